@@ -0,0 +1,276 @@
+"""
+Пакетная обработка архивных записей: каталог видеофайлов -> индекс таймлайнов детекции.
+
+Обрабатывает записи стримов (stream/{stream_id}.mp4) и выгрузки камер с NAS
+без загрузки по HTTP. Файлы делятся на диапазоны сэмплов (CHUNK_SAMPLES
+сэмплов по --interval секунд), диапазоны декодируются в пуле процессов
+(services/sparse_decode.py: с PyAV — переход к ключевому кадру перед каждым
+сэмплом), кадры проверяются детектором в пуле потоков, а вердикты сэмплов
+записываются в индекс (services/archive_index.py). Контрольная точка файла
+сдвигается после каждого обработанного по порядку диапазона, поэтому
+повторный запуск после сбоя продолжает обработку с нее. Файлы, уже
+обработанные текущей конфигурацией детектора, пропускаются.
+
+Примеры:
+    python archive_batch.py scan stream /mnt/nas/cameras --workers 4 --detector-concurrency 8
+    python archive_batch.py query --verdict Yes
+    python archive_batch.py query --timeline /mnt/nas/cameras/cam1/2024-05-01.mp4
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from routers.video_processing import SAMPLE_INTERVAL, sliding_window_verdict
+from services.archive_index import ArchiveIndex, ARCHIVE_INDEX_PATH
+from services.logging_config import setup_logging
+from services.sparse_decode import count_samples, encode_sample_range
+from utils import detect_smoking, normalize_verdict, DETECTOR_CONFIG_VERSION
+
+logger = logging.getLogger("archive_batch")
+
+# Расширения видеофайлов, которые ищутся в каталогах
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".ts", ".webm", ".flv", ".m4v")
+
+# Сэмплов в одном диапазоне (при интервале 5 с — 5 минут записи)
+CHUNK_SAMPLES = int(os.getenv("ARCHIVE_CHUNK_SAMPLES", "60"))
+
+
+def scan_videos(roots: List[str], min_age: float) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Видеофайлы каталогов (рекурсивно) в порядке путей.
+    Файлы, изменявшиеся последние min_age секунд, пропускаются: их еще записывает стрим.
+    """
+    now = time.time()
+    for root in roots:
+        if os.path.isfile(root):
+            candidates = [os.path.abspath(root)]
+        else:
+            candidates = []
+            for directory, subdirectories, filenames in os.walk(root):
+                subdirectories.sort()
+                candidates.extend(
+                    os.path.abspath(os.path.join(directory, name))
+                    for name in sorted(filenames) if name.lower().endswith(VIDEO_EXTENSIONS)
+                )
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime < min_age:
+                logger.info("Пропуск %s: файл изменялся менее %.0f с назад", path, min_age)
+                continue
+            yield path, stat
+
+
+def file_chunks(first_sample: int, total_samples: Optional[int]) -> List[Tuple[int, Optional[int]]]:
+    """Диапазоны сэмплов файла начиная с контрольной точки; последний диапазон открыт (None)."""
+    if total_samples is None:
+        return [(first_sample, None)]
+    starts = list(range(first_sample, max(total_samples, first_sample + 1), CHUNK_SAMPLES))
+    return [(start, end) for start, end in zip(starts, starts[1:] + [None])]
+
+
+class FileProgress:
+    """Обработанные диапазоны файла для сдвига контрольной точки по порядку."""
+
+    def __init__(self, path: str, chunks: List[Tuple[int, Optional[int]]]):
+        self.path = path
+        self.pending = list(chunks)
+        # Формат: { начало обработанного диапазона: номер следующего за ним сэмпла }
+        self.done: Dict[int, int] = {}
+        self.failed = False
+
+    def complete(self, first_sample: int, next_sample: int) -> Optional[int]:
+        """Отмечает диапазон обработанным. Возвращает новую контрольную точку или None, если она не сдвинулась."""
+        self.done[first_sample] = next_sample
+        checkpoint = None
+        while self.pending and self.pending[0][0] in self.done:
+            start, _ = self.pending.pop(0)
+            checkpoint = self.done.pop(start)
+        return checkpoint
+
+    @property
+    def finished(self) -> bool:
+        return not self.pending
+
+
+def run_scan(args) -> dict:
+    index = ArchiveIndex(args.index)
+    config_version = f"{DETECTOR_CONFIG_VERSION}-s{args.interval:g}"
+    decode_pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+    detect_pool = ThreadPoolExecutor(max_workers=args.detector_concurrency)
+
+    files = scan_videos(args.paths, args.min_age)
+    progress: Dict[str, FileProgress] = {}
+    queued: List[Tuple[str, int, Optional[int]]] = []
+    # Формат: { future декодирования: (путь, диапазон) }
+    decoding: Dict[Future, Tuple[str, int, Optional[int]]] = {}
+    # Формат: { future детекции: (путь, начало диапазона, номер сэмпла в диапазоне, время) }
+    detecting: Dict[Future, Tuple[str, int, int, float]] = {}
+    # Формат: { (путь, начало диапазона): [(номер сэмпла, время, вердикт) или None, ...] }
+    chunk_results: Dict[Tuple[str, int], List] = {}
+    summary = {"files": 0, "skipped": 0, "completed": 0, "failed": 0, "samples": 0}
+    started = time.time()
+
+    def fill_queue() -> bool:
+        """Добавляет диапазоны следующего необработанного файла. False — файлов больше нет."""
+        for path, stat in files:
+            summary["files"] += 1
+            if not args.force and index.is_completed(path, stat.st_size, stat.st_mtime_ns, config_version):
+                summary["skipped"] += 1
+                continue
+            try:
+                total_samples = count_samples(path, args.interval)
+            except IOError as e:
+                index.start_file(path, stat.st_size, stat.st_mtime_ns, config_version, None)
+                index.fail_file(path, str(e))
+                summary["failed"] += 1
+                logger.warning("Не удалось открыть %s: %s", path, e)
+                continue
+            first_sample = index.start_file(path, stat.st_size, stat.st_mtime_ns, config_version, total_samples, reset=args.force)
+            chunks = file_chunks(first_sample, total_samples)
+            progress[path] = FileProgress(path, chunks)
+            queued.extend((path, start, end) for start, end in chunks)
+            logger.info("%s: %s сэмплов, продолжение с %d", path, total_samples if total_samples is not None else "?", first_sample)
+            return True
+        return False
+
+    def finish_file(path: str):
+        state = progress.pop(path)
+        if state.failed:
+            summary["failed"] += 1
+            return
+        verdicts = [verdict for _, verdict in index.timeline(path)]
+        verdict = sliding_window_verdict(verdicts)
+        index.complete_file(path, verdict)
+        summary["completed"] += 1
+        logger.info("%s: %s (%d сэмплов)", path, verdict, len(verdicts))
+
+    def complete_chunk(path: str, start: int):
+        """Записывает вердикты диапазона и сдвигает контрольную точку файла."""
+        results = chunk_results.pop((path, start))
+        state = progress[path]
+        answered = [result for result in results if result[2] is not None]
+        if len(answered) < len(results):
+            # Контрольная точка не сдвигается дальше диапазона с ошибками детектора
+            state.failed = True
+            index.fail_file(path, f"Detector returned no answer for {len(results) - len(answered)} samples")
+        index.put_samples(path, answered)
+        summary["samples"] += len(answered)
+        if state.failed:
+            state.pending = [chunk for chunk in state.pending if chunk[0] != start]
+        else:
+            checkpoint = state.complete(start, start + len(results))
+            if checkpoint is not None:
+                index.checkpoint(path, checkpoint)
+        if state.finished:
+            finish_file(path)
+
+    # В работе не больше 2 * workers диапазонов, поэтому память не зависит от объема архива
+    max_in_flight = args.workers * 2
+    exhausted = False
+    try:
+        while True:
+            while len(decoding) + len(chunk_results) < max_in_flight:
+                if not queued and (exhausted or not fill_queue()):
+                    exhausted = True
+                    break
+                if not queued:
+                    continue
+                path, start, end = queued.pop(0)
+                future = decode_pool.submit(encode_sample_range, path, args.interval, start, end)
+                decoding[future] = (path, start, end)
+
+            if not decoding and not detecting:
+                break
+            done, _ = wait(list(decoding) + list(detecting), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in decoding:
+                    path, start, end = decoding.pop(future)
+                    try:
+                        samples = future.result()
+                    except Exception as e:
+                        logger.warning("Ошибка декодирования %s [%d, %s): %s", path, start, end, e)
+                        progress[path].failed = True
+                        index.fail_file(path, f"Decode error: {e}")
+                        samples = []
+                    chunk_results[(path, start)] = [None] * len(samples)
+                    for number, (timestamp, b64_image) in enumerate(samples):
+                        detecting[detect_pool.submit(detect_smoking, b64_image)] = (path, start, number, timestamp)
+                    if not samples:
+                        complete_chunk(path, start)
+                else:
+                    path, start, number, timestamp = detecting.pop(future)
+                    verdict_raw = future.result()
+                    results = chunk_results[(path, start)]
+                    results[number] = (start + number, timestamp, normalize_verdict(verdict_raw) if verdict_raw else None)
+                    if all(result is not None for result in results):
+                        complete_chunk(path, start)
+    except KeyboardInterrupt:
+        logger.warning("Прервано; обработка продолжится с контрольных точек при следующем запуске")
+        raise
+    finally:
+        decode_pool.shutdown(wait=False, cancel_futures=True)
+        detect_pool.shutdown(wait=False, cancel_futures=True)
+        index.close()
+
+    summary["elapsed"] = round(time.time() - started, 3)
+    return summary
+
+
+def run_query(args) -> None:
+    index = ArchiveIndex(args.index)
+    try:
+        if args.timeline:
+            path = os.path.abspath(args.timeline)
+            record = index.get_file(path)
+            if record is None:
+                sys.exit(f"{path} is not in the index")
+            record["segments"] = index.positive_segments(path, args.interval)
+            record["timeline"] = index.timeline(path)
+            print(json.dumps(record, ensure_ascii=False))
+            return
+        for record in index.files(status=args.status, verdict=args.verdict, prefix=args.prefix):
+            record["segments"] = index.positive_segments(record["path"], args.interval)
+            print(json.dumps(record, ensure_ascii=False))
+    finally:
+        index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная детекция курения в архивных видеозаписях")
+    parser.add_argument("--index", default=ARCHIVE_INDEX_PATH, help="Путь к SQLite индексу")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL, help="Шаг сэмплирования в секундах")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan = subparsers.add_parser("scan", help="Обработать видеофайлы каталогов")
+    scan.add_argument("paths", nargs="+", help="Каталоги или файлы")
+    scan.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Процессов декодирования")
+    scan.add_argument("--detector-concurrency", type=int, default=8, help="Одновременных вызовов детектора")
+    scan.add_argument("--min-age", type=float, default=60.0, help="Пропускать файлы, изменявшиеся последние N секунд")
+    scan.add_argument("--force", action="store_true", help="Обработать заново уже обработанные файлы")
+
+    query = subparsers.add_parser("query", help="Вывести файлы индекса в формате JSON Lines")
+    query.add_argument("--status", choices=["pending", "completed", "failed"])
+    query.add_argument("--verdict", help="Вердикт файла (Yes/No)")
+    query.add_argument("--prefix", help="Префикс пути файла")
+    query.add_argument("--timeline", help="Вывести таймлайн сэмплов одного файла")
+
+    args = parser.parse_args()
+    if args.command == "scan":
+        setup_logging()
+        print(json.dumps(run_scan(args), ensure_ascii=False))
+    else:
+        run_query(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Локальный мок AI детектора с OpenAI-совместимым API.
+
+Отвечает на POST /v1/chat/completions так же, как OpenRouter, но без сети и
+оплаты: задержка берется из заданного распределения, часть запросов
+завершается ошибкой, вердикты выдаются по сценарию. Генератор случайных чисел
+инициализируется --seed, поэтому последовательность задержек, ошибок и
+вердиктов воспроизводима от запуска к запуску.
+
+Запуск мока и сервера, который к нему обращается:
+    python benchmarks/mock_detector.py --port 8100 --latency lognormal:0.4:0.5 --error-rate 0.02 --verdicts No,No,Yes
+    DETECTOR_BASE_URL=http://127.0.0.1:8100/v1 DETECTOR_API_KEY=mock uvicorn main:app
+
+Форматы --latency (секунды):
+    fixed:0.3              — постоянная задержка
+    uniform:0.1:0.6        — равномерное распределение
+    lognormal:0.4:0.5      — логнормальное с медианой 0.4 и sigma 0.5 (тяжелый хвост)
+    normal:0.4:0.1         — нормальное (обрезается снизу нулем)
+"""
+
+import argparse
+import asyncio
+import math
+import random
+import time
+import uuid
+from typing import Callable, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Разбирает описание распределения задержки в функцию выборки."""
+    kind, *params = spec.split(":")
+    values = [float(value) for value in params]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    raise ValueError(f"Unsupported latency spec: {spec}")
+
+
+class MockDetector:
+    """Состояние мока: сценарий вердиктов, генератор случайных чисел и статистика."""
+
+    def __init__(self, latency: str = "fixed:0.2", error_rate: float = 0.0, error_status: int = 500,
+                 verdicts: List[str] = ("No",), seed: int = 0):
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verdicts = list(verdicts)
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.verdict_counts = {}
+
+    def next_response(self):
+        """Следующие (задержка, вердикт или None при ошибке) по сценарию."""
+        index = self.requests
+        self.requests += 1
+        latency = self.sample_latency(self.rng)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return latency, None
+        verdict = self.verdicts[index % len(self.verdicts)]
+        self.verdict_counts[verdict] = self.verdict_counts.get(verdict, 0) + 1
+        return latency, verdict
+
+
+def create_app(detector: MockDetector) -> FastAPI:
+    app = FastAPI(title="Mock detector")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        latency, verdict = detector.next_response()
+        await asyncio.sleep(latency)
+        detector.latency_total += latency
+
+        if verdict is None:
+            return JSONResponse(
+                {"error": {"message": "Mock detector error", "type": "server_error", "code": detector.error_status}},
+                status_code=detector.error_status
+            )
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": verdict},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 1, "total_tokens": 1},
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "requests": detector.requests,
+            "errors": detector.errors,
+            "verdicts": detector.verdict_counts,
+            "mean_latency": round(detector.latency_total / detector.requests, 4) if detector.requests else None,
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный OpenAI-совместимый мок AI детектора")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="fixed:0.2", help="Распределение задержки, например lognormal:0.4:0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, завершающихся ошибкой")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP статус ошибки (500, 429, ...)")
+    parser.add_argument("--verdicts", default="No", help="Сценарий вердиктов через запятую, повторяется по кругу")
+    parser.add_argument("--verdicts-file", help="Сценарий вердиктов из файла (по одному на строку)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.verdicts_file:
+        with open(args.verdicts_file, encoding="utf-8") as f:
+            verdicts = [line.strip() for line in f if line.strip()]
+    else:
+        verdicts = [verdict.strip() for verdict in args.verdicts.split(",") if verdict.strip()]
+
+    detector = MockDetector(args.latency, args.error_rate, args.error_status, verdicts, args.seed)
+    uvicorn.run(create_app(detector), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Воспроизведение записанных видео через API для воспроизводимых нагрузочных тестов.
+
+Прогоняет видеофайлы через работающий сервер (обычно запущенный с
+DETECTOR_BASE_URL мок-сервера из benchmarks/mock_detector.py):
+- video: загружает файлы в /video/detect-smoking и ждет результата задачи.
+  Индекс повторов по умолчанию обходится (dedup=false), чтобы --repeat измерял
+  обработку, а не отдачу закэшированного вердикта; --dedup включает его;
+- stream: открывает файлы как URL стримы (/stream/open-stream-url), подключается
+  к WebSocket и собирает вердикты до остановки стрима. Файлы должны быть
+  доступны серверу по тому же пути, поэтому режим предназначен для локального сервера.
+
+Пример:
+    python benchmarks/replay.py recordings/*.mp4 --mode both --concurrency 4 --repeat 3 --json bench_output.json
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import requests
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": round(p50, 3), "p90": round(p90, 3), "p99": round(p99, 3), "max": round(max(values), 3)}
+
+
+# ============================================================================
+# /video/detect-smoking
+# ============================================================================
+
+def replay_video(server: str, path: str, poll_interval: float, timeout: float, dedup: bool = False) -> dict:
+    """Загружает видео и ждет результата. Возвращает вердикт и время до результата."""
+    started = time.time()
+    with open(path, "rb") as f:
+        response = requests.post(
+            f"{server}/video/detect-smoking",
+            params={"dedup": str(dedup).lower()},
+            files={"file": (os.path.basename(path), f, "video/mp4")},
+        )
+    response.raise_for_status()
+    status_url = f"{server}{response.json()['status_url']}"
+
+    while time.time() - started < timeout:
+        job = requests.get(status_url).json()
+        if job.get("status") != "processing":
+            return {"file": path, "status": job.get("status"), "verdict": job.get("verdict"), "latency": time.time() - started}
+        time.sleep(poll_interval)
+    return {"file": path, "status": "timeout", "verdict": None, "latency": time.time() - started}
+
+
+def run_video_mode(args) -> dict:
+    jobs = [path for _ in range(args.repeat) for path in args.files]
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda path: replay_video(args.server, path, args.poll_interval, args.timeout, args.dedup), jobs))
+    elapsed = time.time() - started
+
+    completed = [result for result in results if result["status"] == "completed"]
+    return {
+        "jobs": len(results),
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "elapsed": round(elapsed, 3),
+        "throughput_jobs_per_min": round(len(completed) / elapsed * 60, 2) if elapsed else None,
+        "latency_s": percentiles([result["latency"] for result in completed]),
+        "verdicts": {path: sorted({result["verdict"] for result in results if result["file"] == path and result["verdict"]}) for path in args.files},
+    }
+
+
+# ============================================================================
+# /stream/open-stream-url
+# ============================================================================
+
+def replay_stream(server: str, path: str, detection_interval: int, timeout: float) -> dict:
+    """Открывает файл как URL стрим и собирает вердикты детекции до его остановки."""
+    from websockets.sync.client import connect
+
+    started = time.time()
+    response = requests.post(
+        f"{server}/stream/open-stream-url",
+        json={"url": os.path.abspath(path), "detection_interval": detection_interval}
+    )
+    response.raise_for_status()
+    stream = response.json()
+    stream_id = stream["stream_id"]
+
+    verdicts = []
+    latencies = []
+    ws_url = server.replace("http", "ws", 1) + stream["websocket_url"]
+    with connect(ws_url, max_size=None) as websocket:
+        done = threading.Event()
+
+        def watch_status():
+            # Стрим файла останавливается сам, когда кадры заканчиваются
+            while not done.is_set() and time.time() - started < timeout:
+                status = requests.get(f"{server}/stream/status/{stream_id}").json().get("status")
+                if status in ("stopped", "error"):
+                    break
+                time.sleep(0.5)
+            done.set()
+            websocket.close()
+
+        watcher = threading.Thread(target=watch_status, daemon=True)
+        watcher.start()
+        try:
+            for message in websocket:
+                data = json.loads(message)
+                if data.get("type") == "smoking_detection":
+                    verdicts.append(data["verdict"])
+                    latencies.append(time.time() - data["timestamp"])
+        except Exception:
+            pass
+        done.set()
+        watcher.join()
+
+    return {"file": path, "elapsed": time.time() - started, "verdicts": verdicts, "latencies": latencies}
+
+
+def run_stream_mode(args) -> dict:
+    jobs = [path for _ in range(args.repeat) for path in args.files]
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda path: replay_stream(args.server, path, args.detection_interval, args.timeout), jobs))
+    elapsed = time.time() - started
+
+    latencies = [latency for result in results for latency in result["latencies"]]
+    return {
+        "streams": len(results),
+        "elapsed": round(elapsed, 3),
+        "detections": len(latencies),
+        "detections_per_min": round(len(latencies) / elapsed * 60, 2) if elapsed else None,
+        "detection_latency_s": percentiles(latencies),
+        "positive": sum(result["verdicts"].count("Yes") for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение видеофайлов через API сервера")
+    parser.add_argument("files", nargs="+", help="Видеофайлы для воспроизведения")
+    parser.add_argument("--server", default="http://127.0.0.1:8000")
+    parser.add_argument("--mode", choices=["video", "stream", "both"], default="video")
+    parser.add_argument("--concurrency", type=int, default=1, help="Количество одновременных загрузок или стримов")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз воспроизвести каждый файл")
+    parser.add_argument("--dedup", action="store_true", help="Не обходить индекс повторов: повторные загрузки получают закэшированный вердикт")
+    parser.add_argument("--detection-interval", type=int, default=5, help="Базовый интервал детекции для стримов")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Интервал опроса результата задачи")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Максимальное время на один файл")
+    parser.add_argument("--json", help="Сохранить результат в JSON файл")
+    args = parser.parse_args()
+
+    report = {"config": vars(args)}
+    if args.mode in ("video", "both"):
+        report["video"] = run_video_mode(args)
+    if args.mode in ("stream", "both"):
+        report["stream"] = run_stream_mode(args)
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
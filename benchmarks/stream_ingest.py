@@ -0,0 +1,317 @@
+"""
+Бенчмарк приема видеопотоков через WebSocket.
+
+Запускает приложение в этом же процессе (uvicorn в отдельном потоке) с
+локальной заглушкой детектора, а нагрузку создает в дочернем процессе, чтобы
+CPU и RSS сервера не смешивались с клиентами:
+- N издателей отправляют синтетические JPEG кадры в /ws/stream/{id} с заданными FPS и разрешением;
+- M зрителей читают MJPEG поток /stream/video/{id}.
+
+В каждый кадр зашит его номер (полоса черно-белых блоков сверху), поэтому
+зритель определяет, какой кадр получил, и считает задержку от отправки до
+показа. Задержка детекции считается по вердиктам, которые издатель получает
+через WebSocket.
+
+Пример:
+    python benchmarks/stream_ingest.py --publishers 8 --viewers 8 --fps 15 --width 1280 --height 720 --duration 30
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Сколько бит номера кадра зашивается в кадр и высота полосы с ними (пиксели)
+SEQ_BITS = 16
+SEQ_BAND_HEIGHT = 16
+
+# Количество заранее закодированных кадров (номер кадра берется по модулю)
+FRAME_POOL_SIZE = 256
+
+
+# ============================================================================
+# СИНТЕТИЧЕСКИЕ КАДРЫ
+# ============================================================================
+
+def make_frame(seq: int, width: int, height: int) -> np.ndarray:
+    """Кадр с движущимся прямоугольником и номером кадра в верхней полосе."""
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    size = max(16, min(width, height) // 6)
+    x = (seq * 7) % max(1, width - size)
+    y = SEQ_BAND_HEIGHT + (seq * 3) % max(1, height - size - SEQ_BAND_HEIGHT)
+    cv2.rectangle(frame, (x, y), (x + size, y + size), (40, 160, 220), -1)
+
+    block = width // SEQ_BITS
+    for bit in range(SEQ_BITS):
+        value = 255 if (seq >> bit) & 1 else 0
+        frame[:SEQ_BAND_HEIGHT, bit * block:(bit + 1) * block] = value
+    return frame
+
+
+def read_seq(jpeg: bytes) -> Optional[int]:
+    """Читает номер кадра из JPEG (декодирование в половинном разрешении)."""
+    image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if image is None:
+        return None
+    block = image.shape[1] / SEQ_BITS
+    row = image[SEQ_BAND_HEIGHT // 4]
+    seq = 0
+    for bit in range(SEQ_BITS):
+        if row[int((bit + 0.5) * block)] > 127:
+            seq |= 1 << bit
+    return seq
+
+
+def build_frame_pool(width: int, height: int, quality: int) -> List[str]:
+    """Заранее кодирует кадры в data URI, чтобы издатели не тратили CPU на кодирование."""
+    pool = []
+    for seq in range(FRAME_POOL_SIZE):
+        _, buffer = cv2.imencode('.jpg', make_frame(seq, width, height), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        pool.append("data:image/jpeg;base64," + base64.b64encode(buffer).decode('ascii'))
+    return pool
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": round(p50 * 1000, 1), "p90": round(p90 * 1000, 1), "p99": round(p99 * 1000, 1), "max": round(max(values) * 1000, 1)}
+
+
+# ============================================================================
+# КЛИЕНТЫ (дочерний процесс)
+# ============================================================================
+
+class ClientStats:
+    def __init__(self, measure_from: float):
+        self.measure_from = measure_from
+        self.frames_sent = 0
+        self.frames_viewed = 0
+        self.e2e_latency: List[float] = []
+        self.detection_latency: List[float] = []
+        # Время отправки кадров: { (индекс стрима, номер кадра по модулю пула): время }
+        self.sent_at: Dict[tuple, float] = {}
+
+    def measuring(self, now: float) -> bool:
+        return now >= self.measure_from
+
+
+async def run_publisher(index: int, port: int, stream_id: str, pool: List[str], fps: float, stop_at: float, stats: ClientStats):
+    import websockets
+
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/stream/{stream_id}", max_size=None) as websocket:
+        async def receive_verdicts():
+            async for message in websocket:
+                data = json.loads(message)
+                now = time.time()
+                if data.get("type") == "smoking_detection" and stats.measuring(now):
+                    stats.detection_latency.append(now - data["timestamp"])
+
+        receiver = asyncio.create_task(receive_verdicts())
+        period = 1.0 / fps
+        next_send = time.time()
+        seq = 0
+        while time.time() < stop_at:
+            slot = seq % FRAME_POOL_SIZE
+            now = time.time()
+            stats.sent_at[(index, slot)] = now
+            await websocket.send(pool[slot])
+            if stats.measuring(now):
+                stats.frames_sent += 1
+            seq += 1
+            next_send += period
+            await asyncio.sleep(max(0.0, next_send - time.time()))
+        receiver.cancel()
+
+
+async def run_viewer(index: int, port: int, stream_id: str, stop_at: float, stats: ClientStats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    # HTTP/1.0: тело без chunked кодирования, кадры ищутся по маркерам начала и конца JPEG
+    writer.write(f"GET /stream/video/{stream_id} HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n".encode("ascii"))
+    await writer.drain()
+
+    buffer = b""
+    last_slot = None
+    try:
+        while time.time() < stop_at:
+            try:
+                chunk = await asyncio.wait_for(reader.read(1 << 16), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                break
+            buffer += chunk
+            while True:
+                start = buffer.find(b"\xff\xd8")
+                end = buffer.find(b"\xff\xd9", start + 2)
+                if start < 0 or end < 0:
+                    break
+                jpeg, buffer = buffer[start:end + 2], buffer[end + 2:]
+                now = time.time()
+                slot = read_seq(jpeg)
+                # MJPEG поток повторяет последний кадр, задержку считаем только для новых
+                if slot is None or slot == last_slot:
+                    continue
+                last_slot = slot
+                sent = stats.sent_at.get((index, slot % FRAME_POOL_SIZE))
+                if sent is not None and stats.measuring(now):
+                    stats.frames_viewed += 1
+                    stats.e2e_latency.append(now - sent)
+    finally:
+        writer.close()
+
+
+async def run_clients(args, port: int, stream_ids: List[str], measure_from: float, stop_at: float) -> dict:
+    pool = build_frame_pool(args.width, args.height, args.quality)
+    stats = ClientStats(measure_from)
+    tasks = [run_publisher(i, port, stream_id, pool, args.fps, stop_at, stats) for i, stream_id in enumerate(stream_ids)]
+    tasks += [run_viewer(i % len(stream_ids), port, stream_ids[i % len(stream_ids)], stop_at, stats) for i in range(args.viewers)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [repr(result) for result in results if isinstance(result, Exception)]
+
+    duration = stop_at - measure_from
+    return {
+        "sent_fps": round(stats.frames_sent / duration, 2),
+        "viewed_fps": round(stats.frames_viewed / duration, 2),
+        "e2e_latency_ms": percentiles(stats.e2e_latency),
+        "detection_latency_ms": percentiles(stats.detection_latency),
+        "detections": len(stats.detection_latency),
+        "errors": errors,
+    }
+
+
+def client_process(args, port: int, stream_ids: List[str], measure_from: float, stop_at: float, results):
+    results.put(asyncio.run(run_clients(args, port, stream_ids, measure_from, stop_at)))
+
+
+# ============================================================================
+# СЕРВЕР (текущий процесс)
+# ============================================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes() -> int:
+    """Текущий RSS процесса (Linux), иначе максимальный RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_server(port: int):
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=64 * 1024 * 1024))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def server_frames() -> float:
+    from services.metrics import metrics
+    return sum(metrics.frames._values.values())
+
+
+def stage_means() -> Dict[str, float]:
+    from services.metrics import metrics
+    return {
+        labels[0]: round(total / sum(counts) * 1000, 3)
+        for labels, (counts, total) in metrics.stage_latency._series.items()
+        if sum(counts)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк приема видеопотоков через WebSocket")
+    parser.add_argument("--publishers", type=int, default=4, help="Количество WebSocket издателей (стримов)")
+    parser.add_argument("--viewers", type=int, default=4, help="Количество MJPEG зрителей (распределяются по стримам)")
+    parser.add_argument("--fps", type=float, default=15.0, help="FPS каждого издателя")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--quality", type=int, default=80, help="Качество JPEG синтетических кадров")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность измерения (секунды)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Прогрев перед измерением (секунды)")
+    parser.add_argument("--detector-latency", type=float, default=0.2, help="Задержка заглушки детектора (секунды)")
+    parser.add_argument("--json", help="Сохранить результат в JSON файл")
+    args = parser.parse_args()
+
+    # Настройки сервера задаются до импорта приложения
+    os.environ["DETECTOR_BACKEND"] = "stub"
+    os.environ["DETECTOR_STUB_LATENCY"] = str(args.detector_latency)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("MAX_STREAMS", str(max(16, args.publishers)))
+    sys.path.insert(0, REPO_ROOT)
+
+    import requests
+
+    port = free_port()
+    start_server(port)
+    rss_base = rss_bytes()
+    # Записи стримов пишутся во временную папку
+    workdir = tempfile.TemporaryDirectory(prefix="stream-bench-")
+    os.chdir(workdir.name)
+
+    stream_ids = [requests.post(f"http://127.0.0.1:{port}/stream/request").json()["stream_id"] for _ in range(args.publishers)]
+
+    start = time.time()
+    measure_from = start + args.warmup
+    stop_at = measure_from + args.duration
+    results = multiprocessing.get_context("spawn").Queue()
+    clients = multiprocessing.get_context("spawn").Process(
+        target=client_process, args=(args, port, stream_ids, measure_from, stop_at, results)
+    )
+    clients.start()
+
+    time.sleep(max(0.0, measure_from - time.time()))
+    cpu_start, frames_start = time.process_time(), server_frames()
+    time.sleep(max(0.0, stop_at - time.time()))
+    cpu_used, frames = time.process_time() - cpu_start, server_frames() - frames_start
+    rss = rss_bytes()
+
+    client_report = results.get(timeout=args.warmup + args.duration + 60)
+    clients.join()
+
+    report = {
+        "config": vars(args),
+        "server": {
+            "sustained_fps": round(frames / args.duration, 2),
+            "sustained_fps_per_stream": round(frames / args.duration / args.publishers, 2),
+            "cpu_cores": round(cpu_used / args.duration, 3),
+            "cpu_cores_per_stream": round(cpu_used / args.duration / args.publishers, 4),
+            "rss_mb": round(rss / 2 ** 20, 1),
+            "rss_mb_per_stream": round((rss - rss_base) / 2 ** 20 / args.publishers, 2),
+            "stage_mean_ms": stage_means(),
+        },
+        "clients": client_report,
+    }
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(os.path.join(REPO_ROOT, args.json) if not os.path.isabs(args.json) else args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Микробенчмарки покадровых операций (pytest-benchmark).
+
+Покрывают операции, которые выполняются на каждый кадр или каждый сэмпл:
+декодирование base64 data URI и cv2.imdecode (прием кадра по WebSocket),
+JPEG-85 для last_frames (MJPEG поток), PNG + base64 для детекции,
+VideoWriter.write (запись стрима) и голосование скользящим окном
+(sliding_window_verdict из routers/video_processing.py).
+
+Запуск и сохранение базовой линии:
+    pip install -r requirements-dev.txt
+    pytest benchmarks/test_frame_primitives.py --benchmark-storage=benchmarks/.baselines --benchmark-save=baseline
+
+Сравнение с сохраненной базовой линией после оптимизации:
+    pytest benchmarks/test_frame_primitives.py --benchmark-storage=benchmarks/.baselines --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+
+import base64
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark", reason="pytest-benchmark is not installed: pip install -r requirements-dev.txt")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Импорт роутера не должен создавать клиента AI модели
+os.environ.setdefault("DETECTOR_BACKEND", "stub")
+
+from routers.video_processing import sliding_window_verdict  # noqa: E402
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+
+_frames = {}
+
+
+def synthetic_frame(width: int, height: int) -> np.ndarray:
+    """
+    Детерминированный кадр, похожий на уличную сцену по сжимаемости:
+    плавный градиент, прямоугольники и слабый шум (чистый шум сжимается нереалистично плохо).
+    """
+    key = (width, height)
+    if key not in _frames:
+        rng = np.random.default_rng(0)
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        frame = np.stack([(x + y) / 2, np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width))], axis=2)
+        for _ in range(40):
+            x1, y1 = int(rng.integers(0, width)), int(rng.integers(0, height))
+            color = tuple(int(c) for c in rng.integers(0, 255, 3))
+            cv2.rectangle(frame, (x1, y1), (x1 + width // 12, y1 + height // 10), color, -1)
+        frame += rng.normal(0, 4, frame.shape).astype(np.float32)
+        _frames[key] = np.clip(frame, 0, 255).astype(np.uint8)
+    return _frames[key]
+
+
+@pytest.fixture(params=list(RESOLUTIONS), ids=list(RESOLUTIONS))
+def frame(request):
+    return synthetic_frame(*RESOLUTIONS[request.param])
+
+
+@pytest.fixture
+def data_uri(frame):
+    """Кадр в том виде, в котором его присылает браузер (JPEG 70 в data URI)."""
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])
+    return "data:image/jpeg;base64," + base64.b64encode(buffer).decode('utf-8')
+
+
+def test_data_uri_base64_decode(benchmark, data_uri):
+    def decode():
+        header, encoded = data_uri.split(",", 1)
+        return np.frombuffer(base64.b64decode(encoded), np.uint8)
+
+    assert benchmark(decode).size > 0
+
+
+def test_imdecode(benchmark, data_uri):
+    np_arr = np.frombuffer(base64.b64decode(data_uri.split(",", 1)[1]), np.uint8)
+    assert benchmark(cv2.imdecode, np_arr, cv2.IMREAD_COLOR) is not None
+
+
+def test_jpeg85_encode_last_frame(benchmark, frame):
+    def encode():
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        return buffer.tobytes()
+
+    assert benchmark(encode)
+
+
+def test_png_base64_encode_for_detection(benchmark, frame):
+    def encode():
+        _, buffer = cv2.imencode('.png', frame)
+        return base64.b64encode(buffer).decode('utf-8')
+
+    assert benchmark(encode)
+
+
+def test_video_writer_write(benchmark, frame, tmp_path):
+    height, width = frame.shape[:2]
+    writer = cv2.VideoWriter(str(tmp_path / "bench.mp4"), cv2.VideoWriter_fourcc(*'mp4v'), 30.0, (width, height))
+    if not writer.isOpened():
+        pytest.skip("mp4v VideoWriter is not available in this OpenCV build")
+    try:
+        benchmark(writer.write, frame)
+    finally:
+        writer.release()
+
+
+@pytest.mark.parametrize("samples", [12, 720, 17280], ids=["1min", "1h", "24h"])
+def test_sliding_window_verdict(benchmark, samples):
+    # Один сэмпл раз в 5 секунд; детерминированная смесь вердиктов
+    rng = np.random.default_rng(samples)
+    verdicts = ["Yes" if value else "No" for value in rng.random(samples) < 0.3]
+    assert benchmark(sliding_window_verdict, verdicts) in ("Yes", "No")
@@ -0,0 +1,104 @@
+"""
+Локальная заглушка вебхука для проверки доставки оповещений (services/alerts.py).
+
+Принимает POST {"alerts": [...]} на любой путь, запоминает полученные
+оповещения и отвечает 200; часть запросов (--error-rate) завершается ошибкой
+--error-status, чтобы проверить повторы и постоянную очередь. Подпись
+X-Alert-Signature проверяется, если задан --secret. GET /stats возвращает
+количество запросов, ошибок, оповещений и повторно доставленных оповещений.
+
+Запуск заглушки и сервера, который отправляет на нее оповещения:
+    python benchmarks/webhook_stub.py --port 8200 --error-rate 0.3 --secret s3cret
+    ALERT_WEBHOOK_URLS=http://127.0.0.1:8200/alerts ALERT_WEBHOOK_SECRET=s3cret uvicorn main:app
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import random
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def sign_body(body: bytes, secret: str) -> str:
+    """Подпись тела запроса так же, как в services/alerts.py."""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class WebhookStub:
+    """Состояние заглушки: генератор ошибок и полученные оповещения."""
+
+    def __init__(self, error_rate: float = 0.0, error_status: int = 500, secret: Optional[str] = None,
+                 seed: int = 0, keep: int = 1000):
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.secret = secret
+        self.rng = random.Random(seed)
+        self.keep = keep
+        self.requests = 0
+        self.errors = 0
+        self.bad_signatures = 0
+        self.batch_sizes = []
+        # Формат: { alert_id: сколько раз оповещение было принято }
+        self.received = {}
+        self.last_alerts = []
+
+
+def create_app(stub: WebhookStub) -> FastAPI:
+    app = FastAPI(title="Webhook stub")
+
+    @app.post("/{path:path}")
+    async def receive(path: str, request: Request):
+        body = await request.body()
+        stub.requests += 1
+        if stub.secret and request.headers.get("X-Alert-Signature") != sign_body(body, stub.secret):
+            stub.bad_signatures += 1
+            return JSONResponse({"error": "bad signature"}, status_code=401)
+        if stub.rng.random() < stub.error_rate:
+            stub.errors += 1
+            return JSONResponse({"error": "stub error"}, status_code=stub.error_status)
+
+        alerts = json.loads(body)["alerts"]
+        stub.batch_sizes.append(len(alerts))
+        for alert in alerts:
+            stub.received[alert["alert_id"]] = stub.received.get(alert["alert_id"], 0) + 1
+        stub.last_alerts = (stub.last_alerts + alerts)[-stub.keep:]
+        return {"accepted": len(alerts)}
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "requests": stub.requests,
+            "errors": stub.errors,
+            "bad_signatures": stub.bad_signatures,
+            "batches": len(stub.batch_sizes),
+            "max_batch": max(stub.batch_sizes, default=0),
+            "alerts": len(stub.received),
+            "duplicates": sum(count - 1 for count in stub.received.values()),
+            "suppressed": sum(alert.get("suppressed", 0) for alert in stub.last_alerts),
+            "last_alerts": stub.last_alerts[-10:],
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка вебхука оповещений")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, завершающихся ошибкой")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP статус ошибки (500, 503, ...)")
+    parser.add_argument("--secret", help="Проверять подпись X-Alert-Signature этим секретом")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stub = WebhookStub(args.error_rate, args.error_status, args.secret, args.seed)
+    uvicorn.run(create_app(stub), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
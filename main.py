@@ -1,6 +1,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import ping, streaming, frontend, heatmap, video_processing
+from services.logging_config import setup_logging
+from routers import ping, streaming, frontend, heatmap, video_processing, metrics, admin, events, alerts
+
+# Логи пишутся через очередь в отдельном потоке и не блокируют обработку кадров
+setup_logging()
 
 app = FastAPI(
     title="Video Streaming API",
@@ -29,9 +33,53 @@ app = FastAPI(
     
     **URL:** `/heatmap`
     
-    Отображает тепловую карту на основе данных из `data.json`.
+    Отображает тепловую карту детекций. Начальные точки загружаются из `data.json`,
+    новые события поступают из стримов с указанными координатами камеры.
+    
+    **Эндпоинт данных:** `/api/heatmap-data` (поддерживает `ETag`/`If-None-Match` и `since=`)
     
-    **Эндпоинт данных:** `/api/heatmap-data`
+    Параметр `window=hour|day|week` возвращает очаги за последний час, сутки или неделю.
+
+    ---
+
+    ## Метрики
+
+    **URL:** `/metrics`
+
+    Метрики в текстовом формате Prometheus: гистограммы задержек этапов обработки кадра
+    (`parse`, `decode`, `write`, `jpeg_encode`, `preprocess`, `detector`, `broadcast`),
+    FPS, глубина очереди к детектору и счетчики сброшенных кадров по стримам.
+
+    ---
+
+    ## Профилирование
+
+    **URL:** `/admin/profiler/*`, `/admin/trace/{stream_id}`
+
+    Сэмплирующий профайлер на заданное время с результатом в формате folded stacks (flamegraph)
+    и трассировка этапов обработки следующих N кадров стрима. Эндпоинты доступны только при
+    заданном `ADMIN_TOKEN`, запросы должны содержать заголовок `X-Admin-Token` с этим значением.
+
+    ---
+
+    ## История событий
+
+    **URL:** `/events`
+
+    Вердикты детекции и события треков всех стримов сохраняются в SQLite (`EVENT_STORE_PATH`, по умолчанию
+    `events.db`). Запрос по интервалу времени, стриму, вердикту и области камер возвращает страницу JSON
+    с курсором или поток NDJSON (`format=ndjson`).
+
+    ---
+
+    ## Оповещения
+
+    **URL:** `/alerts/status`
+
+    Положительные вердикты стримов отправляются POST запросом `{"alerts": [...]}` на вебхуки из
+    `ALERT_WEBHOOK_URLS` не чаще раза в `ALERT_COOLDOWN` секунд на стрим (подавленные вердикты
+    учитываются в поле `suppressed`). Недоставленные оповещения хранятся в `ALERT_OUTBOX_PATH`
+    и повторяются с экспоненциальной задержкой.
     """,
     version="1.0.0"
 )
@@ -51,6 +99,10 @@ app.include_router(streaming.websocket_router)  # WebSocket роутер без
 app.include_router(frontend.router)
 app.include_router(heatmap.router)
 app.include_router(video_processing.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
+app.include_router(events.router)
+app.include_router(alerts.router)
 
 @app.get("/")
 async def root():
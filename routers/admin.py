@@ -0,0 +1,147 @@
+import asyncio
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Path, Query
+from fastapi.responses import PlainTextResponse
+from services.profiling import profiler, stream_tracer, ProfilerBusyError, PROFILER_INTERVAL, PROFILER_MAX_DURATION, TRACE_MAX_FRAMES
+from routers.streaming import stream_sessions
+
+# Админские эндпоинты требуют заголовок X-Admin-Token с этим значением;
+# если токен не задан, они отключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled: ADMIN_TOKEN is not set")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post(
+    "/profiler/start",
+    summary="Запустить сэмплирующий профайлер",
+    description="""
+    Запускает профайлер всех потоков процесса на `duration` секунд.
+    Результат доступен через `/admin/profiler/profile` в свернутом формате
+    (folded stacks) для flamegraph.pl, speedscope или inferno:
+    ```
+    curl -s localhost:8000/admin/profiler/profile > profile.folded
+    flamegraph.pl profile.folded > profile.svg
+    ```
+
+    **Ошибки:**
+    - `409`: Профайлер уже запущен
+    """
+)
+async def start_profiler(
+    duration: float = Query(30.0, gt=0, le=PROFILER_MAX_DURATION, description="Длительность в секундах"),
+    interval: float = Query(PROFILER_INTERVAL, ge=0.001, le=1.0, description="Интервал сэмплирования в секундах"),
+    include_idle: bool = Query(False, description="Учитывать простаивающие потоки (ожидание событий, сон)")
+):
+    """
+    Запускает профайлер.
+    """
+    try:
+        profiler.start(duration, interval, include_idle)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.status()
+
+
+@router.post(
+    "/profiler/stop",
+    summary="Остановить профайлер",
+    description="Останавливает профайлер досрочно и возвращает собранный профиль в свернутом формате.",
+    response_class=PlainTextResponse
+)
+async def stop_profiler():
+    """
+    Останавливает профайлер.
+    """
+    # Ожидание потока профайлера не должно блокировать event loop
+    await asyncio.to_thread(profiler.stop)
+    return PlainTextResponse(profiler.folded())
+
+
+@router.get(
+    "/profiler/status",
+    summary="Состояние профайлера"
+)
+async def get_profiler_status():
+    return profiler.status()
+
+
+@router.get(
+    "/profiler/profile",
+    summary="Профиль последнего запуска",
+    description="Свернутые стеки последнего (или текущего) запуска профайлера: `поток;файл:функция:строка;... количество`.",
+    response_class=PlainTextResponse
+)
+async def get_profile():
+    """
+    Возвращает профиль последнего запуска.
+    """
+    if profiler.started_at is None:
+        raise HTTPException(status_code=404, detail="Profiler has not been run")
+    return PlainTextResponse(profiler.folded())
+
+
+@router.post(
+    "/trace/{stream_id}",
+    summary="Включить трассировку стрима",
+    description="""
+    Записывает время начала и длительность этапов конвейера
+    (`parse`, `decode`, `write`, `jpeg_encode`, `preprocess`, `detector`, `broadcast`)
+    для следующих `frames` кадров стрима. Предыдущая трассировка стрима сбрасывается.
+
+    **Ошибки:**
+    - `404`: Stream ID не найден
+    """
+)
+async def start_stream_trace(
+    stream_id: str = Path(..., description="ID стрима"),
+    frames: int = Query(100, ge=1, le=TRACE_MAX_FRAMES, description="Количество кадров")
+):
+    """
+    Включает трассировку стрима.
+    """
+    if stream_id not in stream_sessions:
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+    trace = stream_tracer.start(stream_id, frames)
+    return {"stream_id": stream_id, "limit": trace.limit, "trace_url": f"/admin/trace/{stream_id}"}
+
+
+@router.get(
+    "/trace",
+    summary="Список трассировок"
+)
+async def list_stream_traces():
+    return {"traces": stream_tracer.list()}
+
+
+@router.get(
+    "/trace/{stream_id}",
+    summary="Результат трассировки стрима",
+    description="Кадры с этапами: смещение начала этапа от начала обработки кадра и длительность в миллисекундах."
+)
+async def get_stream_trace(stream_id: str = Path(..., description="ID стрима")):
+    trace = stream_tracer.get(stream_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"No trace for stream {stream_id}")
+    return trace.to_dict()
+
+
+@router.delete(
+    "/trace/{stream_id}",
+    summary="Удалить трассировку стрима"
+)
+async def delete_stream_trace(stream_id: str = Path(..., description="ID стрима")):
+    trace = stream_tracer.stop(stream_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"No trace for stream {stream_id}")
+    return trace.to_dict()
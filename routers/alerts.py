@@ -0,0 +1,28 @@
+from fastapi import APIRouter
+from services.alerts import alert_dispatcher
+
+router = APIRouter(prefix="/alerts", tags=["Alerts"])
+
+
+@router.on_event("startup")
+async def start_alert_dispatcher():
+    alert_dispatcher.start()
+
+
+@router.on_event("shutdown")
+async def stop_alert_dispatcher():
+    # Неотправленные оповещения остаются в очереди до следующего запуска
+    await alert_dispatcher.stop()
+
+
+@router.get(
+    "/status",
+    summary="Состояние доставки оповещений",
+    description="""
+    Адреса вебхуков, счетчики созданных, подавленных окном `ALERT_COOLDOWN`, доставленных
+    и отброшенных оповещений, а также размер постоянной очереди по адресам и статусам
+    (`pending` — ожидают доставки, `dead` — не доставлены за `ALERT_MAX_ATTEMPTS` попыток).
+    """
+)
+async def get_alert_status():
+    return await alert_dispatcher.status()
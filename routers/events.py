@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import json
+from typing import Literal, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from services.event_store import event_store
+
+# Размер страницы по умолчанию и максимальный для JSON ответа
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Сколько событий читается из базы за один шаг при потоковой выдаче
+STREAM_CHUNK_SIZE = 500
+
+router = APIRouter(prefix="/events", tags=["Events"])
+
+
+@router.on_event("startup")
+async def start_event_store():
+    event_store.start()
+
+
+@router.on_event("shutdown")
+async def stop_event_store():
+    # Дописываем события, оставшиеся в очереди
+    await asyncio.to_thread(event_store.stop)
+
+
+def parse_cursor(cursor: str):
+    try:
+        timestamp, event_id = cursor.rsplit(":", 1)
+        return float(timestamp), int(event_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get(
+    "",
+    summary="История событий детекции",
+    description="""
+    Возвращает сохраненные вердикты детекции (`smoking_detection`) и события треков (`smoking_event`)
+    в порядке времени.
+
+    **Фильтры:**
+    - `start`, `end`: интервал времени (Unix time, `end` не включается)
+    - `stream_id`: ID стрима (для стримов по URL — ID захвата, `capture_id`)
+    - `verdict`: `Yes` или `No`
+    - `type`: тип события
+    - `min_lat`, `min_lng`, `max_lat`, `max_lng`: область расположения камер (все четыре сразу)
+
+    **Формат ответа:**
+    - `json` (по умолчанию): страница `{"events": [...], "next_cursor": ...}`; следующая страница
+      запрашивается с `cursor=next_cursor`, `next_cursor` равен `null` на последней странице
+    - `ndjson`: все подходящие события потоком, по строке JSON на событие (`limit` необязателен)
+
+    **Пример использования (cURL):**
+    ```bash
+    curl "http://localhost:8000/events?stream_id=STREAM_ID&verdict=Yes&start=1717200000"
+    curl -N "http://localhost:8000/events?format=ndjson&start=1717200000&end=1717286400" > day.ndjson
+    ```
+
+    **Ошибки:**
+    - `400`: Неверный курсор или неполная область координат
+    """
+)
+async def list_events(
+    start: Optional[float] = Query(None, description="Начало интервала (Unix time)"),
+    end: Optional[float] = Query(None, description="Конец интервала (Unix time, не включается)"),
+    stream_id: Optional[str] = Query(None, description="ID стрима"),
+    verdict: Optional[Literal["Yes", "No"]] = Query(None, description="Вердикт детекции"),
+    type: Optional[Literal["smoking_detection", "smoking_event"]] = Query(None, description="Тип события"),
+    min_lat: Optional[float] = Query(None, ge=-90.0, le=90.0),
+    min_lng: Optional[float] = Query(None, ge=-180.0, le=180.0),
+    max_lat: Optional[float] = Query(None, ge=-90.0, le=90.0),
+    max_lng: Optional[float] = Query(None, ge=-180.0, le=180.0),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor предыдущего ответа)"),
+    limit: Optional[int] = Query(None, ge=1, description=f"Размер страницы (по умолчанию {DEFAULT_PAGE_SIZE}, не больше {MAX_PAGE_SIZE} для json)"),
+    format: Literal["json", "ndjson"] = Query("json", description="Формат ответа")
+):
+    """
+    Возвращает события по фильтрам страницей JSON или потоком NDJSON.
+    """
+    bounds = (min_lat, min_lng, max_lat, max_lng)
+    if any(value is not None for value in bounds) and any(value is None for value in bounds):
+        raise HTTPException(status_code=400, detail="min_lat, min_lng, max_lat and max_lng must be given together")
+    filters = {
+        "start": start,
+        "end": end,
+        "stream_id": stream_id,
+        "verdict": verdict,
+        "event_type": type,
+        "bbox": bounds if min_lat is not None else None,
+        "after": parse_cursor(cursor) if cursor else None,
+    }
+
+    if format == "ndjson":
+        events = event_store.query(**filters, limit=limit)
+
+        async def generate():
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(lambda: list(itertools.islice(events, STREAM_CHUNK_SIZE)))
+                    if not chunk:
+                        break
+                    yield "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in chunk)
+            finally:
+                events.close()
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    page_size = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    # Одно лишнее событие показывает, есть ли следующая страница
+    events = await asyncio.to_thread(lambda: list(event_store.query(**filters, limit=page_size + 1)))
+    next_cursor = None
+    if len(events) > page_size:
+        events = events[:page_size]
+        next_cursor = f"{events[-1]['timestamp']!r}:{events[-1]['id']}"
+    return {"events": events, "count": len(events), "next_cursor": next_cursor}
+
+
+@router.get(
+    "/stats",
+    summary="Состояние хранилища событий",
+    description="Количество записанных событий, событий в очереди записи и отброшенных из-за переполнения очереди."
+)
+async def get_event_store_stats():
+    return event_store.stats()
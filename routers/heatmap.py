@@ -1,9 +1,51 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import HTMLResponse
-import json
+import asyncio
+import time
+from fastapi import APIRouter, HTTPException, Query, Request, Body
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from services.heatmap_store import heatmap_store, zoom_to_level
+from services.heatmap_push import heatmap_broadcaster
+
+# Интервал отправки keep-alive комментариев в SSE соединение (секунды)
+SSE_KEEPALIVE_INTERVAL = 15.0
+
+# Допустимые временные окна тепловой карты
+HeatmapWindow = Literal["hour", "day", "week"]
 
 router = APIRouter()
 
+
+class HeatmapEvent(BaseModel):
+    """Событие детекции для тепловой карты."""
+    lat: float = Field(..., description="Широта камеры", ge=-90.0, le=90.0)
+    lng: float = Field(..., description="Долгота камеры", ge=-180.0, le=180.0)
+    intensity: float = Field(1.0, description="Интенсивность события", ge=0.0)
+    timestamp: Optional[float] = Field(None, description="Время события (по умолчанию — время получения)")
+
+
+@router.on_event("startup")
+async def start_heatmap():
+    heatmap_store.load_json("data.json")
+    heatmap_broadcaster.start()
+
+
+@router.on_event("shutdown")
+async def stop_heatmap():
+    await heatmap_broadcaster.stop()
+
+
+def parse_bbox(bbox: str):
+    """Разбирает область просмотра "west,south,east,north"; долгота обрезается до [-180, 180]."""
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be 'west,south,east,north'")
+    if south > north or west > east:
+        raise HTTPException(status_code=400, detail="bbox must satisfy south <= north and west <= east")
+    return max(west, -180.0), south, min(east, 180.0), north
+
+
 @router.get("/heatmap", response_class=HTMLResponse)
 async def get_heatmap_page():
     try:
@@ -12,11 +54,101 @@ async def get_heatmap_page():
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="index.html not found")
 
+
 @router.get("/api/heatmap-data")
-async def get_heatmap_data():
-    try:
-        with open('data.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return data
-    except FileNotFoundError:
-        return []
+async def get_heatmap_data(
+    request: Request,
+    since: Optional[int] = Query(None, description="Вернуть только ячейки, изменившиеся после этой версии"),
+    window: Optional[HeatmapWindow] = Query(None, description="Временное окно: hour, day или week (по умолчанию — все время)")
+):
+    if window is None:
+        etag = heatmap_store.etag
+    else:
+        etag = f'W/"heatmap-{heatmap_store.version}-{window}-{heatmap_store.window_stamp(window)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if window is not None:
+        # Значения окна меняются со временем без новых событий, поэтому изменения
+        # по since= для окон не ведутся и всегда отдается полный снимок окна
+        version, points = heatmap_store.snapshot(window=window)
+        if since is None:
+            return JSONResponse(points, headers=headers)
+        return JSONResponse({"version": version, "full": True, "points": points}, headers=headers)
+
+    if since is None:
+        _, body = heatmap_store.snapshot_json()
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    version, points = heatmap_store.changes_since(since)
+    full = points is None
+    if full:
+        version, points = heatmap_store.snapshot()
+    return JSONResponse({"version": version, "full": full, "points": points}, headers=headers)
+
+
+@router.get("/api/heatmap-tiles")
+async def get_heatmap_tiles(
+    request: Request,
+    bbox: str = Query(..., description="Область просмотра: west,south,east,north"),
+    zoom: int = Query(..., description="Масштаб карты", ge=0, le=22),
+    window: Optional[HeatmapWindow] = Query(None, description="Временное окно: hour, day или week (по умолчанию — все время)")
+):
+    west, south, east, north = parse_bbox(bbox)
+    version, level, body = heatmap_store.query_viewport(south, west, north, east, zoom, window)
+    etag = f'W/"heatmap-{version}-{level}-{window or "all"}-{heatmap_store.window_stamp(window)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Heatmap-Version": str(version), "X-Heatmap-Level": str(level)}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/api/heatmap-stream")
+async def stream_heatmap_updates(
+    request: Request,
+    zoom: int = Query(..., description="Масштаб карты", ge=0, le=22),
+    window: Optional[HeatmapWindow] = Query(None, description="Временное окно: hour, day или week (по умолчанию — все время)"),
+    since: Optional[int] = Query(None, description="Версия, уже полученная через HTTP снимок"),
+    bbox: Optional[str] = Query(None, description="Область просмотра: west,south,east,north (по умолчанию — весь мир)")
+):
+    """
+    Server-Sent Events поток изменений тепловой карты.
+
+    Первое сообщение `snapshot` содержит все ячейки уровня в области просмотра (если не
+    передан since), далее приходят сообщения `delta` только с изменившимися ячейками
+    области (`points`) и удаленными ячейками (`removed`), не чаще одного раза за интервал
+    объединения. При смене области просмотра клиент переподписывается.
+    """
+    subscription = heatmap_broadcaster.subscribe(zoom_to_level(zoom), window, since, parse_bbox(bbox) if bbox else None)
+
+    async def event_stream():
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield b": keepalive\n\n"
+                    continue
+                yield message
+        finally:
+            heatmap_broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/api/heatmap-data/events")
+async def add_heatmap_events(events: List[HeatmapEvent] = Body(...)):
+    now = time.time()
+    version = heatmap_store.add_points(
+        {**event.dict(), "timestamp": event.timestamp if event.timestamp is not None else now}
+        for event in events
+    )
+    return {"version": version, "accepted": len(events)}
@@ -0,0 +1,69 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from services.metrics import metrics, Counter, Gauge
+from services.governor import governor
+from services.heatmap_push import heatmap_broadcaster
+from services.event_store import event_store
+from services.alerts import alert_dispatcher
+from routers.streaming import stream_sessions, manager, video_viewers
+
+# Версия текстового формата Prometheus
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+router = APIRouter()
+
+metrics.register(Gauge(
+    "smoking_active_streams",
+    "Live streams",
+    callback=lambda: {(): sum(1 for session in stream_sessions.values() if session.get("live", False) and not session.get("detached", False))},
+))
+metrics.register(Gauge(
+    "smoking_detector_queue_depth",
+    "Detector calls waiting for a slot per stream",
+    ("stream_id",),
+    callback=lambda: {(stream_id,): waiting for stream_id, waiting in governor.detector_waiting().items()},
+))
+metrics.register(Gauge(
+    "smoking_detector_slots_in_use",
+    "Detector slots currently in use",
+    callback=lambda: {(): governor.detector_concurrency - governor.detector_free},
+))
+metrics.register(Gauge(
+    "smoking_stream_viewers",
+    "WebSocket connections and MJPEG viewers per stream",
+    ("stream_id", "kind"),
+    callback=lambda: {
+        **{(stream_id, "websocket"): len(connections) for stream_id, connections in manager.active_connections.items()},
+        **{(stream_id, "mjpeg"): viewers for stream_id, viewers in video_viewers.items()},
+    },
+))
+metrics.register(Gauge(
+    "smoking_heatmap_subscribers",
+    "Heatmap SSE subscribers",
+    callback=lambda: {(): len(heatmap_broadcaster.subscribers)},
+))
+metrics.register(Gauge(
+    "smoking_event_store_pending",
+    "Detection events waiting to be written to the event store",
+    callback=lambda: {(): event_store.pending},
+))
+metrics.register(Counter(
+    "smoking_event_store_dropped_total",
+    "Detection events dropped because the event store queue was full",
+    callback=lambda: {(): event_store.dropped},
+))
+metrics.register(Gauge(
+    "smoking_alerts_outbox_pending",
+    "Alerts waiting for webhook delivery in the outbox",
+    callback=lambda: {(): alert_dispatcher.pending},
+))
+metrics.register(Counter(
+    "smoking_alerts_dropped_total",
+    "Alerts dropped because the in-memory alert queue was full",
+    callback=lambda: {(): alert_dispatcher.dropped},
+))
+
+
+@router.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
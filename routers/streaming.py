@@ -4,9 +4,11 @@
 """
 
 import asyncio
+import logging
 import time
 import uuid
 import base64
+import json
 import os
 import re
 import requests as http_requests
@@ -15,15 +17,35 @@ from collections import deque
 from openai import OpenAI
 import cv2
 import numpy as np
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Body, Path, File, UploadFile
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Body, Path, File, UploadFile, Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from utils import detect_smoking, extract_hls_url_from_page
+from typing import List, Literal, Optional, Tuple
+from utils import detect_smoking, normalize_verdict, DETECTOR_CONFIG_VERSION
+from services.heatmap_store import heatmap_store
+from services.tracking import DetectionTracker, FRAME_TRACKER_PARAMS, VERDICT_TRACKER_PARAMS
+from services.tiling import detect_smoking_tiled
+from services.roi import RoiMask, validate_polygons
+from services.rate_control import rate_controller, BUDGET_POLL_INTERVAL, DEFAULT_DETECTION_INTERVAL
+from services.governor import governor, CapacityError
+from services.metrics import metrics
+from services.hls_resolver import hls_resolver
+from services.capture_registry import capture_registry, SharedCapture
+from services.sparse_decode import SparseCapture, SPARSE_DECODE_BACKEND
+from services.result_index import result_index, content_hash
+from services.source_clock import SourceClock, SOURCE_MAX_PENDING_DETECTIONS
+from services.event_store import event_store
+from services.alerts import alert_dispatcher
+from services.batch_detection import run_batch, BATCH_CONCURRENCY
 
 router = APIRouter(prefix="/stream", tags=["Streaming"])
 websocket_router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# Сколько секунд токен WebSocket стрима держит слот губернатора, пока к нему никто не подключился
+STREAM_TOKEN_CONNECT_TIMEOUT = float(os.getenv("STREAM_TOKEN_CONNECT_TIMEOUT", "60"))
+
 
 # ============================================================================
 # PYDANTIC МОДЕЛИ ДЛЯ API
@@ -72,11 +94,24 @@ class SmokingDetectionResponse(BaseModel):
     """Ответ при детекции курения на фото."""
     verdict: str = Field(..., description="Результат детекции: Yes или No")
     timestamp: float = Field(..., description="Временная метка обработки")
+    deduplicated: bool = Field(False, description="Вердикт взят из индекса: это фото уже проверялось текущим детектором")
 
 class StreamUrlRequest(BaseModel):
     """Запрос на открытие стрима по URL."""
     url: str = Field(..., description="URL видео потока (HLS, RTSP, HTTP, blob и т.д.)")
-    detection_interval: Optional[int] = Field(5, description="Интервал детекции курения в секундах (по умолчанию 5)")
+    detection_interval: Optional[int] = Field(5, description="Базовый интервал детекции курения в секундах (по умолчанию 5), подстраивается под активность стрима")
+    lat: Optional[float] = Field(None, description="Широта камеры (для тепловой карты)", ge=-90.0, le=90.0)
+    lng: Optional[float] = Field(None, description="Долгота камеры (для тепловой карты)", ge=-180.0, le=180.0)
+    tile_grid: Optional[List[int]] = Field(None, description="Сетка тайлов [rows, cols] для детекции на широких кадрах (по умолчанию кадр целиком)", min_items=2, max_items=2)
+    tile_overlap: float = Field(0.1, description="Перекрытие соседних тайлов в долях размера тайла", ge=0.0, lt=1.0)
+    roi: Optional[List[List[List[float]]]] = Field(None, description="Полигоны области интереса [[[x, y], ...], ...] в нормированных координатах 0..1")
+    priority: float = Field(1.0, description="Вес стрима при распределении вызовов детектора", ge=0.1, le=10.0)
+    decode_mode: Literal["full", "sparse"] = Field("full", description="full — декодирование и запись каждого кадра; sparse — только детекция, кадры декодируются по необходимости")
+    clock: Literal["auto", "source", "wall"] = Field("auto", description="Часы интервала детекции: source — время кадров источника (файлы и VOD читаются быстрее реального времени), wall — время сервера (живые источники), auto — по типу источника")
+
+class RoiRequest(BaseModel):
+    """Запрос на установку области интереса (ROI) стрима."""
+    polygons: List[List[List[float]]] = Field(..., description="Полигоны [[[x, y], ...], ...] в нормированных координатах кадра 0..1")
 
 class StreamUrlResponse(BaseModel):
     """Ответ при открытии стрима по URL."""
@@ -86,6 +121,7 @@ class StreamUrlResponse(BaseModel):
     websocket_url: str = Field(..., description="WebSocket URL для получения результатов детекции")
     video_url: str = Field(..., description="URL для просмотра MJPEG потока")
     message: str = Field(..., description="Информационное сообщение")
+    capture_id: Optional[str] = Field(None, description="ID стрима, чей захват источника используется (совпадает с stream_id, если захват новый)")
 
 # Хранилище сессий стримов в памяти
 # Формат: { stream_id: { "live": bool, "closing": bool, "last_frame": bytes, "video_writer": cv2.VideoWriter, ... } }
@@ -100,10 +136,27 @@ stream_sessions: Dict[str, Dict] = {}
 # Формат: { stream_id: bytes } - JPEG закодированный кадр
 last_frames: Dict[str, bytes] = {}
 
+# Количество зрителей MJPEG потока для каждого стрима
+# Формат: { stream_id: int }
+video_viewers: Dict[str, int] = {}
+
 # Очереди результатов детекции для упорядоченного вывода
 # Формат: { stream_id: { 'queue': deque, 'next_frame': int, 'lock': asyncio.Lock } }
 detection_queues: Dict[str, Dict] = {}
 
+# Трекеры детекций по стримам (один трек = одно событие на курящего человека).
+# Вердикты AI модели (рамка на весь кадр) и рамки из /stream/broadcast (пиксели)
+# трекаются раздельно: рамки разных видов не сопоставляются и не старят чужие треки.
+# Формат: { (stream_id, вид): DetectionTracker }, вид — "verdict" или "frame"
+stream_trackers: Dict[Tuple[str, str], DetectionTracker] = {}
+
+# Параметры трекера для каждого вида рамок
+TRACKER_PARAMS = {"verdict": VERDICT_TRACKER_PARAMS, "frame": FRAME_TRACKER_PARAMS}
+
+# Момент открытия стримов, кадры которых помечены временем источника (services/source_clock.py).
+# Формат: { stream_id: clock.started }
+source_clock_origins: Dict[str, float] = {}
+
 # Флаг для управления отображением видео (установите False для серверов без GUI)
 # По умолчанию False, так как большинство серверов работают без GUI
 ENABLE_VIDEO_DISPLAY = False
@@ -152,9 +205,9 @@ class ConnectionManager:
             # Очищаем список соединений, если он пуст
             if not self.active_connections[token]:
                 del self.active_connections[token]
-                print(f"Все WebSocket соединения для стрима {token} отключены")
+                logger.info("Все WebSocket соединения для стрима отключены", extra={"stream_id": token})
             else:
-                print(f"Осталось {len(self.active_connections[token])} соединений для стрима {token}")
+                logger.info("Осталось %d соединений для стрима", len(self.active_connections[token]), extra={"stream_id": token})
 
     async def broadcast_json(self, data: dict, token: str):
         """
@@ -165,20 +218,157 @@ class ConnectionManager:
             token: Stream ID для трансляции
         """
         if token in self.active_connections:
-            for connection in self.active_connections[token]:
-                await connection.send_json(data)
+            with metrics.stage("broadcast", token):
+                for connection in self.active_connections[token]:
+                    await connection.send_json(data)
 
 manager = ConnectionManager()
 
+def get_stream_tracker(stream_id: str, kind: str) -> DetectionTracker:
+    """
+    Возвращает трекер стрима для вида рамок ("verdict" или "frame"), создавая его при первом обращении.
+    """
+    tracker = stream_trackers.get((stream_id, kind))
+    if tracker is None:
+        tracker = stream_trackers[(stream_id, kind)] = DetectionTracker(**TRACKER_PARAMS[kind])
+    return tracker
+
+def needs_verification(stream_id: str, timestamp: float) -> bool:
+    """
+    Нужно ли отправлять очередной кадр стрима в AI модель.
+    Кадры не отправляются, пока все треки стрима подтверждены и недавно проверены.
+    """
+    tracker = stream_trackers.get((stream_id, "verdict"))
+    return tracker is None or tracker.should_verify(timestamp)
+
+async def broadcast_to_subscribers(data: dict, stream_id: str):
+    """
+    Транслирует JSON данные клиентам стрима и всех сессий, подписанных на его захват.
+    """
+    for subscriber in capture_registry.subscribers(stream_id):
+        await manager.broadcast_json(data, subscriber)
+
+def to_wall_clock(stream_id: str, event: dict) -> dict:
+    """
+    Событие с меткой времени сервера для хранилища событий, тепловой карты и оповещений.
+
+    Кадры файла или VOD помечены моментом открытия стрима плюс время в источнике,
+    и такая метка может быть на часы впереди: в скользящих окнах тепловой карты
+    и хранилища она вытеснила бы настоящие события. Для таких стримов время в
+    источнике сохраняется в media_time, а timestamp заменяется на time.time().
+    """
+    origin = source_clock_origins.get(stream_id)
+    if origin is None:
+        return event
+    media_time = event.get("media_time", round(event["timestamp"] - origin, 3))
+    return {**event, "media_time": media_time, "timestamp": time.time()}
+
+async def publish_track_events(stream_id: str, events: List[dict]):
+    """
+    Рассылает события жизненного цикла треков, сохраняет их в хранилище событий
+    и учитывает начало каждого трека на тепловой карте, если для стрима известны
+    координаты камеры.
+
+    Args:
+        stream_id: ID стрима
+        events: События трекера ({"type": "smoking_event", "event": "started" | "ended", ...})
+    """
+    session = stream_sessions.get(stream_id, {})
+    for event in events:
+        event["stream_id"] = stream_id
+        await broadcast_to_subscribers(event, stream_id)
+        stored = to_wall_clock(stream_id, event)
+        event_store.append({**stored, "lat": session.get("lat"), "lng": session.get("lng")})
+        logger.info("Трек #%s: %s", event["track_id"], event["event"], extra={"stream_id": stream_id})
+        if event["event"] == "started" and session.get("lat") is not None and session.get("lng") is not None:
+            heatmap_store.add_point(session["lat"], session["lng"], timestamp=stored["timestamp"])
+
+async def close_stream_tracker(stream_id: str, timestamp: Optional[float] = None):
+    """Завершает все треки стрима и удаляет его трекеры. timestamp — время окончания по часам стрима."""
+    for kind in TRACKER_PARAMS:
+        tracker = stream_trackers.pop((stream_id, kind), None)
+        if tracker is not None:
+            await publish_track_events(stream_id, tracker.close(time.time() if timestamp is None else timestamp))
+
+async def publish_detection(stream_id: str, payload: dict, boxes: Optional[List[List[float]]] = None):
+    """
+    Рассылает результат детекции клиентам стрима, сохраняет его в хранилище
+    событий, передает положительный вердикт в диспетчер оповещений и вердикт в трекер.
+    Трекер и контроллер частоты работают по часам стрима, хранилище и оповещения —
+    по времени сервера (to_wall_clock).
+
+    При детекции по целому кадру AI модель не возвращает рамок, поэтому
+    положительный вердикт трекается как рамка на весь кадр: серия положительных
+    сэмплов дает один трек и одно событие "started" вместо события на каждый сэмпл.
+
+    Args:
+        stream_id: ID стрима
+        payload: Результат детекции ({"type": "smoking_detection", "verdict": ...})
+        boxes: Рамки положительных тайлов в координатах кадра (при тайловой детекции)
+    """
+    await broadcast_to_subscribers(payload, stream_id)
+
+    session = stream_sessions.get(stream_id, {})
+    timestamp = payload.get("timestamp", time.time())
+    stored = to_wall_clock(stream_id, {**payload, "timestamp": timestamp})
+    event_store.append({**stored, "stream_id": stream_id, "lat": session.get("lat"), "lng": session.get("lng")})
+
+    positive = payload.get("verdict") == "Yes"
+    rate_controller.observe_verdict(stream_id, positive, timestamp)
+    if positive:
+        alert_dispatcher.submit(stream_id, stored, session.get("lat"), session.get("lng"))
+    if boxes is None:
+        boxes = [[0.0, 0.0, 1.0, 1.0]] if positive else []
+    tracker = get_stream_tracker(stream_id, "verdict")
+    events = tracker.update(boxes, [1.0] * len(boxes), timestamp)
+    if positive:
+        tracker.mark_verified(timestamp)
+    await publish_track_events(stream_id, events)
+
+def detach_capture_owner(stream_id: str, capture: Optional[SharedCapture]) -> bool:
+    """
+    Отсоединяет закрытую сессию, под ID которой работает общий захват с другими подписчиками.
+
+    Захват учитывается под ID этой сессии (слот губернатора, трекер, метрики, события),
+    а цикл обработки берет из нее координаты, ROI и тайлы. Поэтому сессия остается
+    активной до остановки захвата, но ее клиенты больше не получают кадры и результаты;
+    цикл обработки пометит ее закрытой, когда уйдет последний подписчик.
+
+    Returns:
+        True, если сессия отсоединена; False, если захват остановится вместе с ней
+    """
+    if capture is None or not capture.active or capture.capture_id != stream_id or stream_id not in stream_sessions:
+        return False
+    session = stream_sessions[stream_id]
+    session["closing"] = False
+    session["detached"] = True
+    session["closed_at"] = time.time()
+    logger.info(
+        "Стрим закрыт, его захват продолжает работать для %d подписчиков", len(capture.subscribers),
+        extra={"stream_id": stream_id}
+    )
+    return True
+
+def count_viewers(stream_id: str) -> int:
+    """Количество зрителей стрима: WebSocket клиенты и MJPEG потоки всех сессий его захвата."""
+    return sum(
+        len(manager.active_connections.get(subscriber, [])) + video_viewers.get(subscriber, 0)
+        for subscriber in capture_registry.subscribers(stream_id)
+    )
+
 def get_active_streams() -> List[str]:
     """
     Внутренняя функция для получения списка активных Stream ID.
     Возвращает список Stream ID, которые в данный момент активны.
     """
     active_ids = list(stream_sessions.keys())
-    print(f"get_active_streams вызвана. Найдено {len(active_ids)} стримов: {active_ids}")
+    logger.debug("get_active_streams вызвана. Найдено %d стримов", len(active_ids))
     return active_ids
 
+@router.on_event("shutdown")
+async def close_hls_resolver():
+    await hls_resolver.close()
+
 @router.get(
     "/websocket-info",
     summary="Информация о WebSocket эндпоинте",
@@ -339,19 +529,10 @@ async def list_active_streams():
     """
     Возвращает список всех активных Stream ID.
     """
-    print(f"Запрошен список активных стримов через /stream/list")
-    print(f"Текущее состояние stream_sessions: {stream_sessions}")
-    print(f"ID объекта stream_sessions: {id(stream_sessions)}")
     active_stream_ids = get_active_streams()
-    print(f"Запрошен список активных стримов. Найдено {len(active_stream_ids)} стримов: {active_stream_ids}")
     return {
         "active_streams": active_stream_ids,
-        "count": len(active_stream_ids),
-        "debug": {
-            "stream_sessions_keys": list(stream_sessions.keys()),
-            "stream_sessions_count": len(stream_sessions),
-            "stream_sessions_id": str(id(stream_sessions))
-        }
+        "count": len(active_stream_ids)
     }
 
 @router.get(
@@ -374,11 +555,108 @@ async def get_stream_status(stream_id: str = Path(..., description="ID стри
         "status": session.get("status", "unknown"),
         "live": session.get("live", False),
         "closing": session.get("closing", False),
+        "detached": session.get("detached", False),
         "error": session.get("error"),
         "url": session.get("url"),
         "created_at": session.get("created_at"),
-        "type": session.get("type", "websocket")
+        "type": session.get("type", "websocket"),
+        "decode_mode": session.get("decode_mode"),
+        "roi": session["roi"].polygons if session.get("roi") else None,
+        "detection_rate": rate_controller.report(session.get("capture_id", stream_id)),
+        "queue_position": governor.queue_position(session.get("capture_id", stream_id)),
+        "capture": capture_registry.describe(stream_id)
+    }
+
+@router.get(
+    "/capacity",
+    summary="Загрузка сервера",
+    description="""
+    Возвращает состояние контроля допуска: количество допущенных и ожидающих стримов,
+    загрузку декодированием и занятость слотов детектора по стримам.
+    """,
+    tags=["Streaming"]
+)
+async def get_capacity():
+    """
+    Возвращает состояние губернатора ресурсов.
+    """
+    return governor.report()
+
+def require_capture_owner(stream_id: str):
+    """
+    Отклоняет (409) изменение области интереса подписчиком чужого захвата: детекция
+    общего захвата идет по сессии, которая его открыла, и ROI подписчика изменила
+    бы ее для всех остальных подписчиков источника.
+    """
+    capture_id = stream_sessions[stream_id].get("capture_id")
+    if capture_id is not None and capture_id != stream_id:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stream {stream_id} shares the capture of stream {capture_id}; only that stream can change the ROI",
+        )
+
+@router.put(
+    "/roi/{stream_id}",
+    summary="Установить область интереса стрима",
+    description="""
+    Задает полигоны области интереса (ROI) для стрима.
+
+    В AI модель отправляется только прямоугольник, ограничивающий полигоны,
+    а пиксели вне полигонов зануляются. Это уменьшает время кодирования,
+    размер запроса и ложные срабатывания на небе, дорогах и фасадах.
+
+    **Формат:** координаты точек нормированы к размеру кадра (0..1):
+    ```json
+    {
+        "polygons": [[[0.1, 0.5], [0.9, 0.5], [0.9, 1.0], [0.1, 1.0]]]
     }
+    ```
+
+    Область интереса общего захвата (несколько стримов по одному URL) действует
+    для всех его подписчиков, поэтому менять ее может только стрим, открывший захват.
+
+    **Ошибки:**
+    - `404`: Stream ID не найден
+    - `400`: Неверный формат полигонов
+    - `409`: Стрим подписан на чужой захват источника
+    """,
+    tags=["Streaming"]
+)
+async def set_stream_roi(
+    stream_id: str = Path(..., description="ID стрима"),
+    request: RoiRequest = Body(...)
+):
+    """
+    Устанавливает область интереса стрима.
+    """
+    if stream_id not in stream_sessions:
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+
+    error = validate_polygons(request.polygons)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    require_capture_owner(stream_id)
+
+    stream_sessions[stream_id]["roi"] = RoiMask(request.polygons)
+    logger.info("Установлена область интереса: %d полигонов", len(request.polygons), extra={"stream_id": stream_id})
+    return {"stream_id": stream_id, "roi": request.polygons}
+
+@router.delete(
+    "/roi/{stream_id}",
+    summary="Сбросить область интереса стрима",
+    description="Удаляет ROI стрима: на детекцию снова отправляется кадр целиком.",
+    tags=["Streaming"]
+)
+async def clear_stream_roi(stream_id: str = Path(..., description="ID стрима")):
+    """
+    Сбрасывает область интереса стрима.
+    """
+    if stream_id not in stream_sessions:
+        raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+    require_capture_owner(stream_id)
+
+    stream_sessions[stream_id]["roi"] = None
+    return {"stream_id": stream_id, "roi": None}
 
 @router.post(
     "/detect-smoking",
@@ -431,6 +709,8 @@ async def get_stream_status(stream_id: str = Path(..., description="ID стри
     **Ответ:**
     - `verdict`: "Yes" или "No"
     - `timestamp`: временная метка обработки
+    - `deduplicated`: `true`, если такое же фото уже проверялось текущей конфигурацией детектора
+      и вердикт взят из индекса без вызова AI модели
 
     **Ошибки:**
     - `400`: Неверный формат файла или ошибка обработки
@@ -456,6 +736,17 @@ async def detect_smoking_photo(file: UploadFile = File(..., description="Фот
         if not contents:
             raise HTTPException(status_code=400, detail="Uploaded file is empty")
 
+        # То же фото уже проверялось текущей конфигурацией детектора
+        photo_hash = content_hash(contents)
+        cached = result_index.get("photo", photo_hash, DETECTOR_CONFIG_VERSION)
+        if cached is not None:
+            logger.info("Фото уже проверялось, вердикт из индекса: %s", cached["verdict"])
+            return {
+                "verdict": cached["verdict"],
+                "timestamp": time.time(),
+                "deduplicated": True
+            }
+
         # Декодируем изображение с помощью OpenCV
         np_arr = np.frombuffer(contents, np.uint8)
         img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
@@ -468,7 +759,7 @@ async def detect_smoking_photo(file: UploadFile = File(..., description="Фот
         b64_image = base64.b64encode(buffer).decode('utf-8')
 
         # Вызываем функцию детекции курения
-        print(f"Отправка фото для детекции курения (размер: {len(contents)} байт)")
+        logger.info("Отправка фото для детекции курения (размер: %d байт)", len(contents))
         verdict_raw = detect_smoking(b64_image)
 
         if verdict_raw is None:
@@ -477,16 +768,10 @@ async def detect_smoking_photo(file: UploadFile = File(..., description="Фот
         timestamp = time.time()
 
         # Нормализуем ответ: если в ответе есть "yes" -> "Yes", если "no" -> "No"
-        verdict_lower = verdict_raw.strip().lower()
-        if "yes" in verdict_lower:
-            verdict = "Yes"
-        elif "no" in verdict_lower:
-            verdict = "No"
-        else:
-            # Если не нашли ни yes, ни no - возвращаем оригинальный ответ
-            verdict = verdict_raw.strip()
+        verdict = normalize_verdict(verdict_raw)
 
-        print(f"Детекция завершена. Исходный ответ: '{verdict_raw}' -> Нормализованный: '{verdict}'")
+        logger.info("Детекция завершена. Исходный ответ: %r -> Нормализованный: %r", verdict_raw, verdict)
+        result_index.put("photo", photo_hash, DETECTOR_CONFIG_VERSION, verdict, size=len(contents))
 
         return {
             "verdict": verdict,
@@ -496,43 +781,168 @@ async def detect_smoking_photo(file: UploadFile = File(..., description="Фот
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Ошибка при обработке фото: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка при обработке фото: %s", e)
         raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
 
-async def process_video_stream_from_url(stream_id: str, url: str, detection_interval: int = 5):
+
+@router.post(
+    "/detect-smoking/batch",
+    summary="Пакетная детекция курения на фото",
+    description="""
+    Проверяет множество фото за один запрос: несколько файлов и/или архивы ZIP и tar (.tar, .tar.gz, .tgz).
+
+    **Формат:**
+    multipart/form-data, поле `files` повторяется для каждого файла. Архивы распознаются по расширению
+    или Content-Type, их элементы проверяются по одному.
+
+    **Что происходит:**
+    1. Файлы и элементы архивов читаются последовательно, очередь перед детектором ограничена
+    2. Фото декодируются и кодируются в PNG в пуле потоков
+    3. К AI модели одновременно выполняется не более `concurrency` запросов; они получают слот детектора
+       после стримов и расходуют только не занятую стримами часть бюджета `DETECTOR_BUDGET_PER_MINUTE`
+    4. Фото, уже проверенные текущей конфигурацией детектора, берутся из индекса результатов
+
+    **Ответ:** `application/x-ndjson`, по строке JSON на фото в порядке готовности:
+    - `{"index": 0, "name": "a.jpg", "verdict": "Yes", "deduplicated": false, "timestamp": ...}`
+    - `{"index": 1, "name": "photos.zip/b.png", "error": "Invalid image format"}`
+
+    Последняя строка — итог: `{"summary": {"total", "yes", "no", "deduplicated", "errors", "elapsed"}}`.
+
+    **Пример использования (cURL):**
+    ```bash
+    curl -N -X POST "http://localhost:8000/stream/detect-smoking/batch" \
+         -F "files=@photos.zip" -F "files=@extra.jpg"
+    ```
+
+    **Пример использования (Python):**
+    ```python
+    import json
+    import requests
+
+    with open("photos.zip", "rb") as f:
+        response = requests.post("http://localhost:8000/stream/detect-smoking/batch",
+                                 files=[("files", f)], stream=True)
+        for line in response.iter_lines():
+            print(json.loads(line))
+    ```
+    """,
+    tags=["Smoking Detection"]
+)
+async def detect_smoking_batch(
+    files: List[UploadFile] = File(..., description="Фото (JPEG, PNG) и/или архивы ZIP/tar с фото"),
+    concurrency: int = Query(BATCH_CONCURRENCY, description="Одновременных вызовов AI модели", ge=1, le=64)
+):
+    """
+    Определяет курение на множестве фото, отдавая результаты потоком NDJSON.
+
+    Args:
+        files: Загруженные фото и архивы
+        concurrency: Число одновременных вызовов детектора
+
+    Returns:
+        StreamingResponse с NDJSON результатами
+    """
+    async def generate():
+        async for result in run_batch(files, concurrency):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# Обработка кадров файла в пуле потоков: каждая функция возвращает и время CPU
+# своего потока, которое учитывается в загрузке стрима губернатором
+
+def read_frame_timed(cap) -> Tuple[bool, Optional[np.ndarray], float]:
+    """cap.read() и время CPU потока на чтение."""
+    started = time.thread_time()
+    ret, frame = cap.read()
+    return ret, frame, time.thread_time() - started
+
+def run_timed(func, *args) -> float:
+    """Вызывает func(*args) и возвращает время CPU потока на вызов."""
+    started = time.thread_time()
+    func(*args)
+    return time.thread_time() - started
+
+def encode_jpeg_timed(frame: np.ndarray) -> Tuple[np.ndarray, float]:
+    """JPEG кадра для MJPEG потока и время CPU потока на кодирование."""
+    started = time.thread_time()
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return buffer, time.thread_time() - started
+
+async def process_video_stream_from_url(stream_id: str, url: str, detection_interval: int = 5, capture: Optional[SharedCapture] = None,
+                                        decode_mode: str = "full", clock_mode: str = "auto"):
     """
     Фоновая задача для обработки видео потока с URL.
 
+    Кадры и результаты детекции раздаются всем сессиям, подписанным на захват;
+    обработка продолжается, пока у захвата есть подписчики.
+
     Args:
-        stream_id: ID стрима
+        stream_id: ID стрима (ID захвата)
         url: URL видео потока
-        detection_interval: Интервал детекции курения в секундах
+        detection_interval: Базовый интервал детекции курения в секундах
+        capture: Общий захват источника (создается, если не передан)
+        decode_mode: "full" — каждый кадр декодируется и записывается в файл;
+            "sparse" — без записи, кадр декодируется полностью только для MJPEG зрителей,
+            детекции и оценки движения (services/sparse_decode.py)
+        clock_mode: Часы интервала детекции (services/source_clock.py): для файлов и VOD
+            время берется из источника, кадры читаются без ожидания реального времени,
+            детекция выполняется каждые detection_interval секунд видео
     """
-    print(f"[{stream_id}] Запуск обработки видео потока с URL: {url}")
+    if capture is None:
+        capture = capture_registry.acquire(url, stream_id)
+    logger.info("Запуск обработки видео потока с URL: %s", url, extra={"stream_id": stream_id})
+    detection_interval = detection_interval or DEFAULT_DETECTION_INTERVAL
+    # Сэмпл тайловой детекции стоит rows * cols вызовов AI модели
+    tile_grid = stream_sessions.get(stream_id, {}).get("tile_grid")
+    rate_controller.register(stream_id, detection_interval, tile_grid[0] * tile_grid[1] if tile_grid else 1)
 
     cap = None
     video_writer = None
     video_path = None
-    last_detection_time = 0
+    clock = None
+    last_frame_time = None
     frame_count = 0
     actual_url = url
+    sparse = decode_mode == "sparse"
+    open_capture = SparseCapture if sparse else cv2.VideoCapture
 
     try:
+        # Если сервер загружен, стрим ждет в очереди допуска
+        while not governor.is_admitted(stream_id):
+            if stream_id not in governor.streams or not capture.active:
+                logger.info("Стрим закрыт до допуска к обработке", extra={"stream_id": stream_id})
+                return
+            capture_registry.set_status(capture, "queued", stream_sessions)
+            try:
+                await asyncio.wait_for(governor.wait_admitted(stream_id), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+        capture_registry.set_status(capture, "initializing", stream_sessions)
+
         # Если это blob: или веб-страница, пытаемся извлечь реальный HLS URL
+        page_url = None
         if url.startswith('blob:') or (url.startswith('http') and not url.endswith(('.m3u8', '.ts', '.mp4', '.avi', '.mov'))):
-            print(f"[{stream_id}] Обнаружен веб-страничный URL, пытаемся извлечь HLS URL")
+            logger.info("Обнаружен веб-страничный URL, пытаемся извлечь HLS URL", extra={"stream_id": stream_id})
             # Убираем blob: префикс если есть
             page_url = url.replace('blob:', '') if url.startswith('blob:') else url
-            extracted_url = await asyncio.to_thread(extract_hls_url_from_page, page_url)
+            extracted_url = await hls_resolver.resolve(page_url)
             if extracted_url:
                 actual_url = extracted_url
-            print(f"[{stream_id}] Используем URL: {actual_url}")
+            logger.info("Используем URL: %s", actual_url, extra={"stream_id": stream_id})
 
         # Открываем видео поток
-        print(f"[{stream_id}] Попытка открыть видео поток через OpenCV")
-        cap = cv2.VideoCapture(actual_url)
+        logger.debug("Попытка открыть видео поток (режим декодирования %s)", decode_mode, extra={"stream_id": stream_id})
+        cap = open_capture(actual_url)
+
+        # Закэшированный URL плейлиста мог устареть (например, истек токен): получаем его заново
+        if not cap.isOpened() and page_url is not None and actual_url != url:
+            refreshed_url = await hls_resolver.resolve(page_url, force=True)
+            if refreshed_url and refreshed_url != actual_url:
+                logger.info("Плейлист не открылся, используем обновленный URL: %s", refreshed_url, extra={"stream_id": stream_id})
+                cap.release()
+                actual_url = refreshed_url
+                cap = open_capture(actual_url)
 
         if not cap.isOpened():
             error_msg = (
@@ -549,16 +959,12 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
                 f"- Copy the real HLS URL and use it\n"
                 f"- See HOW_TO_FIND_STREAM_URL.md for detailed instructions"
             )
-            print(f"[{stream_id}] ❌ Ошибка: не удалось открыть видео поток")
-            print(f"[{stream_id}] Использован URL: {actual_url}")
-            print(f"[{stream_id}] ")
-            print(f"[{stream_id}] 💡 Для сайтов типа sochi.camera:")
-            print(f"[{stream_id}]    1. Откройте DevTools (F12)")
-            print(f"[{stream_id}]    2. Network → Фильтр 'm3u8'")
-            print(f"[{stream_id}]    3. Найдите и скопируйте .m3u8 URL")
-            print(f"[{stream_id}]    4. См. HOW_TO_FIND_STREAM_URL.md")
-            stream_sessions[stream_id]["status"] = "error"
-            stream_sessions[stream_id]["error"] = error_msg
+            logger.error(
+                "❌ Не удалось открыть видео поток: %s. Для сайтов типа sochi.camera найдите .m3u8 URL "
+                "в DevTools (F12) → Network → фильтр 'm3u8', см. HOW_TO_FIND_STREAM_URL.md",
+                actual_url, extra={"stream_id": stream_id}
+            )
+            capture_registry.set_status(capture, "error", stream_sessions, error_msg)
 
             # Отправляем сообщение об ошибке через WebSocket
             error_payload = {
@@ -568,28 +974,36 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
                 "timestamp": time.time()
             }
             try:
-                await manager.broadcast_json(error_payload, stream_id)
+                await broadcast_to_subscribers(error_payload, stream_id)
             except:
                 pass
 
             return
 
-        print(f"[{stream_id}] Видео поток успешно открыт")
-        stream_sessions[stream_id]["status"] = "streaming"
+        logger.info("Видео поток успешно открыт", extra={"stream_id": stream_id})
+        capture_registry.set_status(capture, "streaming", stream_sessions)
 
         # Получаем параметры видео
         fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-        print(f"[{stream_id}] Параметры потока: {width}x{height} @ {fps} FPS")
+        clock = SourceClock.open(cap, actual_url, fps, clock_mode)
+        capture.clock = clock.mode
+        if clock.source_time:
+            source_clock_origins[stream_id] = clock.started
+        logger.info("Параметры потока: %dx%d @ %s FPS, часы: %s", width, height, fps, clock.mode, extra={"stream_id": stream_id})
 
-        # Подготавливаем видеописатель для сохранения
-        stream_folder = "stream"
-        os.makedirs(stream_folder, exist_ok=True)
-        video_path = os.path.join(stream_folder, f"{stream_id}.mp4")
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        video_writer = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
+        # Подготавливаем видеописатель для сохранения. В разреженном режиме кадры
+        # декодируются не все, поэтому стрим не записывается
+        if sparse:
+            logger.info("Разреженное декодирование (%s), запись стрима отключена", SPARSE_DECODE_BACKEND, extra={"stream_id": stream_id})
+        else:
+            stream_folder = "stream"
+            os.makedirs(stream_folder, exist_ok=True)
+            video_path = os.path.join(stream_folder, f"{stream_id}.mp4")
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            video_writer = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
         stream_sessions[stream_id]["video_writer"] = video_writer
         stream_sessions[stream_id]["video_path"] = video_path
 
@@ -603,7 +1017,7 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
         # Запускаем фоновую задачу для отправки результатов в порядке очереди
         async def send_ordered_results():
             """Отправляет результаты детекции строго по порядку номеров кадров."""
-            while stream_sessions.get(stream_id, {}).get("live", False):
+            while capture.active:
                 queue_data = detection_queues.get(stream_id)
                 if not queue_data:
                     await asyncio.sleep(0.1)
@@ -617,8 +1031,8 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
                         payload = queue_data['results'].pop(next_frame_num)
 
                         # Отправляем результат
-                        await manager.broadcast_json(payload, stream_id)
-                        print(f"[{stream_id}] 📤 Отправлен результат для кадра #{next_frame_num}: {payload['verdict']}")
+                        await broadcast_to_subscribers(payload, stream_id)
+                        logger.debug("📤 Отправлен результат для кадра #%d: %s", next_frame_num, payload["verdict"], extra={"stream_id": stream_id})
 
                         # Переходим к следующему кадру
                         queue_data['next_frame'] += 1
@@ -631,66 +1045,187 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
         # Запускаем задачу отправки результатов
         send_task = asyncio.create_task(send_ordered_results())
 
-        # Основной цикл обработки кадров
-        while stream_sessions.get(stream_id, {}).get("live", False):
-            ret, frame = cap.read()
+        # Файл или VOD читается без ожидания реального времени, детекция идет каждые
+        # detection_interval секунд видео. Чтение не уходит дальше чем на
+        # SOURCE_MAX_PENDING_DETECTIONS детекций вперед
+        source_time = clock.source_time
+        detection_slots = asyncio.Semaphore(SOURCE_MAX_PENDING_DETECTIONS) if source_time else None
+        next_detection_at = clock.started
+        end_of_source = False
+
+        # Основной цикл обработки кадров: пока на захват подписана хотя бы одна сессия
+        while capture.active:
+            if source_time and not count_viewers(stream_id):
+                # Без зрителей файл не читается, иначе он закончится до подключения клиентов
+                await asyncio.sleep(0.1)
+                continue
+
+            if sparse:
+                # Кадр декодируется полностью, только если его смотрят по MJPEG,
+                # пора отправлять его на детекцию или оценивать движение
+                has_websocket_clients = any(manager.active_connections.get(subscriber) for subscriber in capture.subscribers)
+                has_mjpeg_viewers = any(video_viewers.get(subscriber) for subscriber in capture.subscribers)
+                if source_time:
+                    # Время кадра известно только после чтения: с PyAV читаются одни ключевые
+                    # кадры, и следующий кадр может оказаться на секунды дальше предсказанного
+                    detection_at = next_detection_at
+                    need_frame = lambda position: (
+                        has_mjpeg_viewers or (has_websocket_clients and clock.started + position >= detection_at)
+                    )
+                else:
+                    now = time.time()
+                    need_frame = (
+                        has_mjpeg_viewers
+                        or rate_controller.needs_motion_sample(stream_id, now)
+                        or (has_websocket_clients and rate_controller.is_detection_due(stream_id, now))
+                    )
+                # Чтение ключевого кадра живого источника может ждать секунды, поэтому в отдельном потоке
+                with metrics.stage("decode", stream_id, frame_count + 1):
+                    ret, frame, decode_cpu = await asyncio.to_thread(cap.read, need_frame)
+                # Время CPU потока event loop на запись и кодирование кадра (без ожиданий,
+                # во время которых поток выполняет другие корутины)
+                frame_started = time.thread_time()
+            elif source_time:
+                # Файл декодируется без ожидания реального времени: в отдельном потоке,
+                # чтобы чтение подряд не занимало event loop других стримов и запросов
+                with metrics.stage("decode", stream_id, frame_count + 1):
+                    ret, frame, decode_cpu = await asyncio.to_thread(read_frame_timed, cap)
+                frame_started = time.thread_time()
+            else:
+                # Время CPU потока event loop на декодирование, запись и кодирование кадра
+                frame_started = time.thread_time()
+                with metrics.stage("decode", stream_id, frame_count + 1):
+                    ret, frame = cap.read()
+                decode_cpu = 0.0
 
             if not ret:
-                print(f"[{stream_id}] Не удалось прочитать кадр, завершаем обработку")
+                if source_time:
+                    logger.info("Источник прочитан до конца (%.1f с видео)", clock.position, extra={"stream_id": stream_id})
+                    end_of_source = True
+                    break
+                logger.info("Не удалось прочитать кадр, завершаем обработку", extra={"stream_id": stream_id})
+                metrics.record_drop(stream_id, "read_error")
                 break
 
             frame_count += 1
             current_time = time.time()
+            frame_time = clock.tick()
+            if source_time:
+                last_frame_time = frame_time
+            metrics.record_frame(stream_id, current_time)
+
+            if frame is None:
+                # Кадр пропущен без преобразования (разреженный режим)
+                governor.record_load(stream_id, decode_cpu, current_time)
+                continue
 
-            # Сохраняем кадр в видеофайл
+            # Сохраняем кадр в видеофайл. Файл читается без пауз реального времени,
+            # поэтому его запись и кодирование кадра тоже выполняются в отдельном потоке
             if video_writer is not None:
-                video_writer.write(frame)
+                with metrics.stage("write", stream_id, frame_count):
+                    if source_time:
+                        decode_cpu += await asyncio.to_thread(run_timed, video_writer.write, frame)
+                    else:
+                        video_writer.write(frame)
 
             # Сохраняем последний кадр для MJPEG потока
             try:
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                last_frames[stream_id] = buffer.tobytes()
+                with metrics.stage("jpeg_encode", stream_id, frame_count):
+                    if source_time:
+                        buffer, encode_cpu = await asyncio.to_thread(encode_jpeg_timed, frame)
+                        decode_cpu += encode_cpu
+                    else:
+                        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                frame_bytes = buffer.tobytes()
+                for subscriber in capture.subscribers:
+                    last_frames[subscriber] = frame_bytes
             except Exception as e:
-                print(f"[{stream_id}] Ошибка при сохранении кадра для MJPEG: {e}")
+                logger.warning("Ошибка при сохранении кадра для MJPEG: %s", e, extra={"stream_id": stream_id, "rate_limit": 5.0})
+                metrics.record_drop(stream_id, "jpeg_error")
+            governor.record_load(stream_id, time.thread_time() - frame_started + decode_cpu, current_time)
+
+            # Детекция курения ТОЛЬКО если есть подключенные WebSocket клиенты.
+            # Интервал детекции подстраивается под движение, детекции и зрителей стрима
+            # Для файлов интервал фиксирован во времени видео и не зависит от нагрузки
+            has_websocket_clients = any(manager.active_connections.get(subscriber) for subscriber in capture.subscribers)
+            if source_time:
+                detection_due = has_websocket_clients and frame_time >= next_detection_at
+                if detection_due:
+                    next_detection_at = frame_time + detection_interval
+            else:
+                rate_controller.set_viewers(stream_id, count_viewers(stream_id))
+                rate_controller.observe_frame(stream_id, frame, current_time)
+                detection_due = has_websocket_clients
 
-            # Детекция курения ТОЛЬКО если есть подключенные WebSocket клиенты
-            has_websocket_clients = stream_id in manager.active_connections and len(manager.active_connections[stream_id]) > 0
+            if (detection_due
+                    and needs_verification(stream_id, frame_time)
+                    and (source_time or rate_controller.should_detect(stream_id, current_time))):
 
-            if has_websocket_clients and (current_time - last_detection_time >= detection_interval):
-                last_detection_time = current_time
+                if source_time:
+                    # Интервал файла отсчитывается по времени видео, поэтому сэмпл
+                    # ждет, пока глобальный бюджет вызовов AI модели его допустит
+                    while capture.active and not rate_controller.try_background_call(time.time(), stream_id):
+                        await asyncio.sleep(BUDGET_POLL_INTERVAL)
 
                 # Сохраняем номер кадра и время ПЕРЕД запуском детекции
                 detection_frame_number = frame_count
-                detection_timestamp = current_time
-
-                # Копируем кадр для безопасности (чтобы он не изменился во время обработки)
-                frame_copy = frame.copy()
+                detection_timestamp = frame_time
+
+                # Копируем кадр для безопасности (чтобы он не изменился во время обработки).
+                # Если задана область интереса, копируется только она
+                roi = stream_sessions.get(stream_id, {}).get("roi")
+                with metrics.stage("preprocess", stream_id, frame_count):
+                    if roi is not None:
+                        frame_copy, roi_offset = roi.apply(frame)
+                    else:
+                        frame_copy, roi_offset = frame.copy(), (0, 0)
 
                 # Запускаем детекцию в фоновой задаче (полностью асинхронно)
-                async def run_detection(frame_num: int, timestamp: float, frame_data):
+                async def run_detection(frame_num: int, timestamp: float, frame_data, offset):
                     try:
                         client_count = len(manager.active_connections.get(stream_id, []))
-                        print(f"[{stream_id}] 🔍 Запуск детекции для кадра #{frame_num} ({client_count} клиентов)")
+                        logger.debug("🔍 Запуск детекции для кадра #%d (%d клиентов)", frame_num, client_count, extra={"stream_id": stream_id})
+
+                        # Тайловая детекция: все тайлы кадра отправляются одной пачкой,
+                        # каждый тайл занимает свой слот детектора
+                        session = stream_sessions.get(stream_id, {})
+                        if session.get("tile_grid"):
+                            rows, cols = session["tile_grid"]
+                            with metrics.stage("detector", stream_id, frame_num):
+                                verdict, boxes = await detect_smoking_tiled(frame_data, rows, cols, session["tile_overlap"], stream_id)
+                            if verdict is None:
+                                # AI модель не ответила для части тайлов: как и без тайлов, результата нет
+                                return
+                            # Переводим рамки из координат области интереса в координаты кадра
+                            boxes = [[x1 + offset[0], y1 + offset[1], x2 + offset[0], y2 + offset[1]] for x1, y1, x2, y2 in boxes]
+                            payload = {
+                                "type": "smoking_detection",
+                                "timestamp": timestamp,
+                                "verdict": verdict,
+                                "frame_number": frame_num,
+                                "boxes": boxes
+                            }
+                            if source_time:
+                                payload["media_time"] = clock.media_time(timestamp)
+                            await publish_detection(stream_id, payload, boxes=boxes)
+                            logger.info("✅ Результат тайловой детекции: %s, рамок: %d (кадр #%d)", verdict, len(boxes), frame_num, extra={"stream_id": stream_id})
+                            return
 
                         # Кодируем кадр в отдельном потоке (не блокирует event loop)
                         def encode_frame():
-                            _, buffer = cv2.imencode('.png', frame_data)
-                            return base64.b64encode(buffer).decode('utf-8')
+                            with metrics.stage("preprocess", stream_id, frame_num):
+                                _, buffer = cv2.imencode('.png', frame_data)
+                                return base64.b64encode(buffer).decode('utf-8')
 
                         b64_image = await asyncio.to_thread(encode_frame)
 
-                        # Вызываем детекцию в отдельном потоке
-                        verdict_raw = await asyncio.to_thread(detect_smoking, b64_image)
+                        # Вызываем детекцию в отдельном потоке, дождавшись своей очереди к детектору
+                        async with governor.detector_slot(stream_id):
+                            with metrics.stage("detector", stream_id, frame_num):
+                                verdict_raw = await asyncio.to_thread(detect_smoking, b64_image)
 
                         if verdict_raw is not None:
-                            # Нормализуем ответ
-                            verdict_lower = verdict_raw.strip().lower()
-                            if "yes" in verdict_lower:
-                                verdict = "Yes"
-                            elif "no" in verdict_lower:
-                                verdict = "No"
-                            else:
-                                verdict = verdict_raw.strip()
+                            verdict = normalize_verdict(verdict_raw)
 
                             # Отправляем результат через WebSocket
                             payload = {
@@ -699,47 +1234,71 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
                                 "verdict": verdict,
                                 "frame_number": frame_num
                             }
-                            await manager.broadcast_json(payload, stream_id)
-                            print(f"[{stream_id}] ✅ Результат детекции: {verdict} (кадр #{frame_num})")
+                            if source_time:
+                                payload["media_time"] = clock.media_time(timestamp)
+                            await publish_detection(stream_id, payload)
+                            logger.info("✅ Результат детекции: %s (кадр #%d)", verdict, frame_num, extra={"stream_id": stream_id})
 
                     except Exception as e:
-                        print(f"[{stream_id}] ❌ Ошибка при детекции курения: {e}")
+                        logger.warning("❌ Ошибка при детекции курения: %s", e, extra={"stream_id": stream_id, "rate_limit": 5.0})
+                        metrics.record_drop(stream_id, "detector_error")
+                    finally:
+                        if detection_slots is not None:
+                            detection_slots.release()
 
                 # Запускаем детекцию в фоне (fire-and-forget)
-                asyncio.create_task(run_detection(detection_frame_number, detection_timestamp, frame_copy))
-
-            # Минимальная задержка для снижения нагрузки на CPU
-            # Не блокируем слишком долго, чтобы видео было плавным
-            await asyncio.sleep(0.001)  # 1ms задержка для переключения контекста
-
-            # Проверяем, не закрывается ли стрим
-            if stream_sessions.get(stream_id, {}).get("closing", False):
-                print(f"[{stream_id}] Стрим закрывается")
-                break
+                if detection_slots is not None:
+                    await detection_slots.acquire()
+                asyncio.create_task(run_detection(detection_frame_number, detection_timestamp, frame_copy, roi_offset))
+
+            if source_time:
+                # Кадры до следующей точки сэмплирования никому не нужны: переходим к ней
+                if video_writer is None and not any(video_viewers.get(subscriber) for subscriber in capture.subscribers):
+                    clock.seek(next_detection_at)
+                await asyncio.sleep(0)
+            else:
+                # Минимальная задержка для снижения нагрузки на CPU
+                # Не блокируем слишком долго, чтобы видео было плавным
+                await asyncio.sleep(0.001)  # 1ms задержка для переключения контекста
+
+        if end_of_source:
+            # Дожидаемся детекций последних кадров, чтобы клиенты получили все результаты
+            for _ in range(SOURCE_MAX_PENDING_DETECTIONS):
+                await detection_slots.acquire()
+            await broadcast_to_subscribers({
+                "type": "end_of_stream",
+                "frames": frame_count,
+                "media_time": round(clock.position, 3),
+                "timestamp": time.time()
+            }, stream_id)
 
-        print(f"[{stream_id}] Обработка завершена. Всего обработано кадров: {frame_count}")
+        logger.info("Обработка завершена. Всего обработано кадров: %d", frame_count, extra={"stream_id": stream_id})
 
     except Exception as e:
-        print(f"[{stream_id}] Критическая ошибка при обработке потока: {e}")
-        import traceback
-        traceback.print_exc()
-        stream_sessions[stream_id]["status"] = "error"
-        stream_sessions[stream_id]["error"] = str(e)
+        logger.exception("Критическая ошибка при обработке потока: %s", e, extra={"stream_id": stream_id})
+        capture_registry.set_status(capture, "error", stream_sessions, str(e))
 
     finally:
         # Освобождаем ресурсы
         if cap is not None:
             cap.release()
-            print(f"[{stream_id}] VideoCapture освобожден")
+            logger.debug("VideoCapture освобожден", extra={"stream_id": stream_id})
 
         if video_writer is not None:
             video_writer.release()
-            print(f"[{stream_id}] VideoWriter освобожден, видео сохранено: {video_path}")
+            logger.info("VideoWriter освобожден, видео сохранено: %s", video_path, extra={"stream_id": stream_id})
 
-        # Обновляем статус
-        if stream_id in stream_sessions:
-            stream_sessions[stream_id]["live"] = False
-            stream_sessions[stream_id]["status"] = "stopped"
+        # Обновляем статус захвата и всех подписанных на него сессий
+        for subscriber in [stream_id] + capture_registry.close(capture):
+            if subscriber in stream_sessions:
+                stream_sessions[subscriber]["live"] = False
+                stream_sessions[subscriber]["status"] = "stopped"
+
+        await close_stream_tracker(stream_id, last_frame_time)
+        source_clock_origins.pop(stream_id, None)
+        rate_controller.unregister(stream_id)
+        governor.release(stream_id)
+        metrics.remove_stream(stream_id)
 
 @router.post(
     "/open-stream-url",
@@ -785,12 +1344,56 @@ async def process_video_stream_from_url(stream_id: str, url: str, detection_inte
     3. Видео сохраняется в файл для последующего просмотра
     4. Последний кадр постоянно обновляется и доступен через MJPEG поток
 
+    **Повторное открытие того же источника:**
+    - Если URL (после нормализации) уже открыт другим стримом, новый стрим получает свой `stream_id`,
+      но подписывается на существующий захват (`capture_id` в ответе): декодирование, запись,
+      детекция и MJPEG кадр выполняются один раз и раздаются всем подписчикам
+    - Настройки детекции (интервал, тайлы, координаты, режим декодирования) берутся у стрима, открывшего захват;
+      ROI, заданная любому подписчику, действует для всего захвата
+    - Захват останавливается, когда закрывается последний подписанный стрим
+
     **Детекция курения:**
     - Детекция курения НЕ запускается автоматически
     - Она активируется ТОЛЬКО при подключении к WebSocket
-    - Каждые N секунд (по умолчанию 5) кадр отправляется на детекцию
+    - Кадр отправляется на детекцию примерно раз в `detection_interval` секунд (по умолчанию 5):
+      интервал сокращается при движении в кадре, недавних детекциях и большом числе зрителей,
+      растет на статичной сцене и ограничен общим бюджетом вызовов AI модели
+      (`DETECTOR_BUDGET_PER_MINUTE`); текущий интервал — в `detection_rate` у `/stream/status/{stream_id}`
     - Результаты передаются через WebSocket всем подключенным клиентам
     - Это экономит ресурсы AI - детекция работает только когда нужна
+    - Положительные вердикты объединяются в треки: на каждый эпизод курения приходит одно
+      сообщение `{"type": "smoking_event", "event": "started", "track_id": ...}` и одно `"ended"`
+    - Пока трек подтвержден и недавно проверен, кадры повторно в AI модель не отправляются
+
+    **Разреженное декодирование (`decode_mode: "sparse"`):**
+    - Для стримов только с детекцией: кадры демультиплексируются, но полностью декодируются
+      лишь для MJPEG зрителей, очередной детекции и оценки движения
+    - С PyAV (`av` из requirements.txt) декодируются только ключевые кадры. Без него OpenCV
+      декодирует каждый кадр (grab) и пропускает только преобразование в BGR, поэтому CPU
+      экономится в основном за счет отключенной записи и кодирования JPEG
+    - Стрим в этом режиме не записывается в файл
+
+    **Файлы и VOD (`clock`):**
+    - Для локальных файлов и VOD (.mp4 и т.п. по HTTP) при `clock: "auto"` интервал детекции отсчитывается
+      по времени кадров источника (PTS), а не по часам сервера: файл читается быстрее реального времени,
+      детекция выполняется каждые `detection_interval` секунд видео
+    - Чтение начинается, когда к стриму подключен хотя бы один клиент, и не уходит дальше чем на
+      `SOURCE_MAX_PENDING_DETECTIONS` незавершенных детекций
+    - При `decode_mode: "sparse"` и без MJPEG зрителей источник переходит от одной точки сэмплирования к следующей
+    - В результатах есть `media_time` — время кадра в видео, по окончании файла приходит
+      `{"type": "end_of_stream", "frames": ..., "media_time": ...}`
+    - `clock: "source"` включает этот режим принудительно (например, для VOD плейлиста .m3u8),
+      `clock: "wall"` — отключает; живые источники (RTSP, HLS) работают в реальном времени
+
+    **Тайловая детекция (для широких кадров городских камер):**
+    - `tile_grid: [rows, cols]` режет кадр на сетку тайлов с перекрытием `tile_overlap`
+    - Все тайлы отправляются на детекцию одной пачкой
+    - В результате приходят рамки положительных тайлов (`boxes`) в координатах кадра
+
+    **Область интереса (ROI):**
+    - `roi` — полигоны в нормированных координатах кадра, в AI модель попадают только их пиксели
+    - Можно изменить позже через `PUT /stream/roi/{stream_id}`
+    - Если источник уже открыт другим стримом, ROI задает только он: запрос с `roi` получает `409`
 
     **Пример использования (Python):**
     ```python
@@ -856,10 +1459,37 @@ async def open_stream_from_url(request: StreamUrlRequest = Body(...)):
     Returns:
         dict: Информация о созданном стриме
     """
-    try:
-        # Генерируем уникальный ID для стрима
-        stream_id = str(uuid.uuid4())
+    if request.tile_grid is not None and not all(1 <= n <= 8 for n in request.tile_grid):
+        raise HTTPException(status_code=400, detail="tile_grid values must be between 1 and 8")
+    if request.roi is not None:
+        roi_error = validate_polygons(request.roi)
+        if roi_error:
+            raise HTTPException(status_code=400, detail=roi_error)
+
+    # Генерируем уникальный ID для стрима. Если этот источник уже открыт, стрим
+    # подписывается на существующий захват и не занимает новых ресурсов
+    stream_id = str(uuid.uuid4())
+    capture = capture_registry.acquire(request.url, stream_id)
+    shared = capture.capture_id != stream_id
+    if shared and request.roi is not None:
+        # Детекция общего захвата идет по области интереса стрима, который его открыл
+        capture_registry.release(stream_id)
+        raise HTTPException(
+            status_code=409,
+            detail=f"Source is already open as stream {capture.capture_id}; its ROI applies to all subscribers",
+        )
+    if shared:
+        admitted = True
+        status = capture.status
+    else:
+        try:
+            admitted = governor.admit(stream_id, request.priority, allow_queue=True)
+        except CapacityError as e:
+            capture_registry.release(stream_id)
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+        status = capture.status = "initializing" if admitted else "queued"
 
+    try:
         # Создаем сессию стрима
         stream_sessions[stream_id] = {
             "live": True,
@@ -867,34 +1497,55 @@ async def open_stream_from_url(request: StreamUrlRequest = Body(...)):
             "created_at": time.time(),
             "url": request.url,
             "detection_interval": request.detection_interval,
-            "status": "initializing",
-            "type": "url_stream"
+            "lat": request.lat,
+            "lng": request.lng,
+            "tile_grid": request.tile_grid,
+            "tile_overlap": request.tile_overlap,
+            "roi": RoiMask(request.roi) if request.roi else None,
+            "status": status,
+            "type": "url_stream",
+            "capture_id": capture.capture_id,
+            "decode_mode": request.decode_mode
         }
 
-        print(f"Создан новый стрим по URL: {stream_id}")
-        print(f"URL: {request.url}")
-        print(f"Интервал детекции: {request.detection_interval} сек")
-
-        # Запускаем фоновую задачу для обработки потока
-        asyncio.create_task(process_video_stream_from_url(
-            stream_id,
-            request.url,
-            request.detection_interval
-        ))
+        if shared:
+            logger.info(
+                "Стрим подписан на захват %s того же источника (подписчиков: %d)",
+                capture.capture_id, len(capture.subscribers), extra={"stream_id": stream_id}
+            )
+        else:
+            logger.info("Создан новый стрим по URL: %s, интервал детекции: %s сек", request.url, request.detection_interval, extra={"stream_id": stream_id})
+
+            # Запускаем фоновую задачу для обработки потока
+            asyncio.create_task(process_video_stream_from_url(
+                stream_id,
+                request.url,
+                request.detection_interval,
+                capture,
+                request.decode_mode,
+                request.clock
+            ))
 
         return {
             "stream_id": stream_id,
             "url": request.url,
-            "status": "initializing",
+            "status": status,
             "websocket_url": f"/ws/stream/{stream_id}",
             "video_url": f"/stream/video/{stream_id}",
-            "message": "Stream is being initialized. Connect to WebSocket to receive detection results."
+            "capture_id": capture.capture_id,
+            "message": (
+                f"Stream shares the capture of stream {capture.capture_id} opened for the same source."
+                if shared else
+                "Stream is being initialized. Connect to WebSocket to receive detection results."
+                if admitted else
+                f"Server is at capacity, stream is queued at position {governor.queue_position(stream_id)}."
+            )
         }
 
     except Exception as e:
-        print(f"Ошибка при открытии стрима по URL: {e}")
-        import traceback
-        traceback.print_exc()
+        capture_registry.release(stream_id)
+        governor.release(stream_id)
+        logger.exception("Ошибка при открытии стрима по URL: %s", e)
         raise HTTPException(status_code=400, detail=f"Failed to open stream: {str(e)}")
 
 @router.post(
@@ -926,26 +1577,41 @@ async def open_stream_from_url(request: StreamUrlRequest = Body(...)):
     """,
     tags=["Streaming"]
 )
-async def request_stream_token():
+async def request_stream_token(
+    lat: Optional[float] = Query(None, description="Широта камеры (для тепловой карты)", ge=-90.0, le=90.0),
+    lng: Optional[float] = Query(None, description="Долгота камеры (для тепловой карты)", ge=-180.0, le=180.0),
+    detection_interval: float = Query(DEFAULT_DETECTION_INTERVAL, description="Базовый интервал детекции курения в секундах", gt=0),
+    priority: float = Query(1.0, description="Вес стрима при распределении вызовов детектора", ge=0.1, le=10.0)
+):
     """
     Создает новую трансляцию и возвращает UUID стрима.
     
     Stream ID и Video ID - это один и тот же UUID.
-    Токен сразу готов для стриминга и просмотра.
+    Токен сразу готов для стриминга и просмотра. Если за STREAM_TOKEN_CONNECT_TIMEOUT
+    секунд к нему не подключился ни один WebSocket, токен удаляется, а его слот
+    губернатора освобождается.
     """
     # Генерируем UUID, который будет служить одновременно stream_token и video_uuid
     stream_id = str(uuid.uuid4())
+
+    # WebSocket стримы не ставятся в очередь: клиент повторит запрос позже
+    try:
+        governor.admit(stream_id, priority)
+    except CapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     
     # Токен сразу активен и готов к использованию
     stream_sessions[stream_id] = {
         "live": True,
         "closing": False,
-        "created_at": time.time()
+        "created_at": time.time(),
+        "lat": lat,
+        "lng": lng,
+        "detection_interval": detection_interval
     }
-    print(f"Создан новый стрим с ID: {stream_id} (сразу готов)")
-    print(f"Stream ID = Video ID = {stream_id}")
-    print(f"Всего активных стримов: {len(stream_sessions)}")
-    print(f"Все активные stream_ids: {list(stream_sessions.keys())}")
+    rate_controller.register(stream_id, detection_interval)
+    asyncio.create_task(expire_unconnected_token(stream_id))
+    logger.info("Создан новый стрим (всего активных стримов: %d)", len(stream_sessions), extra={"stream_id": stream_id})
     return {
         "stream_token": stream_id,
         "stream_id": stream_id,
@@ -955,6 +1621,24 @@ async def request_stream_token():
         "status": "active"
     }
 
+async def expire_unconnected_token(stream_id: str):
+    """
+    Удаляет токен, к которому за STREAM_TOKEN_CONNECT_TIMEOUT секунд не подключился
+    ни один WebSocket. Слот губернатора выдается при создании токена и освобождается
+    при отключении последнего клиента, поэтому неиспользованные токены иначе
+    занимали бы его навсегда.
+    """
+    await asyncio.sleep(STREAM_TOKEN_CONNECT_TIMEOUT)
+    session = stream_sessions.get(stream_id)
+    # Закрытый через /stream/close токен уже освободил ресурсы
+    if session is None or session.get("connected_at") is not None or not session.get("live", False):
+        return
+    del stream_sessions[stream_id]
+    rate_controller.unregister(stream_id)
+    governor.release(stream_id)
+    metrics.remove_stream(stream_id)
+    logger.info("Токен не использован за %.0f с, слот стрима освобожден", STREAM_TOKEN_CONNECT_TIMEOUT, extra={"stream_id": stream_id})
+
 @router.post(
     "/broadcast/{token}",
     response_model=BroadcastResponse,
@@ -983,7 +1667,9 @@ async def request_stream_token():
     1. Данные принимаются через HTTP POST запрос
     2. К данным добавляется временная метка (`time`)
     3. Данные отправляются всем подключенным клиентам через WebSocket
-    4. Возвращается количество получателей
+    4. Рамки сопоставляются с треками стрима, каждому кадру добавляется `track_id`
+    5. При подтверждении и завершении трека отправляются события `smoking_event`
+    6. Возвращается количество получателей
     
     **Пример использования:**
     ```python
@@ -1038,7 +1724,7 @@ async def broadcast_to_stream(
     Returns:
         dict: Статус отправки и количество получателей
     """
-    print(f"Запрос на отправку данных в стрим {token}")
+    logger.debug("Запрос на отправку данных в стрим", extra={"stream_id": token, "rate_limit": 1.0})
     
     # Проверяем, что стрим существует
     if token not in stream_sessions:
@@ -1052,6 +1738,13 @@ async def broadcast_to_stream(
     try:
         # Формируем payload в том же формате, что был при генерации
         frames_data = [{"metric": f.metric, "cord": f.cord} for f in data.frames]
+
+        # Сопоставляем рамки с треками стрима: cord [x, y, width, height] -> [x1, y1, x2, y2]
+        tracker = get_stream_tracker(token, "frame")
+        boxes = [[x, y, x + w, y + h] for x, y, w, h in (f.cord for f in data.frames)]
+        track_events = tracker.update(boxes, [f.metric for f in data.frames], time.time())
+        for frame_data, track_id in zip(frames_data, tracker.last_track_ids):
+            frame_data["track_id"] = track_id
         payload = {
             "time": time.time(),  # Временная метка обработанного кадра
             "frames": frames_data  # Массив объектов с metric и cord
@@ -1059,12 +1752,12 @@ async def broadcast_to_stream(
         
         # Транслируем данные через менеджер соединений
         await manager.broadcast_json(payload, token)
+        await publish_track_events(token, track_events)
         
         # Подсчитываем количество получателей
         recipient_count = len(manager.active_connections.get(token, []))
         
-        print(f"Данные отправлены в стрим {token} для {recipient_count} получателей")
-        print(f"Формат данных: {payload}")
+        logger.debug("Данные отправлены в стрим для %d получателей", recipient_count, extra={"stream_id": token, "rate_limit": 1.0})
         
         return {
             "message": "Data broadcasted successfully",
@@ -1073,9 +1766,7 @@ async def broadcast_to_stream(
             "data": payload
         }
     except Exception as e:
-        print(f"Ошибка при отправке данных в стрим {token}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка при отправке данных в стрим: %s", e, extra={"stream_id": token})
         raise HTTPException(status_code=500, detail=f"Failed to broadcast data: {str(e)}")
 
 @router.post(
@@ -1129,7 +1820,7 @@ async def close_stream(
     Returns:
         dict: Статус закрытия стрима
     """
-    print(f"Запрос на закрытие стрима: {token}")
+    logger.info("Запрос на закрытие стрима", extra={"stream_id": token})
     
     # Проверяем, что стрим существует
     if token not in stream_sessions:
@@ -1144,6 +1835,13 @@ async def close_stream(
             "stream_id": token,
             "status": "closing"
         }
+    if session.get("detached", False):
+        return {
+            "message": "Stream is already closed",
+            "stream_id": token,
+            "status": "closed",
+            "closed_at": session["closed_at"]
+        }
     
     if not session.get("live", False):
         return {
@@ -1154,37 +1852,60 @@ async def close_stream(
     
     # Помечаем стрим как закрывающийся
     session["closing"] = True
-    print(f"Стрим {token} помечен как закрывающийся")
+    logger.debug("Стрим помечен как закрывающийся", extra={"stream_id": token})
+
+    # Отписываем URL стрим от захвата источника. Пока у захвата остаются другие
+    # подписчики, его видеописатель, слот губернатора и трекер продолжают работать
+    capture = capture_registry.release(token)
+    shared = capture is not None and capture.active
+
+    if detach_capture_owner(token, capture):
+        return {
+            "message": "Stream closed successfully",
+            "stream_id": token,
+            "status": "closed",
+            "closed_at": session["closed_at"]
+        }
     
     # Ждем завершения обработки (даем время на обработку оставшихся кадров)
     # Обычно достаточно 1-2 секунд для завершения обработки
     await asyncio.sleep(2)
     
     # Освобождаем ресурсы видеописателя, если он был создан
-    if "video_writer" in session and session["video_writer"] is not None:
+    if not shared and "video_writer" in session and session["video_writer"] is not None:
         try:
             video_writer = session["video_writer"]
             video_writer.release()
-            print(f"Видеописатель для стрима {token} освобожден")
+            logger.debug("Видеописатель стрима освобожден", extra={"stream_id": token})
         except Exception as e:
-            print(f"Ошибка при освобождении видеописателя для стрима {token}: {e}")
+            logger.warning("Ошибка при освобождении видеописателя: %s", e, extra={"stream_id": token})
     
     # Закрываем окно отображения, если оно было открыто
     if "display_window_name" in session and session["display_window_name"]:
         try:
             if ENABLE_VIDEO_DISPLAY:
                 cv2.destroyWindow(session["display_window_name"])
-                print(f"Окно отображения для стрима {token} закрыто")
+                logger.debug("Окно отображения стрима закрыто", extra={"stream_id": token})
         except Exception as e:
-            print(f"Ошибка при закрытии окна для стрима {token}: {e}")
+            logger.warning("Ошибка при закрытии окна: %s", e, extra={"stream_id": token})
     
     # Помечаем стрим как закрытый
     session["live"] = False
     session["closing"] = False
     session["closed_at"] = time.time()
-    
-    print(f"Стрим {token} успешно закрыт")
-    print(f"Активных стримов: {len([s for s in stream_sessions.values() if s.get('live', False)])}")
+    if capture is not None:
+        session["status"] = "stopped"
+
+    if not shared:
+        await close_stream_tracker(token)
+        rate_controller.unregister(token)
+        governor.release(token)
+        metrics.remove_stream(token)
+    
+    logger.info(
+        "Стрим успешно закрыт (активных стримов: %d)",
+        len([s for s in stream_sessions.values() if s.get("live", False)]), extra={"stream_id": token}
+    )
     
     return {
         "message": "Stream closed successfully",
@@ -1200,16 +1921,15 @@ async def start_stream(token: str):
     ПРИМЕЧАНИЕ: Этот эндпоинт теперь опционален - токены готовы сразу после создания.
     Сохранен для обратной совместимости.
     """
-    print(f"Запуск стрима для токена: {token}")
-    print(f"Доступные токены перед запуском: {list(stream_sessions.keys())}")
+    logger.info("Запуск стрима", extra={"stream_id": token})
     
     if token not in stream_sessions:
-        print(f"ОШИБКА: Токен {token} не найден")
+        logger.warning("Токен не найден", extra={"stream_id": token})
         raise HTTPException(status_code=404, detail="Stream token not found")
 
     # Если уже активен, просто возвращаем успех
     if stream_sessions[token].get("live", False):
-        print(f"ИНФО: Стрим {token} уже активен")
+        logger.info("Стрим уже активен", extra={"stream_id": token})
         return {
             "message": "Stream already active", 
             "stream_id": token,
@@ -1219,8 +1939,7 @@ async def start_stream(token: str):
     
     stream_sessions[token]["live"] = True
     
-    print(f"Стрим {token} успешно запущен")
-    print(f"Состояние сессии стрима: {stream_sessions[token]}")
+    logger.info("Стрим успешно запущен", extra={"stream_id": token})
 
     return {
         "message": "Stream started successfully", 
@@ -1301,6 +2020,16 @@ async def get_video_stream(
         Генератор для создания MJPEG потока.
         Отправляет последний кадр стрима в бесконечном цикле.
         """
+        video_viewers[token] = video_viewers.get(token, 0) + 1
+        try:
+            async for chunk in mjpeg_frames():
+                yield chunk
+        finally:
+            video_viewers[token] -= 1
+            if not video_viewers[token]:
+                del video_viewers[token]
+
+    async def mjpeg_frames():
         while True:
             # Проверяем, что стрим все еще активен
             if token not in stream_sessions:
@@ -1441,34 +2170,33 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
     """
     # Логируем детали подключения для отладки
     client_host = websocket.client.host if websocket.client else "unknown"
-    print(f"Попытка WebSocket подключения от {client_host} для stream_id: {token}")
-    print(f"Заголовки: {dict(websocket.headers)}")
-    print(f"Доступные stream_ids: {list(stream_sessions.keys())}")
+    logger.info("Попытка WebSocket подключения от %s", client_host, extra={"stream_id": token})
+    logger.debug("Заголовки: %s", dict(websocket.headers), extra={"stream_id": token})
     
     try:
         # Принимаем WebSocket соединение первым делом (требуется перед любым общением)
         # Это работает с ngrok и другими обратными прокси
         await websocket.accept()
-        print(f"WebSocket соединение принято для stream_id: {token}")
+        logger.debug("WebSocket соединение принято", extra={"stream_id": token})
     except Exception as e:
-        print(f"ОШИБКА при принятии WebSocket соединения: {e}")
+        logger.warning("Ошибка при принятии WebSocket соединения: %s", e, extra={"stream_id": token})
         return
     
     # Проверяем, что токен стрима существует и активен
-    if token not in stream_sessions or not stream_sessions[token].get("live", False):
-        # Если стрим не найден или не активен, закрываем соединение
+    if token not in stream_sessions or not stream_sessions[token].get("live", False) or stream_sessions[token].get("detached"):
+        # Если стрим не найден, не активен или закрыт клиентом (отсоединен от своего захвата), закрываем соединение
         reason = f"Stream {token} not found or has been closed."
-        print(f"ОТКЛОНЕНО: {reason}")
+        logger.warning("Отклонено: %s", reason, extra={"stream_id": token})
         await websocket.close(code=4000, reason=reason)
         return
     
     # Убеждаемся, что стрим помечен как активный (автоактивация при необходимости)
     if not stream_sessions[token].get("live", False):
         stream_sessions[token]["live"] = True
-        print(f"Автоактивация стрима для stream_id {token}")
+        logger.info("Автоактивация стрима", extra={"stream_id": token})
     
-    print(f"Stream ID {token} успешно проверен, готов для стриминга/просмотра")
-    print(f"Stream ID = Video ID = {token}")
+    logger.info("Stream ID успешно проверен, готов для стриминга/просмотра", extra={"stream_id": token})
+    stream_sessions[token].setdefault("connected_at", time.time())
 
     # Добавляем это соединение в менеджер соединений для трансляции
     await manager.connect(websocket, token)
@@ -1487,75 +2215,82 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
     try:
         # Главный цикл: непрерывно принимаем и обрабатываем видеокадры
         frame_count = 0
-        last_checked = time.time()
         while True:
             try:
                 # Принимаем видеокадр от клиента как base64-закодированный data URI
                 # Формат: "data:image/jpeg;base64,/9j/4AAQSkZJRg..."
                 data = await websocket.receive_text()
+                frame_started = time.thread_time()
                 frame_count += 1
                 
                 if frame_count == 1:
-                    print(f"Получен первый кадр для стрима {token}")
+                    logger.info("Получен первый кадр", extra={"stream_id": token})
                 
                 # Декодируем base64 данные изображения
                 try:
                     # Разделяем data URI, чтобы получить base64 часть
                     if "," not in data:
-                        print(f"ОШИБКА: Неверный формат data URI для кадра {frame_count}: отсутствует запятая")
+                        logger.warning("Неверный формат data URI для кадра %d: отсутствует запятая", frame_count, extra={"stream_id": token, "rate_limit": 5.0})
+                        metrics.record_drop(token, "invalid_data")
                         continue
                     
-                    header, encoded = data.split(",", 1)
-                    # Декодируем base64 в бинарные данные изображения
-                    img_data = base64.b64decode(encoded)
+                    with metrics.stage("parse", token, frame_count):
+                        header, encoded = data.split(",", 1)
+                        # Декодируем base64 в бинарные данные изображения
+                        img_data = base64.b64decode(encoded)
                     # Преобразуем бинарные данные в numpy массив
                     np_arr = np.frombuffer(img_data, np.uint8)
                     # Декодируем изображение с помощью OpenCV
-                    frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+                    with metrics.stage("decode", token, frame_count):
+                        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+                    # Нагрузка считается только по синхронным участкам: во время ожидания детектора
+                    # поток event loop выполняет другие корутины, и их CPU не относится к стриму
+                    decode_cpu = time.thread_time() - frame_started
                     
                     # Проверяем, успешно ли декодирован кадр
                     if frame is None:
-                        print(f"Не удалось декодировать кадр {frame_count}: неверные данные изображения")
+                        logger.warning("Не удалось декодировать кадр %d: неверные данные изображения", frame_count, extra={"stream_id": token, "rate_limit": 5.0})
+                        metrics.record_drop(token, "decode_error")
                         continue
                 except Exception as e:
-                    print(f"ОШИБКА при декодировании кадра {frame_count}: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.warning("Ошибка при декодировании кадра %d: %s", frame_count, e, exc_info=True, extra={"stream_id": token, "rate_limit": 5.0})
+                    metrics.record_drop(token, "decode_error")
                     continue
 
                 current_time = time.time()
-                if current_time - last_checked >= 5:
-                    last_checked = current_time
-                    print(f"Preparing to send frame to OpenAI for stream {token}")
-                    _, buffer = cv2.imencode('.png', frame)
-                    b64_image = base64.b64encode(buffer).decode('utf-8')
+                metrics.record_frame(token, current_time)
+                rate_controller.set_viewers(token, count_viewers(token))
+                rate_controller.observe_frame(token, frame, current_time)
+                if needs_verification(token, current_time) and rate_controller.should_detect(token, current_time):
+                    logger.debug("Отправка кадра на детекцию", extra={"stream_id": token})
+                    roi = stream_sessions.get(token, {}).get("roi")
+                    with metrics.stage("preprocess", token, frame_count):
+                        detection_frame = roi.apply(frame)[0] if roi is not None else frame
+                        _, buffer = cv2.imencode('.png', detection_frame)
+                        b64_image = base64.b64encode(buffer).decode('utf-8')
 
                     # Offload the OpenAI API call to a separate thread to avoid blocking the event loop
-                    verdict_raw = await asyncio.to_thread(detect_smoking, b64_image)
+                    async with governor.detector_slot(token):
+                        with metrics.stage("detector", token, frame_count):
+                            verdict_raw = await asyncio.to_thread(detect_smoking, b64_image)
 
                     if verdict_raw is not None:
-                        # Нормализуем ответ: если в ответе есть "yes" -> "Yes", если "no" -> "No"
-                        verdict_lower = verdict_raw.strip().lower()
-                        if "yes" in verdict_lower:
-                            verdict = "Yes"
-                        elif "no" in verdict_lower:
-                            verdict = "No"
-                        else:
-                            verdict = verdict_raw.strip()
+                        verdict = normalize_verdict(verdict_raw)
 
                         payload = {
                             "type": "smoking_detection",
                             "timestamp": current_time,
                             "verdict": verdict
                         }
-                        await manager.broadcast_json(payload, token)
-                        print(f"Broadcasted smoking detection verdict for stream {token}: {verdict} (raw: {verdict_raw})")
+                        await publish_detection(token, payload)
+                        logger.info("Вердикт детекции: %s (ответ модели: %r)", verdict, verdict_raw, extra={"stream_id": token})
 
                 # Проверяем, не закрывается ли стрим
                 if stream_sessions.get(token, {}).get("closing", False):
-                    print(f"Стрим {token} закрывается, прекращаем обработку новых кадров")
+                    logger.info("Стрим закрывается, прекращаем обработку новых кадров", extra={"stream_id": token})
                     break
                 
+                write_started = time.thread_time()
                 # Инициализируем видеописатель на первом кадре
                 if video_writer is None:
                     try:
@@ -1577,13 +2312,9 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                         if token in stream_sessions:
                             stream_sessions[token]["video_writer"] = video_writer
                             stream_sessions[token]["video_path"] = video_path
-                        print(f"Начало записи стрима {token} в {video_path}")
-                        print(f"Разрешение видео: {width}x{height}, FPS: {fps}")
-                        print(f"Stream ID = Video ID = {token}")
+                        logger.info("Начало записи стрима в %s, разрешение %dx%d, FPS: %s", video_path, width, height, fps, extra={"stream_id": token})
                     except Exception as e:
-                        print(f"ОШИБКА при инициализации видеописателя: {e}")
-                        import traceback
-                        traceback.print_exc()
+                        logger.exception("Ошибка при инициализации видеописателя: %s", e, extra={"stream_id": token})
                         continue
 
                 # Отображаем видеокадр в реальном времени (если включено)
@@ -1600,26 +2331,29 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                     except Exception as e:
                         # Если отображение не удалось (например, нет GUI), логируем предупреждение, но продолжаем
                         # Отображение будет попытаться снова на следующем кадре
-                        print(f"Предупреждение: Не удалось отобразить видеокадр {frame_count}: {e}")
+                        logger.warning("Не удалось отобразить видеокадр %d: %s", frame_count, e, extra={"stream_id": token, "rate_limit": 5.0})
                         if frame_count == 1:
-                            print("Совет: Установите ENABLE_VIDEO_DISPLAY = False при работе без GUI")
+                            logger.info("Совет: Установите ENABLE_VIDEO_DISPLAY = False при работе без GUI")
 
                 # Записываем кадр в видеофайл для последующего воспроизведения/анализа
                 try:
                     if video_writer is not None:
-                        video_writer.write(frame)
+                        with metrics.stage("write", token, frame_count):
+                            video_writer.write(frame)
                 except Exception as e:
-                    print(f"ОШИБКА при записи кадра {frame_count} в видеофайл: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.warning("Ошибка при записи кадра %d в видеофайл: %s", frame_count, e, exc_info=True, extra={"stream_id": token, "rate_limit": 5.0})
+                    metrics.record_drop(token, "write_error")
 
                 # Сохраняем последний кадр для MJPEG потока
                 # Кодируем кадр в JPEG формат для передачи через HTTP
                 try:
-                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                    with metrics.stage("jpeg_encode", token, frame_count):
+                        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
                     last_frames[token] = buffer.tobytes()
                 except Exception as e:
-                    print(f"Предупреждение: Не удалось сохранить кадр {frame_count} для MJPEG потока: {e}")
+                    logger.warning("Не удалось сохранить кадр %d для MJPEG потока: %s", frame_count, e, extra={"stream_id": token, "rate_limit": 5.0})
+                    metrics.record_drop(token, "jpeg_error")
+                governor.record_load(token, decode_cpu + time.thread_time() - write_started, current_time)
 
                 # Отправляем подтверждение получения кадра (опционально)
                 # Если нужно отправлять данные о каждом кадре, используйте эндпоинт /stream/broadcast/{token}
@@ -1630,54 +2364,63 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                 raise
             except Exception as e:
                 # Логируем любые другие ошибки, но продолжаем работу
-                print(f"ОШИБКА при обработке кадра {frame_count} для стрима {token}: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.warning("Ошибка при обработке кадра %d: %s", frame_count, e, exc_info=True, extra={"stream_id": token, "rate_limit": 5.0})
                 # Продолжаем цикл, чтобы не разрывать соединение из-за ошибки в одном кадре
                 continue
             
     except WebSocketDisconnect:
         # Клиент отключился - завершаем обработку и очищаем ресурсы
-        print(f"WebSocket отключен для стрима {token}.")
+        logger.info("WebSocket отключен", extra={"stream_id": token})
         
         # Удаляем соединение из менеджера
         manager.disconnect(websocket, token)
         
         # Проверяем, остались ли еще соединения для этого стрима
         if not manager.active_connections.get(token):
-            print(f"Последний клиент отключился от стрима {token}. Закрываем стрим.")
+            logger.info("Последний клиент отключился от стрима, закрываем стрим", extra={"stream_id": token})
             
             # Освобождаем ресурсы видеописателя
             if video_writer is not None:
                 try:
                     video_writer.release()
                     if video_path:
-                        print(f"Стрим {token} сохранен в {video_path}")
+                        logger.info("Стрим сохранен в %s", video_path, extra={"stream_id": token})
                 except Exception as e:
-                    print(f"Ошибка при освобождении видеописателя для стрима {token}: {e}")
+                    logger.warning("Ошибка при освобождении видеописателя: %s", e, extra={"stream_id": token})
             
             # Закрываем окно отображения видео, если оно было открыто
             if ENABLE_VIDEO_DISPLAY and display_window_name:
                 try:
                     cv2.destroyWindow(display_window_name)
                 except Exception as e:
-                    print(f"Ошибка при закрытии окна для стрима {token}: {e}")
+                    logger.warning("Ошибка при закрытии окна: %s", e, extra={"stream_id": token})
             
-            # Удаляем сессию стрима, чтобы он не был доступен для переподключения
-            if token in stream_sessions:
+            # Отписываем URL стрим от захвата; ресурсы общего захвата освобождает его цикл
+            capture = capture_registry.release(token)
+
+            # Удаляем сессию стрима, чтобы он не был доступен для переподключения.
+            # Сессия, под которой работает общий захват, остается до его остановки
+            if token in stream_sessions and not detach_capture_owner(token, capture):
                 del stream_sessions[token]
-                print(f"Сессия стрима {token} удалена.")
+                logger.debug("Сессия стрима удалена", extra={"stream_id": token})
             
             # Удаляем последний кадр
             if token in last_frames:
                 del last_frames[token]
+
+            if capture is None or not capture.active:
+                # Завершаем треки стрима
+                await close_stream_tracker(token)
+                rate_controller.unregister(token)
+                governor.release(token)
+                metrics.remove_stream(token)
             
-            print(f"Стрим {token} полностью закрыт и очищен.")
+            logger.info("Стрим полностью закрыт и очищен", extra={"stream_id": token})
         else:
             active_count = len(manager.active_connections.get(token, []))
-            print(f"Клиент отключился, но для стрима {token} еще есть {active_count} активных соединений.")
+            logger.info("Клиент отключился, но для стрима еще есть %d активных соединений", active_count, extra={"stream_id": token})
             
-        print(f"Текущие активные стримы: {list(stream_sessions.keys())}")
+        logger.debug("Текущие активные стримы: %s", list(stream_sessions.keys()))
 
 
 # ============================================================================
@@ -1,27 +1,94 @@
 import asyncio
-import base64
+import math
+import multiprocessing
 import os
 import tempfile
 import uuid
 from collections import deque
-from typing import Deque, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
 
-import cv2
 import numpy as np
-from fastapi import APIRouter, BackgroundTasks, File, HTTPException, UploadFile
+from fastapi import APIRouter, BackgroundTasks, File, HTTPException, Query, UploadFile
 
-from utils import detect_smoking
+from services.result_index import result_index, save_upload_hashed
+from services.sparse_decode import count_samples, encode_sample_range
+from utils import detect_smoking, normalize_verdict, DETECTOR_CONFIG_VERSION
 
 router = APIRouter()
 
+# Sampling interval for uploaded videos (seconds)
+SAMPLE_INTERVAL = 5.0
+
+# Number of processes that decode time ranges of uploaded videos in parallel
+VIDEO_DECODE_WORKERS = int(os.getenv("VIDEO_DECODE_WORKERS", str(os.cpu_count() or 1)))
+
+# Minimum number of samples per range, so that short videos are not split (12 samples = 1 minute)
+MIN_SAMPLES_PER_RANGE = int(os.getenv("MIN_SAMPLES_PER_RANGE", "12"))
+
+_decode_pool: Optional[ProcessPoolExecutor] = None
+
+# How many more times samples the detector did not answer are sent again
+VIDEO_DETECT_RETRIES = int(os.getenv("VIDEO_DETECT_RETRIES", "2"))
+
+# Cached video verdicts are valid for this detector configuration and sampling
+RESULT_CONFIG_VERSION = f"{DETECTOR_CONFIG_VERSION}-s{SAMPLE_INTERVAL:g}"
+
+# Jobs that are still running, by content hash, so that concurrent identical uploads share a job
+pending_jobs: Dict[str, str] = {}
+
 # In-memory storage for job status and results
 job_results: Dict[str, Dict] = {}
 
 
-async def process_video_smoking_detection(video_path: str):
+def get_decode_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool for video decoding, creating it on first use.
+    Workers are spawned rather than forked, since the server process runs threads.
+    """
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ProcessPoolExecutor(
+            max_workers=VIDEO_DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _decode_pool
+
+
+@router.on_event("shutdown")
+async def shutdown_decode_pool():
+    global _decode_pool
+    if _decode_pool is not None:
+        _decode_pool.shutdown(wait=False, cancel_futures=True)
+        _decode_pool = None
+
+
+def split_sample_ranges(total_samples: Optional[int], workers: int,
+                        min_samples: int = MIN_SAMPLES_PER_RANGE) -> List[Tuple[int, Optional[int]]]:
+    """
+    Splits sample indices [0, total_samples) into contiguous ranges, one per worker.
+
+    Args:
+        total_samples: Number of samples in the video, or None if unknown.
+        workers: Maximum number of ranges.
+        min_samples: Minimum number of samples per range.
+
+    Returns:
+        A list of (first_sample, end_sample) ranges; the last range is open-ended (None),
+        so that samples past an inaccurate frame count are not lost.
+    """
+    if not total_samples:
+        return [(0, None)]
+    count = max(1, min(workers, total_samples // max(1, min_samples)))
+    size = math.ceil(total_samples / count)
+    bounds = list(range(0, total_samples, size))
+    return [(start, end) for start, end in zip(bounds, bounds[1:] + [None])]
+
+
+async def process_video_smoking_detection(video_path: str) -> Tuple[str, int]:
     """
     Processes a video to detect smoking by sampling frames and using a sliding window.
-    1. Samples one frame every 5 seconds.
+    1. Samples one frame every 5 seconds. Long videos are split into time ranges
+       that are decoded in parallel by separate processes.
     2. Runs detection on all sampled frames.
     3. Applies a sliding window of 5 samples.
     4. Returns "Yes" if over 50% of the windows are positive.
@@ -30,58 +97,77 @@ async def process_video_smoking_detection(video_path: str):
         video_path: The path to the video file.
 
     Returns:
-        A verdict ("Yes" or "No") based on the smoking detection analysis.
+        A tuple (verdict, unanswered): the verdict ("Yes" or "No") based on the
+        smoking detection analysis, and the number of samples the detector did
+        not answer after VIDEO_DETECT_RETRIES retries. Unanswered samples are
+        left out of the sliding window rather than counted as "No".
+
+    Raises:
+        RuntimeError: The detector did not answer any of the samples.
     """
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
+    # Only the sampled frames are decoded in full (see services/sparse_decode.py).
+    # Each range seeks to its first sample independently
+    try:
+        total_samples = count_samples(video_path, SAMPLE_INTERVAL)
+    except IOError:
         raise HTTPException(status_code=400, detail="Could not open video file.")
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    if not fps or fps == 0:
-        fps = 30  # Assume 30 fps if not available
+    loop = asyncio.get_running_loop()
+    pool = get_decode_pool()
+    ranges = split_sample_ranges(total_samples, VIDEO_DECODE_WORKERS)
+    range_samples = await asyncio.gather(*[
+        loop.run_in_executor(pool, encode_sample_range, video_path, SAMPLE_INTERVAL, first_sample, end_sample)
+        for first_sample, end_sample in ranges
+    ])
+
+    # Merge the per-range timelines in time order for the global sliding window
+    sampled_images = [b64_image for samples in range_samples for _, b64_image in samples]
+
+    if not sampled_images:
+        return "No", 0 # Video is shorter than 5 seconds
 
-    frame_interval = int(fps * 5)  # Sample a frame every 5 seconds
-    frame_count = 0
-    sampled_frames = []
+    # Run detection on all sampled frames concurrently
+    detection_tasks = [asyncio.to_thread(detect_smoking, b64_image) for b64_image in sampled_images]
+    
+    api_verdicts = await asyncio.gather(*detection_tasks)
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
+    # Send the samples the detector did not answer again, a bounded number of times
+    for _ in range(VIDEO_DETECT_RETRIES):
+        missing = [i for i, result in enumerate(api_verdicts) if result is None]
+        if not missing:
             break
+        retried = await asyncio.gather(*[asyncio.to_thread(detect_smoking, sampled_images[i]) for i in missing])
+        for i, result in zip(missing, retried):
+            api_verdicts[i] = result
 
-        if frame_count % frame_interval == 0:
-            sampled_frames.append(frame)
-        
-        frame_count += 1
+    answered = [result for result in api_verdicts if result is not None]
+    if not answered:
+        raise RuntimeError(f"Detector returned no answer for any of {len(api_verdicts)} samples")
 
-    cap.release()
+    # Only "Yes" counts in the sliding window vote, any other answer is a negative sample
+    frame_verdicts = [normalize_verdict(result) for result in answered]
 
-    if not sampled_frames:
-        return "No" # Video is shorter than 5 seconds
+    return sliding_window_verdict(frame_verdicts), len(api_verdicts) - len(answered)
 
-    # Run detection on all sampled frames concurrently
-    detection_tasks = []
-    for frame in sampled_frames:
-        _, buffer = cv2.imencode('.png', frame)
-        b64_image = base64.b64encode(buffer).decode('utf-8')
-        detection_tasks.append(asyncio.to_thread(detect_smoking, b64_image))
-    
-    api_verdicts = await asyncio.gather(*detection_tasks)
 
-    # Normalize verdicts to "Yes" or "No"
-    frame_verdicts = []
-    for result in api_verdicts:
-        if result and "yes" in result.strip().lower():
-            frame_verdicts.append("Yes")
-        else:
-            frame_verdicts.append("No")
+def sliding_window_verdict(frame_verdicts: List[str], window_size: int = 5) -> str:
+    """
+    Aggregates per-sample verdicts with a sliding window vote.
+    A window is positive if more than half of its samples are "Yes";
+    the result is "Yes" if more than half of the windows are positive.
 
-    # Apply a sliding window of 5 to the frame verdicts
-    if len(frame_verdicts) < 5:
+    Args:
+        frame_verdicts: Normalized verdicts of the sampled frames (see utils.normalize_verdict);
+            anything other than "Yes" counts as negative.
+        window_size: Number of samples in a window.
+
+    Returns:
+        The aggregated verdict ("Yes" or "No").
+    """
+    if len(frame_verdicts) < window_size:
         # Not enough samples for a full window, if any sample is "Yes", then "Yes"
         return "Yes" if "Yes" in frame_verdicts else "No"
 
-    window_size = 5
     verdicts_window: Deque[str] = deque(maxlen=window_size)
     window_verdicts = []
 
@@ -106,23 +192,35 @@ async def process_video_smoking_detection(video_path: str):
         return "No"
 
 
-async def process_video_and_store_result(job_id: str, video_path: str):
+async def process_video_and_store_result(job_id: str, video_path: str, content_hash: Optional[str] = None,
+                                         size: Optional[int] = None):
     """
     Wrapper function to run in the background, process video, and store the result.
+    Completed verdicts are saved in the result index under the content hash.
+    Failed jobs and incomplete verdicts (some samples were not answered by the
+    detector) are not, so the same video can be processed again.
     """
     try:
-        verdict = await process_video_smoking_detection(video_path)
+        verdict, unanswered = await process_video_smoking_detection(video_path)
         job_results[job_id] = {"status": "completed", "verdict": verdict}
+        if unanswered:
+            job_results[job_id].update({"incomplete": True, "unanswered_samples": unanswered})
+        elif content_hash is not None:
+            result_index.put("video", content_hash, RESULT_CONFIG_VERSION, verdict, job_id=job_id, size=size)
     except Exception as e:
         job_results[job_id] = {"status": "failed", "error": str(e)}
     finally:
+        if content_hash is not None and pending_jobs.get(content_hash) == job_id:
+            del pending_jobs[content_hash]
         if os.path.exists(video_path):
             os.unlink(video_path)
 
 
 @router.post("/video/detect-smoking", tags=["Video Processing"], status_code=202)
 async def detect_smoking_in_video(
-    background_tasks: BackgroundTasks, file: UploadFile = File(...)
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    dedup: bool = Query(True, description="Return the existing job for an identical video; false always processes the upload"),
 ):
     """
     Uploads a video and starts smoking detection in the background.
@@ -130,17 +228,42 @@ async def detect_smoking_in_video(
     This endpoint returns a job ID immediately. Use the
     `/video/detect-smoking/result/{job_id}` endpoint to check the status and
     get the result.
+
+    The upload is hashed while it is written to disk. If the same video was
+    already processed with the current detector configuration, or is being
+    processed right now, the existing job is returned instead of a new one.
+    With `dedup=false` the video is processed again and its verdict replaces
+    the cached one.
     """
     job_id = str(uuid.uuid4())
-    job_results[job_id] = {"status": "processing"}
+    video_path = None
 
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
-            contents = await file.read()
-            tmp.write(contents)
             video_path = tmp.name
+            content_hash, size = await save_upload_hashed(file, tmp)
 
-        background_tasks.add_task(process_video_and_store_result, job_id, video_path)
+        existing_job_id = pending_jobs.get(content_hash) if dedup else None
+        cached = None
+        if dedup and not existing_job_id:
+            cached = result_index.get("video", content_hash, RESULT_CONFIG_VERSION)
+        if existing_job_id or cached:
+            os.unlink(video_path)
+            if cached:
+                # The job may be from before a restart, so its result is restored from the index
+                existing_job_id = cached["job_id"] or job_id
+                job_results[existing_job_id] = {"status": "completed", "verdict": cached["verdict"]}
+            return {
+                "message": "Identical video was already submitted, returning the existing job.",
+                "job_id": existing_job_id,
+                "status_url": f"/video/detect-smoking/result/{existing_job_id}",
+                "deduplicated": True,
+                **job_results[existing_job_id],
+            }
+
+        job_results[job_id] = {"status": "processing"}
+        pending_jobs[content_hash] = job_id
+        background_tasks.add_task(process_video_and_store_result, job_id, video_path, content_hash, size)
 
         return {
             "message": "Video processing started in the background.",
@@ -150,6 +273,8 @@ async def detect_smoking_in_video(
 
     except Exception as e:
         job_results[job_id] = {"status": "failed", "error": str(e)}
+        if video_path and os.path.exists(video_path):
+            os.unlink(video_path)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -0,0 +1,339 @@
+"""
+Оповещения о курении для внешних систем через вебхуки.
+
+Положительный вердикт детекции стрима превращается в оповещение не чаще
+раза в ALERT_COOLDOWN секунд на стрим: вердикты внутри окна не создают новых
+оповещений, а учитываются в поле suppressed следующего. Оповещения
+записываются в постоянную очередь (outbox, SQLite) по строке на каждый
+адрес доставки, а фоновая задача отправляет их пачками POST запросом
+{"alerts": [...]} через общий пул соединений httpx. Неудачная пачка
+повторяется с экспоненциальной задержкой; после ALERT_MAX_ATTEMPTS попыток
+строки помечаются как недоставленные (dead). Очередь переживает перезапуск
+сервера и ограничена ALERT_OUTBOX_LIMIT строками.
+
+Если задан ALERT_WEBHOOK_SECRET, тело запроса подписывается HMAC-SHA256
+(заголовок X-Alert-Signature: sha256=<hex>).
+
+Проверить доставку можно локальной заглушкой вебхука:
+    python benchmarks/webhook_stub.py --port 8200 --error-rate 0.3
+    ALERT_WEBHOOK_URLS=http://127.0.0.1:8200/alerts uvicorn main:app
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Адреса вебхуков через запятую; без них оповещения не создаются
+ALERT_WEBHOOK_URLS = [url.strip() for url in os.getenv("ALERT_WEBHOOK_URLS", "").split(",") if url.strip()]
+# Секрет для подписи тела запроса
+ALERT_WEBHOOK_SECRET = os.getenv("ALERT_WEBHOOK_SECRET", "")
+# Окно подавления повторных оповещений одного стрима (секунды)
+ALERT_COOLDOWN = float(os.getenv("ALERT_COOLDOWN", "60"))
+# Максимум оповещений в одном запросе к вебхуку
+ALERT_BATCH_SIZE = int(os.getenv("ALERT_BATCH_SIZE", "50"))
+# Как часто отправляются накопленные оповещения (секунды)
+ALERT_BATCH_INTERVAL = float(os.getenv("ALERT_BATCH_INTERVAL", "2.0"))
+# Попыток доставки, после которых оповещение считается недоставленным
+ALERT_MAX_ATTEMPTS = int(os.getenv("ALERT_MAX_ATTEMPTS", "10"))
+# Задержка перед повтором: ALERT_RETRY_BASE * 2^(попытка - 1), не больше ALERT_RETRY_MAX (секунды)
+ALERT_RETRY_BASE = float(os.getenv("ALERT_RETRY_BASE", "2.0"))
+ALERT_RETRY_MAX = float(os.getenv("ALERT_RETRY_MAX", "300"))
+# Таймаут запроса к вебхуку (секунды)
+ALERT_TIMEOUT = float(os.getenv("ALERT_TIMEOUT", "10"))
+# Путь к постоянной очереди и ее максимальный размер (строк)
+ALERT_OUTBOX_PATH = os.getenv("ALERT_OUTBOX_PATH", "alerts.db")
+ALERT_OUTBOX_LIMIT = int(os.getenv("ALERT_OUTBOX_LIMIT", "100000"))
+# Оповещения, ожидающие записи в очередь (в памяти)
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "10000"))
+
+# Статусы строк очереди
+STATUS_PENDING = "pending"
+STATUS_DEAD = "dead"
+
+
+def sign_body(body: bytes, secret: str) -> str:
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class Outbox:
+    """
+    Постоянная очередь оповещений в SQLite. Методы синхронные, вызываются из пула потоков
+    (доставка на разные адреса идет параллельно), поэтому соединение защищено блокировкой.
+    """
+
+    def __init__(self, path: str = ALERT_OUTBOX_PATH, limit: int = ALERT_OUTBOX_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, target, next_attempt_at);
+                """
+            )
+        return self._conn
+
+    def add(self, alerts: List[dict], targets: List[str]):
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO outbox (target, payload, status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(target, json.dumps(alert, ensure_ascii=False), STATUS_PENDING, now, now) for alert in alerts for target in targets],
+            )
+            # Очередь ограничена: сначала удаляются недоставленные, затем самые старые
+            overflow = self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] - self.limit
+            if overflow > 0:
+                self.conn.execute(
+                    "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY status = ? DESC, id LIMIT ?)",
+                    (STATUS_DEAD, overflow),
+                )
+                logger.warning("Очередь оповещений переполнена, удалено %d строк", overflow)
+
+    def due(self, target: str, limit: int) -> List[tuple]:
+        """Строки адреса, которые пора отправить: [(id, payload, attempts), ...] в порядке создания."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, payload, attempts FROM outbox WHERE status = ? AND target = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (STATUS_PENDING, target, time.time(), limit),
+            ).fetchall()
+
+    def delivered(self, ids: List[int]):
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def failed(self, rows: List[tuple], error: str, max_attempts: int):
+        now = time.time()
+        updates = []
+        for row_id, _, attempts in rows:
+            attempts += 1
+            delay = min(ALERT_RETRY_BASE * 2 ** (attempts - 1), ALERT_RETRY_MAX)
+            status = STATUS_DEAD if attempts >= max_attempts else STATUS_PENDING
+            updates.append((status, attempts, now + delay, error, row_id))
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                updates,
+            )
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Количество строк по адресам и статусам."""
+        counts: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            rows = self.conn.execute("SELECT target, status, COUNT(*) FROM outbox GROUP BY target, status").fetchall()
+        for target, status, count in rows:
+            counts.setdefault(target, {})[status] = count
+        return counts
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class AlertDispatcher:
+    """Подавление повторов по стримам и пакетная доставка оповещений на вебхуки."""
+
+    def __init__(self, targets: List[str] = ALERT_WEBHOOK_URLS, cooldown: float = ALERT_COOLDOWN,
+                 outbox: Optional[Outbox] = None):
+        self.targets = list(targets)
+        self.cooldown = cooldown
+        self.outbox = outbox or Outbox()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Оповещения, еще не записанные в очередь
+        self._pending: Deque[dict] = deque(maxlen=ALERT_QUEUE_SIZE)
+        # Формат: { stream_id: (время последнего оповещения, подавлено с тех пор) }
+        self._last_alert: Dict[str, tuple] = {}
+        self.created = 0
+        self.suppressed = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        # Строк очереди, ожидающих доставки, после последнего прохода доставки
+        self.outbox_pending = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.targets)
+
+    @property
+    def pending(self) -> int:
+        """Оповещения, ожидающие доставки: в памяти и в очереди после последнего прохода."""
+        return len(self._pending) + self.outbox_pending
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(ALERT_TIMEOUT),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+                headers={"User-Agent": "smoking-detector-alerts"},
+            )
+        return self._client
+
+    def submit(self, stream_id: str, detection: dict, lat: Optional[float] = None, lng: Optional[float] = None):
+        """
+        Учитывает положительный вердикт стрима. Создает оповещение, если с предыдущего
+        прошло не меньше cooldown секунд, иначе только увеличивает счетчик подавленных.
+        Вызывается из event loop и не блокирует его.
+        """
+        if not self.enabled:
+            return
+        timestamp = detection.get("timestamp", time.time())
+        last_at, suppressed = self._last_alert.get(stream_id, (None, 0))
+        if last_at is not None and 0 <= timestamp - last_at < self.cooldown:
+            self._last_alert[stream_id] = (last_at, suppressed + 1)
+            self.suppressed += 1
+            return
+
+        self._last_alert[stream_id] = (timestamp, 0)
+        alert = {
+            "alert_id": str(uuid.uuid4()),
+            "type": "smoking_alert",
+            "stream_id": stream_id,
+            "timestamp": timestamp,
+            "verdict": detection.get("verdict"),
+            "frame_number": detection.get("frame_number"),
+            "suppressed": suppressed,
+            "lat": lat,
+            "lng": lng,
+        }
+        for key in ("media_time", "boxes"):
+            if key in detection:
+                alert[key] = detection[key]
+        if len(self._pending) == self._pending.maxlen:
+            # Очередь не успевает записываться: вытесняется самое старое оповещение
+            self.dropped += 1
+            logger.warning("Очередь оповещений в памяти переполнена, оповещение отброшено", extra={"rate_limit": 5.0})
+        self._pending.append(alert)
+        self.created += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Оповещения включены: %s", ", ".join(self.targets))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Оповещения из памяти сохраняются в очередь и будут отправлены после перезапуска
+        await self._persist_pending()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await asyncio.to_thread(self.outbox.close)
+
+    async def _persist_pending(self):
+        if not self._pending:
+            return
+        alerts = list(self._pending)
+        self._pending.clear()
+        await asyncio.to_thread(self.outbox.add, alerts, self.targets)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ALERT_BATCH_INTERVAL)
+                # Первое оповещение после паузы ждет остальные до конца интервала
+                await asyncio.sleep(ALERT_BATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._persist_pending()
+                await asyncio.gather(*(self._deliver(target) for target in self.targets))
+                self._prune()
+                counts = await asyncio.to_thread(self.outbox.counts)
+                self.outbox_pending = sum(by_status.get(STATUS_PENDING, 0) for by_status in counts.values())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Ошибка доставки оповещений: %s", e)
+
+    async def _deliver(self, target: str):
+        """Отправляет на адрес все оповещения, которые пора отправить, пачками по ALERT_BATCH_SIZE."""
+        while True:
+            rows = await asyncio.to_thread(self.outbox.due, target, ALERT_BATCH_SIZE)
+            if not rows:
+                return
+            body = ('{"alerts": [' + ", ".join(payload for _, payload, _ in rows) + "]}").encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if ALERT_WEBHOOK_SECRET:
+                headers["X-Alert-Signature"] = sign_body(body, ALERT_WEBHOOK_SECRET)
+            try:
+                response = await self.client.post(target, content=body, headers=headers)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                self.failed += len(rows)
+                logger.warning("Вебхук %s не принял %d оповещений: %s", target, len(rows), e, extra={"rate_limit": 5.0})
+                await asyncio.to_thread(self.outbox.failed, rows, str(e), ALERT_MAX_ATTEMPTS)
+                return
+            self.delivered += len(rows)
+            await asyncio.to_thread(self.outbox.delivered, [row_id for row_id, _, _ in rows])
+            if len(rows) < ALERT_BATCH_SIZE:
+                return
+
+    def _prune(self):
+        # Состояние стримов без положительных вердиктов дольше окна подавления больше не нужно.
+        # Подавленные вердикты хранятся до следующего оповещения стрима, которое их сообщит
+        now = time.time()
+        expired = [
+            stream_id for stream_id, (last_at, suppressed) in self._last_alert.items()
+            if suppressed == 0 and now - last_at > self.cooldown
+        ]
+        for stream_id in expired:
+            del self._last_alert[stream_id]
+
+    async def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "targets": self.targets,
+            "cooldown": self.cooldown,
+            "created": self.created,
+            "suppressed": self.suppressed,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed,
+            "dropped": self.dropped,
+            "in_memory": len(self._pending),
+            "outbox": await asyncio.to_thread(self.outbox.counts) if self.enabled else {},
+        }
+
+
+# Глобальный диспетчер оповещений
+alert_dispatcher = AlertDispatcher()
@@ -0,0 +1,176 @@
+"""
+Индекс пакетной обработки архивных записей (archive_batch.py).
+
+Для каждого файла хранится его идентичность (размер, время изменения),
+версия конфигурации детектора, контрольная точка (номер первого
+необработанного сэмпла) и итоговый вердикт, а для каждого сэмпла — время и
+вердикт. Сэмплы записываются по мере обработки диапазонов, поэтому после
+сбоя обработка файла продолжается с контрольной точки, а не с начала.
+Таймлайн файла и интервалы с курением можно получить запросом к индексу.
+"""
+
+import os
+import sqlite3
+import time
+from typing import Iterable, List, Optional, Tuple
+
+# Путь к базе индекса архива
+ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", "archive.db")
+
+# Статусы файлов
+STATUS_PENDING = "pending"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+FILE_COLUMNS = ("path", "size", "mtime_ns", "config_version", "total_samples", "next_sample",
+                "status", "verdict", "positive_samples", "error", "updated_at")
+
+
+class ArchiveIndex:
+    """SQLite индекс файлов архива и их таймлайнов детекции."""
+
+    def __init__(self, path: str = ARCHIVE_INDEX_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS archive_files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    config_version TEXT NOT NULL,
+                    total_samples INTEGER,
+                    next_sample INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    verdict TEXT,
+                    positive_samples INTEGER,
+                    error TEXT,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS archive_samples (
+                    path TEXT NOT NULL,
+                    sample INTEGER NOT NULL,
+                    timestamp REAL NOT NULL,
+                    verdict TEXT NOT NULL,
+                    PRIMARY KEY (path, sample)
+                );
+                CREATE INDEX IF NOT EXISTS archive_samples_verdict ON archive_samples (verdict, path);
+                CREATE INDEX IF NOT EXISTS archive_files_status ON archive_files (status, verdict);
+                """
+            )
+        return self._conn
+
+    def get_file(self, path: str) -> Optional[dict]:
+        row = self.conn.execute(
+            f"SELECT {', '.join(FILE_COLUMNS)} FROM archive_files WHERE path = ?", (path,)
+        ).fetchone()
+        return dict(zip(FILE_COLUMNS, row)) if row else None
+
+    def start_file(self, path: str, size: int, mtime_ns: int, config_version: str,
+                   total_samples: Optional[int], reset: bool = False) -> int:
+        """
+        Регистрирует файл для обработки и возвращает номер сэмпла, с которого ее продолжать.
+        Если файл изменился, сменилась конфигурация детектора или reset=True, прежние результаты удаляются.
+        """
+        existing = None if reset else self.get_file(path)
+        if existing and (existing["size"], existing["mtime_ns"], existing["config_version"]) == (size, mtime_ns, config_version):
+            self.conn.execute(
+                "UPDATE archive_files SET status = ?, error = NULL, total_samples = ?, updated_at = ? WHERE path = ?",
+                (STATUS_PENDING, total_samples, time.time(), path),
+            )
+            self.conn.commit()
+            return existing["next_sample"]
+
+        with self.conn:
+            self.conn.execute("DELETE FROM archive_samples WHERE path = ?", (path,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO archive_files (path, size, mtime_ns, config_version, total_samples, next_sample, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                (path, size, mtime_ns, config_version, total_samples, STATUS_PENDING, time.time()),
+            )
+        return 0
+
+    def is_completed(self, path: str, size: int, mtime_ns: int, config_version: str) -> bool:
+        existing = self.get_file(path)
+        return bool(existing) and existing["status"] == STATUS_COMPLETED and (
+            existing["size"], existing["mtime_ns"], existing["config_version"]) == (size, mtime_ns, config_version)
+
+    def put_samples(self, path: str, samples: Iterable[Tuple[int, float, str]]):
+        """Записывает вердикты сэмплов (номер, время, вердикт) одной транзакцией."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO archive_samples (path, sample, timestamp, verdict) VALUES (?, ?, ?, ?)",
+                [(path, sample, timestamp, verdict) for sample, timestamp, verdict in samples],
+            )
+
+    def checkpoint(self, path: str, next_sample: int):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE archive_files SET next_sample = ?, updated_at = ? WHERE path = ?",
+                (next_sample, time.time(), path),
+            )
+
+    def complete_file(self, path: str, verdict: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE archive_files SET status = ?, verdict = ?, error = NULL, updated_at = ?, "
+                "positive_samples = (SELECT COUNT(*) FROM archive_samples WHERE path = ? AND verdict = 'Yes') "
+                "WHERE path = ?",
+                (STATUS_COMPLETED, verdict, time.time(), path, path),
+            )
+
+    def fail_file(self, path: str, error: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE archive_files SET status = ?, error = ?, updated_at = ? WHERE path = ?",
+                (STATUS_FAILED, error, time.time(), path),
+            )
+
+    def timeline(self, path: str) -> List[Tuple[float, str]]:
+        """Вердикты сэмплов файла в порядке времени: [(время, вердикт), ...]."""
+        return self.conn.execute(
+            "SELECT timestamp, verdict FROM archive_samples WHERE path = ? ORDER BY sample", (path,)
+        ).fetchall()
+
+    def positive_segments(self, path: str, interval: float) -> List[Tuple[float, float]]:
+        """
+        Интервалы времени (начало, конец) с курением: подряд идущие сэмплы "Yes"
+        объединяются, каждый сэмпл покрывает interval секунд.
+        """
+        segments: List[Tuple[float, float]] = []
+        for timestamp, verdict in self.timeline(path):
+            if verdict != "Yes":
+                continue
+            if segments and timestamp - segments[-1][1] <= interval * 0.5:
+                segments[-1] = (segments[-1][0], timestamp + interval)
+            else:
+                segments.append((timestamp, timestamp + interval))
+        return segments
+
+    def files(self, status: Optional[str] = None, verdict: Optional[str] = None,
+              prefix: Optional[str] = None) -> List[dict]:
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if verdict:
+            conditions.append("verdict = ?")
+            params.append(verdict)
+        if prefix:
+            conditions.append("path LIKE ? ESCAPE '\\'")
+            params.append(prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.conn.execute(
+            f"SELECT {', '.join(FILE_COLUMNS)} FROM archive_files {where} ORDER BY path", params
+        ).fetchall()
+        return [dict(zip(FILE_COLUMNS, row)) for row in rows]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
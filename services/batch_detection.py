@@ -0,0 +1,255 @@
+"""
+Пакетная детекция курения на множестве фото.
+
+Фото принимаются отдельными файлами или архивами ZIP/tar (в том числе
+.tar.gz) и проходят конвейер: чтение -> декодирование и PNG кодирование
+(в пуле потоков) -> вызовы детектора, не более BATCH_CONCURRENCY одновременно.
+Вызовы детектора занимают слоты губернатора с низшим приоритетом ("batch:<id>")
+и расходуют бюджет вызовов, не занятый стримами, поэтому пакет не отнимает
+детектор у живых стримов.
+Результаты отдаются по мере готовности, не в порядке входа: у каждого есть
+index и name элемента.
+
+Память ограничена: архив читается по одному элементу, а между чтением и
+детекцией в очереди ждут не более BATCH_CONCURRENCY * 2 элементов, поэтому
+размер пакета не влияет на потребление памяти.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import tarfile
+import time
+import uuid
+import zipfile
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from fastapi import UploadFile
+
+from services.governor import governor
+from services.metrics import metrics
+from services.rate_control import rate_controller, BUDGET_POLL_INTERVAL
+from services.result_index import result_index, content_hash
+from utils import detect_smoking, normalize_verdict, DETECTOR_CONFIG_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Одновременных вызовов детектора в одном пакете
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Максимальное число фото в одном пакете
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+# Максимальный размер одного фото (байт); защищает от архивов-бомб
+BATCH_MAX_ITEM_BYTES = int(os.getenv("BATCH_MAX_ITEM_BYTES", str(20 * 1024 * 1024)))
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+ZIP_CONTENT_TYPES = {"application/zip", "application/x-zip-compressed"}
+TAR_CONTENT_TYPES = {"application/x-tar", "application/gzip", "application/x-gzip", "application/x-gtar"}
+
+# Элемент пакета: (имя, содержимое или None, ошибка или None)
+BatchItem = Tuple[str, Optional[bytes], Optional[str]]
+
+
+def _archive_kind(upload: UploadFile) -> Optional[str]:
+    name = (upload.filename or "").lower()
+    if name.endswith(ZIP_SUFFIXES) or upload.content_type in ZIP_CONTENT_TYPES:
+        return "zip"
+    if name.endswith(TAR_SUFFIXES) or upload.content_type in TAR_CONTENT_TYPES:
+        return "tar"
+    return None
+
+
+def _skip_member(name: str) -> bool:
+    # Служебные файлы архиваторов macOS
+    base = name.rsplit("/", 1)[-1]
+    return name.startswith("__MACOSX/") or base.startswith("._") or base == ".DS_Store"
+
+
+def _too_large(name: str, size: int) -> Optional[BatchItem]:
+    if size > BATCH_MAX_ITEM_BYTES:
+        return name, None, f"File is larger than {BATCH_MAX_ITEM_BYTES} bytes"
+    return None
+
+
+def iter_upload_items(upload: UploadFile) -> Iterator[BatchItem]:
+    """
+    Фото одной загрузки: сам файл или элементы архива по одному.
+    Читает загрузку синхронно, поэтому вызывается из пула потоков.
+    """
+    kind = _archive_kind(upload)
+    upload.file.seek(0)
+    if kind == "zip":
+        try:
+            archive = zipfile.ZipFile(upload.file)
+        except zipfile.BadZipFile as e:
+            yield upload.filename or "", None, f"Invalid ZIP archive: {e}"
+            return
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir() or _skip_member(info.filename):
+                    continue
+                name = f"{upload.filename}/{info.filename}"
+                rejected = _too_large(name, info.file_size)
+                if rejected:
+                    yield rejected
+                    continue
+                try:
+                    yield name, archive.read(info), None
+                except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                    yield name, None, f"Could not read archive member: {e}"
+    elif kind == "tar":
+        try:
+            archive = tarfile.open(fileobj=upload.file, mode="r:*")
+        except tarfile.TarError as e:
+            yield upload.filename or "", None, f"Invalid tar archive: {e}"
+            return
+        with archive:
+            # Элементы читаются последовательно, без построения полного списка
+            for member in archive:
+                if not member.isfile() or _skip_member(member.name):
+                    continue
+                name = f"{upload.filename}/{member.name}"
+                rejected = _too_large(name, member.size)
+                if rejected:
+                    yield rejected
+                    continue
+                try:
+                    yield name, archive.extractfile(member).read(), None
+                except (tarfile.TarError, OSError) as e:
+                    yield name, None, f"Could not read archive member: {e}"
+    else:
+        data = upload.file.read(BATCH_MAX_ITEM_BYTES + 1)
+        name = upload.filename or ""
+        rejected = _too_large(name, len(data))
+        yield rejected or (name, data, None)
+
+
+def _preprocess(contents: bytes) -> Optional[str]:
+    """Декодирует фото и кодирует его в PNG base64 для детектора. None — не изображение."""
+    img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    _, buffer = cv2.imencode('.png', img)
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+async def _detect_item(batch_id: str, index: int, name: str, contents: Optional[bytes], error: Optional[str]) -> dict:
+    result = {"index": index, "name": name}
+    if error is not None:
+        result["error"] = error
+        return result
+    if not contents:
+        result["error"] = "File is empty"
+        return result
+
+    photo_hash = content_hash(contents)
+    cached = result_index.get("photo", photo_hash, DETECTOR_CONFIG_VERSION)
+    if cached is not None:
+        result.update(verdict=cached["verdict"], deduplicated=True, timestamp=time.time())
+        return result
+
+    with metrics.stage("preprocess"):
+        b64_image = await asyncio.to_thread(_preprocess, contents)
+    if b64_image is None:
+        result["error"] = "Invalid image format"
+        return result
+
+    # Пакет расходует только бюджет, который не нужен стримам, и ждет слот детектора после них
+    while not rate_controller.try_background_call(time.time()):
+        await asyncio.sleep(BUDGET_POLL_INTERVAL)
+    async with governor.detector_slot(batch_id):
+        with metrics.stage("detector"):
+            verdict_raw = await asyncio.to_thread(detect_smoking, b64_image)
+    if verdict_raw is None:
+        result["error"] = "Failed to get response from AI model"
+        return result
+
+    verdict = normalize_verdict(verdict_raw)
+    result_index.put("photo", photo_hash, DETECTOR_CONFIG_VERSION, verdict, size=len(contents))
+    result.update(verdict=verdict, deduplicated=False, timestamp=time.time())
+    return result
+
+
+async def run_batch(uploads: List[UploadFile], concurrency: int = BATCH_CONCURRENCY) -> AsyncIterator[dict]:
+    """
+    Детекция на всех фото загрузок. Результаты отдаются по мере готовности,
+    последним — итог пакета ({"summary": {...}}).
+
+    Args:
+        uploads: Загруженные файлы (фото или архивы)
+        concurrency: Число одновременных вызовов детектора
+
+    Yields:
+        {"index", "name", "verdict", "deduplicated", "timestamp"} или {"index", "name", "error"}
+    """
+    started = time.perf_counter()
+    batch_id = f"batch:{uuid.uuid4().hex[:8]}"
+    items: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results: asyncio.Queue = asyncio.Queue()
+    summary = {"total": 0, "yes": 0, "no": 0, "deduplicated": 0, "errors": 0}
+
+    async def produce():
+        index = 0
+        try:
+            for upload in uploads:
+                iterator = iter_upload_items(upload)
+                while True:
+                    with metrics.stage("decode"):
+                        item = await asyncio.to_thread(next, iterator, None)
+                    if item is None:
+                        break
+                    if index >= BATCH_MAX_ITEMS:
+                        await results.put({"index": index, "name": item[0], "error": f"Batch is limited to {BATCH_MAX_ITEMS} files"})
+                        return
+                    await items.put((index, *item))
+                    index += 1
+        finally:
+            for _ in range(concurrency):
+                await items.put(None)
+
+    async def work():
+        while True:
+            item = await items.get()
+            if item is None:
+                break
+            try:
+                result = await _detect_item(batch_id, *item)
+            except Exception as e:
+                logger.exception("Ошибка пакетной детекции для %s", item[1])
+                result = {"index": item[0], "name": item[1], "error": str(e)}
+            await results.put(result)
+
+    async def run():
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+        finally:
+            await results.put(None)
+
+    runner = asyncio.create_task(run())
+    try:
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            summary["total"] += 1
+            if "error" in result:
+                summary["errors"] += 1
+            else:
+                summary["yes" if result["verdict"] == "Yes" else "no"] += 1
+                summary["deduplicated"] += result["deduplicated"]
+            yield result
+        await runner
+    finally:
+        # Клиент отключился: останавливаем чтение и детекцию
+        if not runner.done():
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+        for upload in uploads:
+            await upload.close()
+
+    summary["elapsed"] = round(time.perf_counter() - started, 3)
+    logger.info("Пакетная детекция завершена: %s", summary)
+    yield {"summary": summary}
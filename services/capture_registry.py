@@ -0,0 +1,158 @@
+"""
+Общий захват видео для стримов, открытых по одному и тому же URL источника.
+
+Когда несколько дашбордов открывают одну камеру, каждый вызов
+/stream/open-stream-url получает свой stream_id, но декодирование, запись,
+детекция и кодирование кадра для MJPEG выполняются один раз. Захват
+идентифицируется stream_id первой сессии (capture_id): под ним учитываются
+ресурсы в губернаторе, контроллере частоты детекции, трекере и метриках.
+Кадры и результаты детекции раздаются всем подписанным сессиям, а захват
+останавливается, когда уходит последний подписчик.
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Порты по умолчанию, которые не различают источники
+DEFAULT_PORTS = {"http": 80, "https": 443, "rtsp": 554}
+
+
+def normalize_source_url(url: str) -> str:
+    """
+    Приводит URL источника к каноническому виду для поиска общего захвата.
+
+    Схема и хост приводятся к нижнему регистру, порт по умолчанию, фрагмент и
+    префикс blob: отбрасываются, параметры запроса сортируются. Локальные пути
+    становятся абсолютными.
+    """
+    url = url.strip()
+    if url.startswith("blob:"):
+        url = url[len("blob:"):]
+    parts = urlsplit(url)
+    if not parts.scheme or len(parts.scheme) == 1:
+        # Локальный файл (в том числе путь Windows вида C:\...)
+        return os.path.normcase(os.path.abspath(url))
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        credentials = parts.username + (f":{parts.password}" if parts.password else "")
+        host = f"{credentials}@{host}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+class SharedCapture:
+    """Захват одного источника и подписанные на него сессии."""
+
+    def __init__(self, key: str, capture_id: str):
+        self.key = key
+        self.capture_id = capture_id
+        self.subscribers: List[str] = [capture_id]
+        self.status = "initializing"
+        self.error: Optional[str] = None
+        # Часы захвата ("source" или "wall"), известны после открытия источника
+        self.clock: Optional[str] = None
+        self.created_at = time.time()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.subscribers)
+
+
+class CaptureRegistry:
+    """Реестр общих захватов по нормализованному URL источника."""
+
+    def __init__(self):
+        self.captures: Dict[str, SharedCapture] = {}
+        # Формат: { stream_id: захват, на который подписан стрим }
+        self._by_stream: Dict[str, SharedCapture] = {}
+        # Формат: { capture_id: захват }. Захват живет дольше сессии, которая его создала
+        self._by_capture: Dict[str, SharedCapture] = {}
+
+    def acquire(self, url: str, stream_id: str) -> SharedCapture:
+        """
+        Подписывает стрим на захват источника, создавая захват при необходимости.
+        Если capture.capture_id == stream_id, захват новый и его нужно запустить.
+        """
+        key = normalize_source_url(url)
+        capture = self.captures.get(key)
+        if capture is None or not capture.active:
+            capture = self.captures[key] = self._by_capture[stream_id] = SharedCapture(key, stream_id)
+        elif stream_id not in capture.subscribers:
+            capture.subscribers.append(stream_id)
+        self._by_stream[stream_id] = capture
+        return capture
+
+    def release(self, stream_id: str) -> Optional[SharedCapture]:
+        """
+        Отписывает стрим от захвата. Возвращает захват или None, если стрим не был подписан.
+        Захват без подписчиков удаляется из реестра, а его цикл обработки завершается.
+        """
+        capture = self._by_stream.pop(stream_id, None)
+        if capture is None:
+            return None
+        if stream_id in capture.subscribers:
+            capture.subscribers.remove(stream_id)
+        if not capture.active:
+            if self.captures.get(capture.key) is capture:
+                del self.captures[capture.key]
+            self._by_capture.pop(capture.capture_id, None)
+        return capture
+
+    def close(self, capture: SharedCapture) -> List[str]:
+        """
+        Удаляет остановленный захват (источник закончился или не открылся) вместе с подписками.
+        Возвращает стримы, которые были на него подписаны.
+        """
+        subscribers, capture.subscribers = capture.subscribers, []
+        for stream_id in subscribers:
+            if self._by_stream.get(stream_id) is capture:
+                del self._by_stream[stream_id]
+        if self.captures.get(capture.key) is capture:
+            del self.captures[capture.key]
+        self._by_capture.pop(capture.capture_id, None)
+        return subscribers
+
+    def get(self, stream_id: str) -> Optional[SharedCapture]:
+        return self._by_stream.get(stream_id)
+
+    def subscribers(self, stream_id: str) -> List[str]:
+        """
+        Стримы, которым раздаются кадры и результаты захвата stream_id.
+        Для стрима без общего захвата (WebSocket стрим) — только он сам.
+        """
+        capture = self._by_capture.get(stream_id)
+        if capture is None:
+            return [stream_id]
+        return list(capture.subscribers)
+
+    def set_status(self, capture: SharedCapture, status: str, sessions: Dict[str, dict], error: Optional[str] = None):
+        """Обновляет статус захвата и всех подписанных сессий."""
+        capture.status = status
+        if error is not None:
+            capture.error = error
+        for stream_id in capture.subscribers:
+            session = sessions.get(stream_id)
+            if session is not None:
+                session["status"] = status
+                if error is not None:
+                    session["error"] = error
+
+    def describe(self, stream_id: str) -> Optional[dict]:
+        capture = self._by_stream.get(stream_id)
+        if capture is None:
+            return None
+        return {
+            "capture_id": capture.capture_id,
+            "subscribers": len(capture.subscribers),
+            "clock": capture.clock,
+        }
+
+
+# Глобальный реестр захватов
+capture_registry = CaptureRegistry()
@@ -0,0 +1,244 @@
+"""
+Постоянное хранилище событий детекции (SQLite в режиме WAL).
+
+Вердикты детекции и события треков, которые рассылаются клиентам стримов,
+дописываются в таблицу events, чтобы по ним можно было строить историю,
+тепловые карты и отчеты без повторной обработки видео.
+
+Запись не блокирует обработку кадров: append() кладет событие в очередь,
+а поток-писатель забирает события пачками (до EVENT_BATCH_SIZE или раз в
+EVENT_FLUSH_INTERVAL секунд) и записывает каждую пачку одной транзакцией.
+Если очередь переполнена (диск не успевает), событие отбрасывается и
+учитывается в счетчике dropped. WAL позволяет читать базу параллельно с
+записью: запросы выполняются на отдельных соединениях в пуле потоков.
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Путь к базе событий
+EVENT_STORE_PATH = os.getenv("EVENT_STORE_PATH", "events.db")
+# Максимальный размер пачки записи
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+# Максимальная задержка записи события (секунды)
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "0.5"))
+# Емкость очереди событий, ожидающих записи
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+
+# Колонки таблицы; остальные поля события сохраняются в payload (JSON)
+EVENT_COLUMNS = ("timestamp", "stream_id", "type", "verdict", "event", "track_id",
+                 "frame_number", "media_time", "lat", "lng")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    stream_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    verdict TEXT,
+    event TEXT,
+    track_id INTEGER,
+    frame_number INTEGER,
+    media_time REAL,
+    lat REAL,
+    lng REAL,
+    payload TEXT
+);
+CREATE INDEX IF NOT EXISTS events_stream_time ON events (stream_id, timestamp);
+CREATE INDEX IF NOT EXISTS events_time ON events (timestamp);
+CREATE INDEX IF NOT EXISTS events_location ON events (lat, lng) WHERE lat IS NOT NULL;
+"""
+
+# Признак остановки писателя в очереди
+_STOP = object()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class EventStore:
+    """Дописываемое хранилище событий с пакетной записью в отдельном потоке."""
+
+    def __init__(self, path: str = EVENT_STORE_PATH, batch_size: int = EVENT_BATCH_SIZE,
+                 flush_interval: float = EVENT_FLUSH_INTERVAL, queue_size: int = EVENT_QUEUE_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        """Создает схему и запускает поток-писатель. Повторные вызовы ничего не делают."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            conn = _connect(self.path)
+            conn.executescript(SCHEMA)
+            conn.close()
+            self._thread = threading.Thread(target=self._run, name="event-store-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Дописывает события из очереди и останавливает поток-писатель."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join()
+        self._thread = None
+
+    def append(self, event: dict):
+        """
+        Ставит событие в очередь записи. Не блокирует: при переполненной очереди событие отбрасывается.
+        Событие должно содержать stream_id, type и timestamp.
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(self._row(event))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Очередь записи событий переполнена, событие отброшено", extra={"rate_limit": 5.0})
+
+    @staticmethod
+    def _row(event: dict) -> tuple:
+        extra = {key: value for key, value in event.items() if key not in EVENT_COLUMNS}
+        return tuple(event.get(column) for column in EVENT_COLUMNS) + (json.dumps(extra) if extra else None,)
+
+    def _run(self):
+        conn = _connect(self.path)
+        insert = f"INSERT INTO events ({', '.join(EVENT_COLUMNS)}, payload) VALUES ({', '.join('?' * (len(EVENT_COLUMNS) + 1))})"
+        stopping = False
+        try:
+            while not stopping:
+                try:
+                    first = self._queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                item = first
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                if not batch:
+                    continue
+                try:
+                    with conn:
+                        conn.executemany(insert, batch)
+                    self.written += len(batch)
+                except sqlite3.Error as e:
+                    self.dropped += len(batch)
+                    logger.error("Ошибка записи %d событий: %s", len(batch), e)
+        finally:
+            conn.close()
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              stream_id: Optional[str] = None, verdict: Optional[str] = None, event_type: Optional[str] = None,
+              bbox: Optional[Tuple[float, float, float, float]] = None,
+              after: Optional[Tuple[float, int]] = None, limit: Optional[int] = None) -> Iterator[dict]:
+        """
+        События по фильтрам в порядке времени. Выполняется синхронно (вызывать из пула потоков).
+
+        Args:
+            start, end: Интервал времени [start, end)
+            stream_id: ID стрима
+            verdict: Вердикт детекции (Yes/No)
+            event_type: Тип события (smoking_detection, smoking_event)
+            bbox: Область камер (min_lat, min_lng, max_lat, max_lng)
+            after: Курсор (timestamp, id) последнего события предыдущей страницы
+            limit: Максимальное количество событий
+
+        Yields:
+            События с полями id, timestamp, stream_id, type, ... и полями из payload
+        """
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        if stream_id is not None:
+            conditions.append("stream_id = ?")
+            params.append(stream_id)
+        if verdict is not None:
+            conditions.append("verdict = ?")
+            params.append(verdict)
+        if event_type is not None:
+            conditions.append("type = ?")
+            params.append(event_type)
+        if bbox is not None:
+            conditions.append("lat IS NOT NULL AND lat BETWEEN ? AND ? AND lng BETWEEN ? AND ?")
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        if after is not None:
+            conditions.append("(timestamp > ? OR (timestamp = ? AND id > ?))")
+            params.extend([after[0], after[0], after[1]])
+        sql = f"SELECT id, {', '.join(EVENT_COLUMNS)}, payload FROM events"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        conn = _connect(self.path)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._event(row)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _event(row: tuple) -> dict:
+        event = {"id": row[0]}
+        for column, value in zip(EVENT_COLUMNS, row[1:]):
+            if value is not None:
+                event[column] = value
+        if row[-1]:
+            event.update(json.loads(row[-1]))
+        return event
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "written": self.written,
+            "pending": self.pending,
+            "dropped": self.dropped,
+        }
+
+
+# Глобальное хранилище событий
+event_store = EventStore()
@@ -0,0 +1,268 @@
+"""
+Контроль допуска стримов и справедливое распределение детектора.
+
+Каждый URL стрим — это отдельная задача, которая декодирует, кодирует и
+записывает кадры, поэтому без ограничения сервер деградирует для всех сразу.
+Губернатор:
+- допускает не больше MAX_STREAMS стримов и не допускает новые, пока
+  суммарная загрузка декодированием превышает доступные ядра; URL стримы
+  сверх лимита ждут в очереди, остальные запросы отклоняются;
+- выдает слоты детектора (не больше DETECTOR_CONCURRENCY одновременных
+  вызовов AI модели) по взвешенному циклическому алгоритму, чтобы одна
+  загруженная камера не занимала детектор целиком. Вызовы без допущенного
+  стрима (пакетная детекция фото, "batch:<id>") получают слот с низшим
+  приоритетом: только когда его не ждет ни один стрим.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+# Максимальное количество одновременно обрабатываемых стримов
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "16"))
+
+# Максимальное количество URL стримов, ожидающих допуска
+MAX_QUEUED_STREAMS = int(os.getenv("MAX_QUEUED_STREAMS", "8"))
+
+# Количество одновременных вызовов AI модели
+DETECTOR_CONCURRENCY = int(os.getenv("DETECTOR_CONCURRENCY", "4"))
+
+# Доля ядер, которую могут занимать циклы декодирования стримов
+DECODE_LOAD_LIMIT = float(os.getenv("DECODE_LOAD_LIMIT", "0.9")) * (os.cpu_count() or 1)
+
+# Окно усреднения загрузки декодированием (секунды)
+LOAD_WINDOW = 5.0
+
+
+class CapacityError(Exception):
+    """Сервер не может принять новый стрим."""
+
+
+class StreamSlot:
+    """Учет ресурсов одного стрима."""
+
+    __slots__ = ("weight", "admitted", "admitted_event", "queued_at", "load", "busy", "window_start", "detector_calls", "current_weight")
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.admitted = False
+        self.admitted_event = asyncio.Event()
+        self.queued_at = time.time()
+        # Загрузка декодированием: секунды обработки кадров на секунду реального времени
+        self.load = 0.0
+        self.busy = 0.0
+        self.window_start = time.time()
+        self.detector_calls = 0
+        # Текущий вес для взвешенного циклического выбора
+        self.current_weight = 0.0
+
+
+class ResourceGovernor:
+    """Допуск стримов и распределение слотов детектора."""
+
+    def __init__(self, max_streams: int = MAX_STREAMS, max_queued: int = MAX_QUEUED_STREAMS,
+                 detector_concurrency: int = DETECTOR_CONCURRENCY, decode_load_limit: float = DECODE_LOAD_LIMIT):
+        self.max_streams = max_streams
+        self.max_queued = max_queued
+        self.detector_concurrency = detector_concurrency
+        self.decode_load_limit = decode_load_limit
+        self.streams: Dict[str, StreamSlot] = {}
+        # Очередь URL стримов, ожидающих допуска (FIFO)
+        self.pending: Deque[str] = deque()
+        self.detector_free = detector_concurrency
+        # Ожидающие слота детектора: { stream_id: deque[Future] }
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+
+    # ------------------------------------------------------------------
+    # Допуск стримов
+    # ------------------------------------------------------------------
+
+    @property
+    def admitted_count(self) -> int:
+        return sum(1 for slot in self.streams.values() if slot.admitted)
+
+    @property
+    def decode_load(self) -> float:
+        return sum(slot.load for slot in self.streams.values() if slot.admitted)
+
+    def _has_capacity(self) -> bool:
+        return self.admitted_count < self.max_streams and self.decode_load < self.decode_load_limit
+
+    def admit(self, stream_id: str, weight: float = 1.0, allow_queue: bool = False) -> bool:
+        """
+        Регистрирует стрим.
+
+        Returns:
+            bool: True, если стрим допущен сразу, False — если поставлен в очередь
+
+        Raises:
+            CapacityError: Нет свободной емкости и очередь недоступна или заполнена
+        """
+        if stream_id in self.streams:
+            return self.streams[stream_id].admitted
+
+        slot = StreamSlot(weight)
+        if not self.pending and self._has_capacity():
+            slot.admitted = True
+            slot.admitted_event.set()
+            self.streams[stream_id] = slot
+            return True
+
+        if not allow_queue:
+            raise CapacityError(f"Server is at capacity: {self.admitted_count}/{self.max_streams} streams, decode load {self.decode_load:.2f}")
+        if len(self.pending) >= self.max_queued:
+            raise CapacityError(f"Stream queue is full: {len(self.pending)}/{self.max_queued} streams waiting")
+
+        self.streams[stream_id] = slot
+        self.pending.append(stream_id)
+        return False
+
+    def is_admitted(self, stream_id: str) -> bool:
+        slot = self.streams.get(stream_id)
+        return slot is not None and slot.admitted
+
+    async def wait_admitted(self, stream_id: str):
+        slot = self.streams.get(stream_id)
+        if slot is not None:
+            await slot.admitted_event.wait()
+
+    def queue_position(self, stream_id: str) -> Optional[int]:
+        try:
+            return self.pending.index(stream_id) + 1
+        except ValueError:
+            return None
+
+    def release(self, stream_id: str):
+        """Освобождает ресурсы стрима и допускает следующие стримы из очереди."""
+        slot = self.streams.pop(stream_id, None)
+        if slot is None:
+            return
+        if not slot.admitted:
+            self.pending.remove(stream_id)
+        # Будим ожидающих слот детектора, чтобы они не висели после закрытия стрима
+        for future in self._waiters.pop(stream_id, ()):
+            if not future.done():
+                future.cancel()
+        self._promote()
+
+    def _promote(self):
+        while self.pending and self._has_capacity():
+            slot = self.streams[self.pending.popleft()]
+            slot.admitted = True
+            slot.admitted_event.set()
+
+    def record_load(self, stream_id: str, seconds: float, timestamp: Optional[float] = None):
+        """Учитывает время обработки кадра стрима (декодирование, кодирование, запись)."""
+        slot = self.streams.get(stream_id)
+        if slot is None:
+            return
+        slot.busy += seconds
+        timestamp = time.time() if timestamp is None else timestamp
+        elapsed = timestamp - slot.window_start
+        if elapsed >= LOAD_WINDOW:
+            slot.load = slot.busy / elapsed
+            slot.busy = 0.0
+            slot.window_start = timestamp
+            self._promote()
+
+    # ------------------------------------------------------------------
+    # Слоты детектора
+    # ------------------------------------------------------------------
+
+    def _next_waiter(self) -> Optional[str]:
+        """
+        Плавный взвешенный циклический выбор (как в nginx) среди ожидающих стримов.
+        Ожидающие без допущенного стрима выбираются по очереди, только если стримов среди ожидающих нет.
+        """
+        candidates: List[str] = [stream_id for stream_id, waiters in self._waiters.items() if waiters]
+        if not candidates:
+            return None
+        total = 0.0
+        best = None
+        for stream_id in candidates:
+            slot = self.streams.get(stream_id)
+            if slot is not None:
+                slot.current_weight += slot.weight
+                total += slot.weight
+                if best is None or slot.current_weight > self.streams[best].current_weight:
+                    best = stream_id
+        if best is None:
+            return candidates[0]
+        self.streams[best].current_weight -= total
+        return best
+
+    async def acquire_detector(self, stream_id: str):
+        if self.detector_free > 0 and not any(self._waiters.values()):
+            self.detector_free -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(stream_id, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                waiters = self._waiters.get(stream_id)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiters[stream_id]
+                elif future.done() and not future.cancelled():
+                    # Слот уже был выдан — возвращаем его
+                    self.release_detector()
+                raise
+        slot = self.streams.get(stream_id)
+        if slot is not None:
+            slot.detector_calls += 1
+
+    def release_detector(self):
+        while True:
+            stream_id = self._next_waiter()
+            if stream_id is None:
+                self.detector_free += 1
+                return
+            future = self._waiters[stream_id].popleft()
+            if not self._waiters[stream_id]:
+                del self._waiters[stream_id]
+            if not future.done():
+                future.set_result(None)
+                return
+
+    @asynccontextmanager
+    async def detector_slot(self, stream_id: str):
+        """Слот детектора на время одного вызова AI модели."""
+        await self.acquire_detector(stream_id)
+        try:
+            yield
+        finally:
+            self.release_detector()
+
+    def detector_waiting(self) -> Dict[str, int]:
+        """Количество вызовов детектора, ожидающих слота, по стримам."""
+        return {stream_id: len(waiters) for stream_id, waiters in self._waiters.items() if waiters}
+
+    def report(self) -> dict:
+        return {
+            "max_streams": self.max_streams,
+            "admitted_streams": self.admitted_count,
+            "queued_streams": list(self.pending),
+            "decode_load": round(self.decode_load, 3),
+            "decode_load_limit": round(self.decode_load_limit, 3),
+            "detector_concurrency": self.detector_concurrency,
+            "detector_in_use": self.detector_concurrency - self.detector_free,
+            "detector_waiting": self.detector_waiting(),
+            "streams": {
+                stream_id: {
+                    "admitted": slot.admitted,
+                    "weight": slot.weight,
+                    "decode_load": round(slot.load, 3),
+                    "detector_calls": slot.detector_calls,
+                }
+                for stream_id, slot in self.streams.items()
+            },
+        }
+
+
+# Глобальный губернатор ресурсов
+governor = ResourceGovernor()
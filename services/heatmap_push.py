@@ -0,0 +1,214 @@
+"""
+Push-рассылка изменений тепловой карты подписанным дашбордам.
+
+Вместо опроса /api/heatmap-data каждые 2 секунды каждая вкладка держит одно
+SSE соединение и получает только изменившиеся ячейки. Изменения копятся и
+рассылаются не чаще одного раза за HEATMAP_PUSH_INTERVAL секунд; одинаковые
+сообщения для подписчиков с одинаковыми параметрами сериализуются один раз.
+Снимки и изменения фильтруются по области просмотра подписчика, поэтому
+дашборд получает только видимые ячейки, а не весь уровень.
+"""
+
+import asyncio
+import json
+import os
+from typing import Dict, Optional, Set, Tuple
+
+from services.heatmap_store import HeatmapStore, heatmap_store
+
+# Интервал объединения изменений перед рассылкой (секунды)
+HEATMAP_PUSH_INTERVAL = float(os.getenv("HEATMAP_PUSH_INTERVAL", "1.0"))
+
+# Сколько неотправленных сообщений может накопиться у одного подписчика.
+# При переполнении очередь сбрасывается, и подписчик получает полный снимок.
+PUSH_QUEUE_SIZE = 16
+
+
+def format_sse(event: str, data: bytes) -> bytes:
+    """Формирует сообщение в формате Server-Sent Events."""
+    return b"event: " + event.encode("ascii") + b"\ndata: " + data + b"\n\n"
+
+
+def point_in_bbox(point: dict, bbox: Tuple[float, float, float, float]) -> bool:
+    """Попадает ли ячейка в область просмотра (west, south, east, north)."""
+    west, south, east, north = bbox
+    return south <= point["lat"] <= north and west <= point["lng"] <= east
+
+
+class HeatmapSubscription:
+    """Подписка одного дашборда на изменения уровня сетки и временного окна в области просмотра."""
+
+    def __init__(self, level: int, window: Optional[str], since: Optional[int],
+                 bbox: Optional[Tuple[float, float, float, float]] = None):
+        self.level = level
+        self.window = window
+        # Область просмотра (west, south, east, north); None — весь мир
+        self.bbox = bbox
+        # Версия хранилища, до которой подписчик уже получил данные (только для окна "все время")
+        self.version = since
+        # Подписчику нужен полный снимок (первое сообщение или переполнение очереди)
+        self.needs_full = since is None or window is not None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=PUSH_QUEUE_SIZE)
+
+    def offer(self, message: bytes):
+        """Кладет сообщение в очередь; при переполнении запрашивает полный снимок."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.needs_full = True
+
+
+class HeatmapBroadcaster:
+    """
+    Фоновая задача, которая раз в интервал рассылает подписчикам изменения.
+
+    Для окна "все время" изменения берутся из журнала хранилища (changes_since).
+    Для временных окон значения ячеек меняются и без новых событий, поэтому
+    текущий снимок окна сравнивается с предыдущим и рассылается разница.
+    """
+
+    def __init__(self, store: HeatmapStore, interval: float = HEATMAP_PUSH_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.subscribers: Set[HeatmapSubscription] = set()
+        # Последние разосланные снимки временных окон
+        # Формат: { (level, window): (версия, номер корзины окна, { id: точка }) }
+        self._window_state: Dict[Tuple[int, str], Tuple[int, int, Dict[str, dict]]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, level: int, window: Optional[str] = None, since: Optional[int] = None,
+                  bbox: Optional[Tuple[float, float, float, float]] = None) -> HeatmapSubscription:
+        subscription = HeatmapSubscription(level, window, since, bbox)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: HeatmapSubscription):
+        self.subscribers.discard(subscription)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.subscribers:
+                self.publish()
+
+    def publish(self):
+        """Рассылает накопленные изменения всем подписчикам."""
+        # Содержимое сообщений в пределах одного тика: { ключ: (событие, данные) или None }
+        payloads: Dict[tuple, Optional[Tuple[str, dict]]] = {}
+        # Сериализованные сообщения: { (ключ, область просмотра): bytes }
+        messages: Dict[tuple, Optional[bytes]] = {}
+        windows_in_use = set()
+
+        for subscription in list(self.subscribers):
+            if subscription.window is None:
+                key = self._all_time_message(subscription, payloads)
+            else:
+                windows_in_use.add((subscription.level, subscription.window))
+                key = self._window_message(subscription, payloads)
+            if key is None:
+                continue
+            message = self._encode(key, subscription.bbox, payloads, messages)
+            if message is not None:
+                subscription.offer(message)
+
+        # Снимки окон, на которые больше никто не подписан, не храним
+        for key in list(self._window_state):
+            if key not in windows_in_use:
+                del self._window_state[key]
+
+    @staticmethod
+    def _encode(key: tuple, bbox: Optional[Tuple[float, float, float, float]],
+                payloads: Dict[tuple, Optional[Tuple[str, dict]]], messages: Dict[tuple, Optional[bytes]]) -> Optional[bytes]:
+        """Сериализует сообщение для области просмотра; пустая разница для области не отправляется."""
+        cache_key = (key, bbox)
+        if cache_key not in messages:
+            event, payload = payloads[key]
+            if bbox is not None:
+                payload = {**payload, "points": [point for point in payload["points"] if point_in_bbox(point, bbox)]}
+            if event == "delta" and not payload["points"] and not payload["removed"]:
+                messages[cache_key] = None
+            else:
+                messages[cache_key] = format_sse(event, json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        return messages[cache_key]
+
+    def _full_message(self, level: int, window: Optional[str], payloads: Dict[tuple, Optional[Tuple[str, dict]]]) -> tuple:
+        key = ("full", level, window)
+        if key not in payloads:
+            version, points = self.store.snapshot(level=level, window=window)
+            payloads[key] = ("snapshot", {"version": version, "points": points, "removed": []})
+        return key
+
+    def _all_time_message(self, subscription: HeatmapSubscription, payloads: Dict[tuple, Optional[Tuple[str, dict]]]) -> Optional[tuple]:
+        version = self.store.version
+        if subscription.needs_full:
+            subscription.needs_full = False
+            subscription.version = version
+            return self._full_message(subscription.level, None, payloads)
+
+        if subscription.version == version:
+            return None
+
+        key = ("delta", subscription.level, subscription.version)
+        if key not in payloads:
+            version, points = self.store.changes_since(subscription.version, level=subscription.level)
+            if points is None:
+                payloads[key] = payloads[self._full_message(subscription.level, None, payloads)]
+            else:
+                payloads[key] = ("delta", {"version": version, "points": points, "removed": []})
+        subscription.version = version
+        return key
+
+    def _window_message(self, subscription: HeatmapSubscription, payloads: Dict[tuple, Optional[Tuple[str, dict]]]) -> Optional[tuple]:
+        state_key = (subscription.level, subscription.window)
+        key = ("window", subscription.level, subscription.window)
+        if key not in payloads:
+            payloads[key] = self._window_delta(subscription.level, subscription.window)
+
+        if subscription.needs_full:
+            subscription.needs_full = False
+            version, stamp, points = self._window_state[state_key]
+            full_key = ("window-full", subscription.level, subscription.window)
+            if full_key not in payloads:
+                payloads[full_key] = ("snapshot", {"version": version, "points": list(points.values()), "removed": []})
+            return full_key
+        return key if payloads[key] is not None else None
+
+    def _window_delta(self, level: int, window: str) -> Optional[Tuple[str, dict]]:
+        """Пересчитывает снимок окна при смене версии или корзины и возвращает разницу."""
+        state_key = (level, window)
+        stamp = self.store.window_stamp(window)
+        previous = self._window_state.get(state_key)
+        if previous is not None and previous[0] == self.store.version and previous[1] == stamp:
+            return None
+
+        version, points = self.store.snapshot(level=level, window=window)
+        current = {point["id"]: point for point in points}
+        self._window_state[state_key] = (version, stamp, current)
+        if previous is None:
+            return None
+
+        old_points = previous[2]
+        changed = [point for point_id, point in current.items() if old_points.get(point_id) != point]
+        removed = [point_id for point_id in old_points if point_id not in current]
+        if not changed and not removed:
+            return None
+        return "delta", {"version": version, "points": changed, "removed": removed}
+
+
+# Глобальный рассыльщик изменений тепловой карты
+heatmap_broadcaster = HeatmapBroadcaster(heatmap_store)
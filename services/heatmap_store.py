@@ -0,0 +1,457 @@
+"""
+Хранилище тепловой карты в памяти.
+Принимает события детекции инкрементально и отдает предагрегированные ячейки сетки,
+чтобы эндпоинты тепловой карты не перечитывали data.json на каждый запрос.
+
+Ячейки образуют квадродерево тайлов Web Mercator: ячейка (x, y) уровня L
+является родителем ячеек (2x..2x+1, 2y..2y+1) уровня L+1. Агрегаты всех уровней
+обновляются при добавлении точки, поэтому запрос по области просмотра на любом
+масштабе читает готовые ячейки и не обходит исходные точки.
+
+Для временных окон ("hour", "day", "week") каждая ячейка хранит кольцевые
+массивы корзин по минутам и по часам и скользящие суммы окон. Добавление
+события и сдвиг окна стоят O(1) амортизированно, запрос окна не просматривает
+исходные события.
+"""
+
+import json
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Самый детальный уровень сетки в терминах тайлов Web Mercator (zoom).
+# На широте Сочи ячейка 20-го уровня — примерно 28x28 метров.
+GRID_LEVEL = 20
+
+# Самый грубый уровень сетки, для которого хранятся агрегаты
+MIN_LEVEL = 0
+
+# Смещение уровня ячеек относительно zoom карты: ячейка уровня zoom+3 занимает
+# 32x32 пикселя на экране, что соответствует радиусу точки Leaflet.heat
+CELL_ZOOM_OFFSET = 3
+
+# Количество закэшированных ответов для областей просмотра
+VIEWPORT_CACHE_SIZE = 256
+
+# Сколько последних изменений ячеек хранить для ответов на запросы с since=
+CHANGE_LOG_SIZE = 10000
+
+# Граница широты для проекции Web Mercator
+MAX_LATITUDE = 85.05112878
+
+# Кольцо минутных корзин (окно "hour") и кольцо часовых корзин (окна "day" и "week")
+MINUTE_BUCKETS = 60
+HOUR_BUCKETS = 168
+
+# Временные окна: имя -> (индекс скользящей суммы, разрешение окна в секундах)
+WINDOWS = {
+    "hour": (0, 60),
+    "day": (1, 3600),
+    "week": (2, 3600),
+}
+
+# Как часто освобождать кольца ячеек без событий за последнюю неделю (секунды)
+COMPACT_INTERVAL = 600
+
+
+def latlng_to_cell(lat: float, lng: float, level: int) -> Tuple[int, int]:
+    """
+    Переводит координаты в индекс ячейки сетки (x, y) заданного уровня.
+
+    Args:
+        lat: Широта
+        lng: Долгота
+        level: Уровень сетки (zoom)
+
+    Returns:
+        tuple: Индексы ячейки (x, y)
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    n = 1 << level
+    sin_lat = math.sin(math.radians(lat))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def zoom_to_level(zoom: int) -> int:
+    """Возвращает уровень ячеек сетки для масштаба карты."""
+    return max(MIN_LEVEL, min(GRID_LEVEL, zoom + CELL_ZOOM_OFFSET))
+
+
+class RollingCounter:
+    """
+    Скользящие суммы интенсивности за последний час, сутки и неделю.
+
+    Корзины хранятся в кольцевых массивах; при сдвиге головы кольца значения
+    выпадающих корзин вычитаются из сумм окон, поэтому сумма окна всегда готова.
+    """
+
+    __slots__ = ("minutes", "minute_head", "hours", "hour_head", "totals")
+
+    def __init__(self):
+        self.minutes = array("d", bytes(8 * MINUTE_BUCKETS))
+        self.hours = array("d", bytes(8 * HOUR_BUCKETS))
+        self.minute_head: Optional[int] = None
+        self.hour_head: Optional[int] = None
+        # Скользящие суммы: [час, сутки, неделя]
+        self.totals = array("d", [0.0, 0.0, 0.0])
+
+    def advance(self, timestamp: float):
+        """Сдвигает кольца к моменту timestamp, вычитая выпавшие корзины."""
+        minute = int(timestamp // 60)
+        if self.minute_head is None:
+            self.minute_head = minute
+        elif minute > self.minute_head:
+            if minute - self.minute_head >= MINUTE_BUCKETS:
+                self.minutes = array("d", bytes(8 * MINUTE_BUCKETS))
+                self.totals[0] = 0.0
+            else:
+                for absolute in range(self.minute_head + 1, minute + 1):
+                    idx = absolute % MINUTE_BUCKETS
+                    self.totals[0] -= self.minutes[idx]
+                    self.minutes[idx] = 0.0
+            self.minute_head = minute
+
+        hour = int(timestamp // 3600)
+        if self.hour_head is None:
+            self.hour_head = hour
+        elif hour > self.hour_head:
+            if hour - self.hour_head >= HOUR_BUCKETS:
+                self.hours = array("d", bytes(8 * HOUR_BUCKETS))
+                self.totals[1] = self.totals[2] = 0.0
+            else:
+                for absolute in range(self.hour_head + 1, hour + 1):
+                    # Корзина absolute-24 выпадает из суточного окна,
+                    # корзина absolute-168 (тот же индекс кольца) — из недельного
+                    self.totals[1] -= self.hours[(absolute - 24) % HOUR_BUCKETS]
+                    idx = absolute % HOUR_BUCKETS
+                    self.totals[2] -= self.hours[idx]
+                    self.hours[idx] = 0.0
+            self.hour_head = hour
+
+        # Защита от накопления ошибки округления
+        for i in range(3):
+            if self.totals[i] < 1e-9:
+                self.totals[i] = 0.0
+
+    def add(self, timestamp: float, value: float):
+        """Учитывает событие в момент timestamp (допускаются опоздавшие события)."""
+        self.advance(timestamp)
+
+        minute = int(timestamp // 60)
+        if self.minute_head - minute < MINUTE_BUCKETS:
+            self.minutes[minute % MINUTE_BUCKETS] += value
+            self.totals[0] += value
+
+        hour = int(timestamp // 3600)
+        age = self.hour_head - hour
+        if age < HOUR_BUCKETS:
+            self.hours[hour % HOUR_BUCKETS] += value
+            self.totals[2] += value
+            if age < 24:
+                self.totals[1] += value
+
+
+class HeatmapCell:
+    """Агрегат одной ячейки сетки: центр масс точек и суммарная интенсивность."""
+
+    __slots__ = ("lat_sum", "lng_sum", "intensity", "count", "rolling", "last_event")
+
+    def __init__(self):
+        self.lat_sum = 0.0
+        self.lng_sum = 0.0
+        self.intensity = 0.0
+        self.count = 0
+        # Кольца временных окон создаются при первом событии с временной меткой
+        self.rolling: Optional[RollingCounter] = None
+        self.last_event = 0.0
+
+    def add(self, lat: float, lng: float, intensity: float, timestamp: Optional[float] = None):
+        self.lat_sum += lat
+        self.lng_sum += lng
+        self.intensity += intensity
+        self.count += 1
+        if timestamp is not None:
+            if self.rolling is None:
+                self.rolling = RollingCounter()
+            self.rolling.add(timestamp, intensity)
+            self.last_event = max(self.last_event, timestamp)
+
+    def to_point(self, key: Tuple[int, int]) -> dict:
+        return {
+            "id": f"{key[0]}:{key[1]}",
+            "lat": round(self.lat_sum / self.count, 6),
+            "lng": round(self.lng_sum / self.count, 6),
+            "intensity": round(self.intensity, 4),
+            "count": self.count,
+        }
+
+    def to_window_point(self, key: Tuple[int, int], window_idx: int, now: float) -> Optional[dict]:
+        """Возвращает точку со значением скользящего окна или None, если окно пустое."""
+        if self.rolling is None:
+            return None
+        self.rolling.advance(now)
+        value = self.rolling.totals[window_idx]
+        if value <= 0.0:
+            return None
+        return {
+            "id": f"{key[0]}:{key[1]}",
+            "lat": round(self.lat_sum / self.count, 6),
+            "lng": round(self.lng_sum / self.count, 6),
+            "intensity": round(value, 4),
+        }
+
+
+class HeatmapStore:
+    """
+    Инкрементальное хранилище точек тепловой карты.
+
+    Каждое добавление точки увеличивает версию хранилища. Версия используется
+    как ETag и как курсор для запросов изменений (since=), поэтому опрос
+    без новых событий не требует ни пересчета, ни сериализации.
+    """
+
+    def __init__(self, level: int = GRID_LEVEL, change_log_size: int = CHANGE_LOG_SIZE):
+        self.level = level
+        self.version = 0
+        # Агрегаты по уровням квадродерева
+        # Формат: { level: { (x, y): HeatmapCell } }
+        self._levels: Dict[int, Dict[Tuple[int, int], HeatmapCell]] = {
+            lvl: {} for lvl in range(MIN_LEVEL, level + 1)
+        }
+        # Журнал изменений: (версия, ключ ячейки самого детального уровня)
+        self._changes: deque = deque(maxlen=change_log_size)
+        # Минимальная версия, начиная с которой журнал изменений полон
+        self._min_since = 0
+        # Кэш сериализованного снимка: (версия, bytes)
+        self._snapshot_cache: Optional[Tuple[int, bytes]] = None
+        # LRU кэш ответов для областей просмотра
+        # Формат: { (level, x0, y0, x1, y1): (версия, bytes) }
+        self._viewport_cache: "OrderedDict[tuple, Tuple[int, bytes]]" = OrderedDict()
+        self._last_compact = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def etag(self) -> str:
+        return f'W/"heatmap-{self.version}"'
+
+    def _add_locked(self, lat: float, lng: float, intensity: float, timestamp: Optional[float]):
+        key = latlng_to_cell(lat, lng, self.level)
+        x, y = key
+        for lvl in range(self.level, MIN_LEVEL - 1, -1):
+            shift = self.level - lvl
+            cells = self._levels[lvl]
+            parent = (x >> shift, y >> shift)
+            cell = cells.get(parent)
+            if cell is None:
+                cell = cells[parent] = HeatmapCell()
+            cell.add(lat, lng, intensity, timestamp)
+        if len(self._changes) == self._changes.maxlen:
+            self._min_since = self._changes[0][0]
+        self._changes.append((self.version, key))
+
+    def _check_level(self, level: Optional[int]) -> int:
+        if level is None:
+            return self.level
+        if level not in self._levels:
+            raise ValueError(f"level must be between {MIN_LEVEL} and {self.level}")
+        return level
+
+    def _compact_locked(self, now: float):
+        """Освобождает кольца временных окон ячеек, где не было событий дольше недели."""
+        self._last_compact = now
+        horizon = now - HOUR_BUCKETS * 3600
+        for cells in self._levels.values():
+            for cell in cells.values():
+                if cell.rolling is not None and cell.last_event < horizon:
+                    cell.rolling = None
+
+    def add_point(self, lat: float, lng: float, intensity: float = 1.0, timestamp: Optional[float] = None) -> int:
+        """
+        Добавляет одно событие детекции.
+
+        Args:
+            lat: Широта
+            lng: Долгота
+            intensity: Интенсивность события
+            timestamp: Время события; без него событие не попадает во временные окна
+
+        Returns:
+            int: Новая версия хранилища
+        """
+        with self._lock:
+            self.version += 1
+            self._add_locked(lat, lng, intensity, timestamp)
+            return self.version
+
+    def add_points(self, points: Iterable[dict]) -> int:
+        """
+        Добавляет пачку точек вида {"lat", "lng", "intensity", "timestamp"} одной версией.
+
+        Returns:
+            int: Новая версия хранилища
+        """
+        with self._lock:
+            self.version += 1
+            for point in points:
+                timestamp = point.get("timestamp")
+                self._add_locked(
+                    float(point["lat"]),
+                    float(point["lng"]),
+                    float(point.get("intensity", 1.0)),
+                    float(timestamp) if timestamp is not None else None
+                )
+            return self.version
+
+    def load_json(self, path: str) -> int:
+        """
+        Загружает начальный набор точек из JSON файла (формат data.json).
+
+        Returns:
+            int: Количество загруженных точек
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                points = json.load(f)
+        except FileNotFoundError:
+            return 0
+        self.add_points(points)
+        return len(points)
+
+    def window_stamp(self, window: Optional[str], now: Optional[float] = None) -> int:
+        """
+        Возвращает номер текущей корзины окна: значения окна меняются со временем
+        даже без новых событий, поэтому он входит в ключи кэша и ETag.
+        """
+        if window is None:
+            return 0
+        _, resolution = WINDOWS[window]
+        return int((now if now is not None else time.time()) // resolution)
+
+    def _points_locked(self, items: Iterable, window: Optional[str], now: float) -> List[dict]:
+        if window is None:
+            return [cell.to_point(key) for key, cell in items]
+        window_idx, _ = WINDOWS[window]
+        points = []
+        for key, cell in items:
+            point = cell.to_window_point(key, window_idx, now)
+            if point is not None:
+                points.append(point)
+        return points
+
+    def snapshot(self, level: Optional[int] = None, window: Optional[str] = None) -> Tuple[int, List[dict]]:
+        """
+        Возвращает все агрегированные ячейки уровня.
+
+        Args:
+            level: Уровень сетки (по умолчанию самый детальный)
+            window: Временное окно ("hour", "day", "week") или None для всего времени
+
+        Returns:
+            tuple: (версия, список точек)
+        """
+        level = self._check_level(level)
+        now = time.time()
+        with self._lock:
+            if now - self._last_compact >= COMPACT_INTERVAL:
+                self._compact_locked(now)
+            return self.version, self._points_locked(self._levels[level].items(), window, now)
+
+    def snapshot_json(self) -> Tuple[int, bytes]:
+        """
+        Возвращает сериализованный снимок, пересчитывая его только при смене версии.
+        """
+        cached = self._snapshot_cache
+        if cached is not None and cached[0] == self.version:
+            return cached
+        version, points = self.snapshot()
+        cached = (version, json.dumps(points, separators=(",", ":")).encode("utf-8"))
+        self._snapshot_cache = cached
+        return cached
+
+    def changes_since(self, since: int, level: Optional[int] = None) -> Tuple[int, Optional[List[dict]]]:
+        """
+        Возвращает ячейки уровня, изменившиеся после версии since.
+
+        Returns:
+            tuple: (версия, список точек) или (версия, None), если журнал изменений
+            уже не покрывает since и клиенту нужен полный снимок
+        """
+        level = self._check_level(level)
+        shift = self.level - level
+        with self._lock:
+            if since >= self.version:
+                return self.version, []
+            if since < self._min_since:
+                return self.version, None
+            keys = set()
+            for version, (x, y) in reversed(self._changes):
+                if version <= since:
+                    break
+                keys.add((x >> shift, y >> shift))
+            cells = self._levels[level]
+            return self.version, [cells[key].to_point(key) for key in keys]
+
+    def query_viewport(
+        self, south: float, west: float, north: float, east: float, zoom: int, window: Optional[str] = None
+    ) -> Tuple[int, int, bytes]:
+        """
+        Возвращает агрегированные ячейки, попадающие в область просмотра.
+
+        Область приводится к границам ячеек уровня, соответствующего масштабу,
+        поэтому близкие области просмотра используют один и тот же ответ из кэша.
+
+        Args:
+            south, west, north, east: Границы области просмотра
+            zoom: Масштаб карты
+            window: Временное окно ("hour", "day", "week") или None для всего времени
+
+        Returns:
+            tuple: (версия, уровень, сериализованный JSON со списком точек)
+        """
+        level = zoom_to_level(zoom)
+        x0, y0 = latlng_to_cell(north, west, level)
+        x1, y1 = latlng_to_cell(south, east, level)
+        now = time.time()
+        cache_key = (level, x0, y0, x1, y1, window, self.window_stamp(window, now))
+
+        with self._lock:
+            if now - self._last_compact >= COMPACT_INTERVAL:
+                self._compact_locked(now)
+
+            cached = self._viewport_cache.get(cache_key)
+            if cached is not None and cached[0] == self.version:
+                self._viewport_cache.move_to_end(cache_key)
+                return cached[0], level, cached[1]
+
+            cells = self._levels[level]
+            area = (x1 - x0 + 1) * (y1 - y0 + 1)
+            if area < len(cells):
+                # Область меньше числа непустых ячеек — перебираем ее ячейки
+                items = [
+                    ((x, y), cells[(x, y)])
+                    for x in range(x0, x1 + 1)
+                    for y in range(y0, y1 + 1)
+                    if (x, y) in cells
+                ]
+            else:
+                items = [
+                    (key, cell) for key, cell in cells.items()
+                    if x0 <= key[0] <= x1 and y0 <= key[1] <= y1
+                ]
+            points = self._points_locked(items, window, now)
+
+            body = json.dumps(points, separators=(",", ":")).encode("utf-8")
+            self._viewport_cache[cache_key] = (self.version, body)
+            self._viewport_cache.move_to_end(cache_key)
+            if len(self._viewport_cache) > VIEWPORT_CACHE_SIZE:
+                self._viewport_cache.popitem(last=False)
+            return self.version, level, body
+
+
+# Глобальное хранилище тепловой карты
+heatmap_store = HeatmapStore()
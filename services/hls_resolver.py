@@ -0,0 +1,169 @@
+"""
+Асинхронное получение HLS (.m3u8) URL со страницы камеры.
+
+Страница загружается общим пулом соединений httpx с таймаутами и читается
+потоком: каждый фрагмент проверяется регулярными выражениями, и загрузка
+прекращается на первом найденном .m3u8, без построения DOM дерева.
+Результаты кэшируются на HLS_CACHE_TTL секунд (URL страницы -> URL плейлиста),
+поэтому повторное открытие той же камеры не обращается к странице.
+Если закэшированный плейлист не открывается (токен в URL истек), вызывающий
+код сбрасывает кэш через resolve(..., force=True).
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urljoin
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Время жизни записи кэша (секунды)
+HLS_CACHE_TTL = float(os.getenv("HLS_CACHE_TTL", "600"))
+# Таймаут загрузки страницы (секунды)
+HLS_RESOLVE_TIMEOUT = float(os.getenv("HLS_RESOLVE_TIMEOUT", "10"))
+# Сколько байт страницы просматривать до отказа
+HLS_MAX_PAGE_BYTES = int(os.getenv("HLS_MAX_PAGE_BYTES", str(5 * 1024 * 1024)))
+
+# Абсолютный URL плейлиста, в том числе экранированный в JSON (https:\/\/...)
+ABSOLUTE_M3U8_RE = re.compile(r"https?:(?:\\?/){2}[^\s\"'<>]+?\.m3u8(?:\?[^\s\"'<>\\]*)?")
+# Относительный URL плейлиста в атрибуте src/href/data-*
+ATTRIBUTE_M3U8_RE = re.compile(r"""(?:src|href|data-[\w-]+)\s*=\s*["']([^"'<>]+?\.m3u8(?:\?[^"'<>]*)?)["']""", re.IGNORECASE)
+# Хвост предыдущего фрагмента, чтобы не потерять URL на границе фрагментов
+CHUNK_OVERLAP = 2048
+
+
+def find_m3u8(text: str, base_url: str, final: bool = True) -> Optional[str]:
+    """
+    Ищет первый URL плейлиста в тексте страницы.
+
+    Args:
+        text: Фрагмент HTML/JS
+        base_url: URL страницы для разрешения относительных ссылок
+        final: Фрагмент последний; иначе URL, который доходит до конца фрагмента,
+            может продолжаться (например, ?token=...) и не принимается
+
+    Returns:
+        Абсолютный URL плейлиста или None
+    """
+    candidates = []
+    match = ABSOLUTE_M3U8_RE.search(text)
+    if match:
+        if not final and match.end() == len(text):
+            # Ждем следующий фрагмент: он придет вместе с хвостом текущего
+            candidates.append((match.start(), None))
+        else:
+            candidates.append((match.start(), match.group(0).replace("\\/", "/")))
+    match = ATTRIBUTE_M3U8_RE.search(text)
+    if match:
+        candidates.append((match.start(1), urljoin(base_url, match.group(1))))
+    if not candidates:
+        return None
+    return min(candidates, key=lambda candidate: candidate[0])[1]
+
+
+class HlsResolver:
+    """Кэширующий резолвер URL страницы камеры в URL HLS плейлиста."""
+
+    def __init__(self, ttl: float = HLS_CACHE_TTL, timeout: float = HLS_RESOLVE_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        # Формат: { URL страницы: (URL плейлиста, время истечения) }
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        # Одновременные запросы одной страницы ждут одну загрузку
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                follow_redirects=True,
+                headers={"User-Agent": "Mozilla/5.0 (compatible; smoking-detector)"},
+            )
+        return self._client
+
+    def cached(self, page_url: str) -> Optional[str]:
+        entry = self._cache.get(page_url)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._cache[page_url]
+            return None
+        return entry[0]
+
+    def invalidate(self, page_url: str):
+        self._cache.pop(page_url, None)
+
+    async def resolve(self, page_url: str, force: bool = False) -> Optional[str]:
+        """
+        Возвращает URL плейлиста для страницы, из кэша или загрузив страницу.
+
+        Args:
+            page_url: URL страницы с плеером
+            force: Игнорировать кэш (закэшированный URL не открылся)
+
+        Returns:
+            URL плейлиста или None, если найти его не удалось
+        """
+        if force:
+            self.invalidate(page_url)
+        hls_url = self.cached(page_url)
+        if hls_url is not None:
+            return hls_url
+
+        lock = self._locks.setdefault(page_url, asyncio.Lock())
+        async with lock:
+            # Пока ждали, страницу мог загрузить другой запрос
+            hls_url = self.cached(page_url)
+            if hls_url is None:
+                hls_url = await self._fetch(page_url)
+                if hls_url is not None:
+                    self._cache[page_url] = (hls_url, time.monotonic() + self.ttl)
+        if not lock.locked():
+            self._locks.pop(page_url, None)
+        return hls_url
+
+    async def _fetch(self, page_url: str) -> Optional[str]:
+        started = time.perf_counter()
+        try:
+            async with self.client.stream("GET", page_url) as response:
+                response.raise_for_status()
+                base_url = str(response.url)
+                tail = ""
+                read = 0
+                async for chunk in response.aiter_text():
+                    text = tail + chunk
+                    hls_url = find_m3u8(text, base_url, final=False)
+                    if hls_url is not None:
+                        logger.debug("HLS URL найден за %.3f с после %d байт страницы %s", time.perf_counter() - started, read + len(chunk), page_url)
+                        return hls_url
+                    read += len(chunk)
+                    if read >= HLS_MAX_PAGE_BYTES:
+                        break
+                    tail = text[-CHUNK_OVERLAP:]
+                else:
+                    # Страница закончилась: URL в самом конце уже не может продолжиться
+                    hls_url = find_m3u8(tail, base_url)
+                    if hls_url is not None:
+                        return hls_url
+        except httpx.HTTPError as e:
+            logger.warning("Error fetching URL %s: %s", page_url, e)
+            return None
+        logger.info("HLS URL не найден на странице %s", page_url)
+        return None
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Глобальный резолвер
+hls_resolver = HlsResolver()
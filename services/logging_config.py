@@ -0,0 +1,191 @@
+"""
+Структурированное неблокирующее логирование.
+
+Логгеры пишут в ограниченную очередь через QueueLogHandler, а форматирование
+и вывод выполняются в отдельном потоке QueueListener, поэтому цикл обработки
+кадров не ждет stdout. При переполнении очереди записи отбрасываются и
+подсчитываются, а не блокируют event loop.
+
+Настройка через переменные окружения:
+- LOG_LEVEL: уровень корневого логгера (по умолчанию INFO)
+- LOG_LEVELS: уровни отдельных модулей, например
+  "routers.streaming=DEBUG,services.governor=WARNING"
+- LOG_FORMAT: "json" (по умолчанию) или "text"
+
+Для сообщений из покадровых циклов передавайте extra={"rate_limit": секунды}:
+одинаковые сообщения (тот же логгер, строка и stream_id) выводятся не чаще
+раза в заданный интервал, а в следующей записи указывается число пропущенных.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+# Размер очереди записей лога
+LOG_QUEUE_SIZE = 10000
+
+# Как часто RateLimitFilter удаляет состояние неактивных мест вызова (секунды)
+RATE_LIMIT_SWEEP_INTERVAL = 60.0
+# Через сколько секунд без записей удаляется состояние с пропущенными записями
+# (например, закрытого стрима); без пропущенных — сразу по истечении интервала
+RATE_LIMIT_STATE_TTL = 600.0
+
+# Атрибуты LogRecord, которые не попадают в JSON как дополнительные поля
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "rate_limit"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну JSON строку."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Текстовый формат для локальной разработки; stream_id выводится в начале сообщения."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        stream_id = getattr(record, "stream_id", None)
+        if stream_id is not None:
+            line = line.replace(": ", f": [{stream_id}] ", 1)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            line += f" (пропущено похожих сообщений: {suppressed})"
+        return line
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Пропускает записи с extra={"rate_limit": секунды} не чаще раза в интервал
+    для каждой пары (место вызова, stream_id).
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Формат: { (логгер, строка, stream_id): [время последней записи, пропущено, интервал] }
+        self._last: Dict[Tuple[str, int, Optional[str]], list] = {}
+        self._next_sweep = time.time() + RATE_LIMIT_SWEEP_INTERVAL
+        # Фильтр вызывается из разных потоков до блокировки обработчика
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        interval = getattr(record, "rate_limit", None)
+        if interval is None:
+            return True
+        key = (record.name, record.lineno, getattr(record, "stream_id", None))
+        now = record.created
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            state = self._last.get(key)
+            if state is not None and now - state[0] < interval:
+                state[1] += 1
+                return False
+            if state is not None and state[1]:
+                record.suppressed = state[1]
+            self._last[key] = [now, 0, interval]
+        return True
+
+    def _sweep(self, now: float):
+        """Удаляет состояние мест вызова, по которым давно не было записей (stream_id закрытых стримов)."""
+        self._next_sweep = now + RATE_LIMIT_SWEEP_INTERVAL
+        expired = [
+            key for key, (last, suppressed, interval) in self._last.items()
+            if now - last >= (RATE_LIMIT_STATE_TTL if suppressed else interval)
+        ]
+        for key in expired:
+            del self._last[key]
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Неблокирующий обработчик: кладет запись в очередь без форматирования.
+    Форматирование (включая подстановку аргументов) выполняется в потоке слушателя.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+queue_handler: Optional[QueueLogHandler] = None
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Разбирает строку вида "module=LEVEL,module2=LEVEL"."""
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """Настраивает корневой логгер. Повторные вызовы ничего не делают."""
+    global _listener, queue_handler
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JsonFormatter())
+
+    queue_handler = QueueLogHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for name, level in parse_levels(os.getenv("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(level)
+
+    # Логи uvicorn идут через ту же очередь
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = QueueListener(queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Дописывает оставшиеся записи и останавливает поток вывода."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        if queue_handler is not None and queue_handler.dropped:
+            sys.stdout.write(f"log records dropped: {queue_handler.dropped} at {time.time():.3f}\n")
@@ -0,0 +1,265 @@
+"""
+Метрики конвейера обработки кадров в формате Prometheus.
+
+Легковесная реализация без внешних зависимостей: гистограмма хранит
+некумулятивные счетчики по корзинам и на горячем пути делает один bisect и
+два сложения под блокировкой (этапы замеряются и в рабочих потоках), кумулятивные значения считаются только при выдаче /metrics.
+Метки гистограмм задержек — только этап конвейера, чтобы число рядов не
+росло с количеством стримов; по стримам ведутся FPS, глубина очереди и сбросы.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from services.profiling import stream_tracer
+
+# Границы корзин гистограммы задержек (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Этапы конвейера обработки кадра
+STAGES = ("parse", "decode", "write", "jpeg_encode", "preprocess", "detector", "broadcast")
+
+# Окно усреднения FPS стрима (секунды)
+FPS_WINDOW = 2.0
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    """Замер длительности блока для гистограммы (perf_counter)."""
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class _TracedTimer(_Timer):
+    """Замер этапа для стрима с включенной трассировкой: дополнительно пишет этап в трассировку."""
+
+    __slots__ = ("stream_id", "frame_number", "wall_start")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...], stream_id: str, frame_number: Optional[int]):
+        super().__init__(histogram, labels)
+        self.stream_id = stream_id
+        self.frame_number = frame_number
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.histogram.observe(duration, *self.labels)
+        stream_tracer.record(self.stream_id, self.frame_number, self.labels[0], self.wall_start, duration)
+        return False
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Формат: { значения меток: [счетчики по корзинам + корзина +Inf, сумма] }
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels: str) -> _Timer:
+        return _Timer(self, labels)
+
+    def remove(self, *labels: str):
+        with self._lock:
+            self._series.pop(labels, None)
+
+    def render(self) -> Iterable[str]:
+        with self._lock:
+            snapshot = [(labels, (list(counts), total)) for labels, (counts, total) in self._series.items()]
+        for labels, (counts, total) in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total!r}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Counter:
+    """Монотонный счетчик. Значения можно увеличивать явно или получать функцией при выдаче (итоги, которые ведет сам сервис)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def remove_matching(self, index: int, value: str):
+        for labels in [labels for labels in self._values if labels[index] == value]:
+            del self._values[labels]
+
+    def render(self) -> Iterable[str]:
+        values = self.callback() if self.callback is not None else self._values
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge:
+    """Текущее значение. Значения можно задавать явно или получать функцией при выдаче."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def remove(self, *labels: str):
+        self._values.pop(labels, None)
+
+    def render(self) -> Iterable[str]:
+        values = self.callback() if self.callback is not None else self._values
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class FpsMeter:
+    """FPS стрима, пересчитываемый раз в FPS_WINDOW секунд."""
+
+    __slots__ = ("frames", "window_start", "fps")
+
+    def __init__(self, timestamp: float):
+        self.frames = 0
+        self.window_start = timestamp
+        self.fps = 0.0
+
+
+class MetricsRegistry:
+    """Набор метрик приложения и их выдача в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.metrics: List = []
+        self._fps: Dict[str, FpsMeter] = {}
+
+        self.stage_latency = self.register(Histogram(
+            "smoking_pipeline_stage_seconds",
+            "Latency of frame pipeline stages",
+            ("stage",),
+        ))
+        self.frames = self.register(Counter(
+            "smoking_stream_frames_total",
+            "Frames processed per stream",
+            ("stream_id",),
+        ))
+        self.dropped = self.register(Counter(
+            "smoking_stream_frames_dropped_total",
+            "Frames dropped per stream and reason",
+            ("stream_id", "reason"),
+        ))
+        self.fps = self.register(Gauge(
+            "smoking_stream_fps",
+            "Frames per second per stream",
+            ("stream_id",),
+            callback=lambda: {(stream_id,): round(meter.fps, 2) for stream_id, meter in self._fps.items()},
+        ))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def stage(self, stage: str, stream_id: Optional[str] = None, frame_number: Optional[int] = None) -> _Timer:
+        """
+        Замер этапа конвейера: with metrics.stage("decode", stream_id, frame_number): ...
+
+        Стрим и номер кадра нужны только для трассировки (services/profiling.py)
+        и в метки гистограммы не попадают.
+        """
+        if stream_id is not None and stream_id in stream_tracer.traces:
+            return _TracedTimer(self.stage_latency, (stage,), stream_id, frame_number)
+        return self.stage_latency.time(stage)
+
+    def record_frame(self, stream_id: str, timestamp: float):
+        self.frames.inc(stream_id)
+        meter = self._fps.get(stream_id)
+        if meter is None:
+            meter = self._fps[stream_id] = FpsMeter(timestamp)
+        meter.frames += 1
+        elapsed = timestamp - meter.window_start
+        if elapsed >= FPS_WINDOW:
+            meter.fps = meter.frames / elapsed
+            meter.frames = 0
+            meter.window_start = timestamp
+
+    def record_drop(self, stream_id: str, reason: str):
+        self.dropped.inc(stream_id, reason)
+
+    def remove_stream(self, stream_id: str):
+        """Удаляет ряды и трассировку закрытого стрима, чтобы их число не росло бесконечно."""
+        self._fps.pop(stream_id, None)
+        self.frames.remove_matching(0, stream_id)
+        self.dropped.remove_matching(0, stream_id)
+        stream_tracer.stop(stream_id)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный реестр метрик
+metrics = MetricsRegistry()
@@ -0,0 +1,199 @@
+"""
+Профилирование по запросу: сэмплирующий профайлер и трассировка этапов стрима.
+
+Сэмплирующий профайлер в отдельном потоке периодически снимает стеки всех
+потоков через sys._current_frames() и складывает их в свернутом формате
+(folded stacks: "поток;модуль:функция;... количество"), который понимают
+flamegraph.pl, speedscope и inferno. Код приложения не инструментируется,
+поэтому накладные расходы ограничены частотой сэмплирования.
+
+Трассировка стрима включается для конкретного stream_id на следующие N кадров
+и записывает время начала и длительность каждого этапа конвейера
+(metrics.stage с указанием стрима и номера кадра).
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Интервал сэмплирования по умолчанию (секунды)
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+# Максимальная длительность одного запуска профайлера (секунды)
+PROFILER_MAX_DURATION = float(os.getenv("PROFILER_MAX_DURATION", "300"))
+# Максимальное число кадров в одной трассировке стрима
+TRACE_MAX_FRAMES = int(os.getenv("TRACE_MAX_FRAMES", "1000"))
+
+# Функции, в которых поток простаивает (ожидание событий, блокировок, сна)
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "wait", "sleep", "acquire", "_wait_for_tstate_lock", "accept", "get", "_worker"}
+
+
+class ProfilerBusyError(Exception):
+    """Профайлер уже запущен."""
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер всех потоков процесса."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.interval = PROFILER_INTERVAL
+        self.include_idle = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float, interval: float = PROFILER_INTERVAL, include_idle: bool = False):
+        """
+        Запускает сэмплирование на duration секунд. Предыдущий результат сбрасывается.
+
+        Raises:
+            ProfilerBusyError: профайлер уже запущен
+        """
+        with self._lock:
+            if self.running:
+                raise ProfilerBusyError("Profiler is already running")
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = interval
+            self.include_idle = include_idle
+            self.started_at = time.time()
+            self.finished_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(min(duration, PROFILER_MAX_DURATION),), name="sampling-profiler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Останавливает сэмплирование и ждет завершения потока профайлера."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, duration: float):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if not self.include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                self.stacks[self._fold(names.get(thread_id, str(thread_id)), frame)] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+        self.finished_at = time.time()
+
+    @staticmethod
+    def _fold(thread_name: str, frame) -> str:
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+            frame = frame.f_back
+        parts.append(thread_name)
+        return ";".join(reversed(parts))
+
+    def folded(self) -> str:
+        """Результат в свернутом формате, по строке на уникальный стек."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "include_idle": self.include_idle,
+            "samples": self.samples,
+            "unique_stacks": len(self.stacks),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class StreamTrace:
+    """Трассировка этапов обработки следующих limit кадров стрима."""
+
+    def __init__(self, stream_id: str, limit: int):
+        self.stream_id = stream_id
+        self.limit = limit
+        self.started_at = time.time()
+        self.frames: Dict[int, dict] = {}
+        self.last_frame: Optional[int] = None
+        self.skipped = 0
+
+    @property
+    def completed(self) -> bool:
+        return len(self.frames) >= self.limit
+
+    def record(self, frame_number: Optional[int], stage: str, started: float, duration: float):
+        # Этапы без номера кадра (например, рассылка результатов) относятся к последнему кадру
+        if frame_number is None:
+            frame_number = self.last_frame
+            if frame_number is None:
+                return
+        entry = self.frames.get(frame_number)
+        if entry is None:
+            if self.completed:
+                self.skipped += 1
+                return
+            entry = self.frames[frame_number] = {"frame_number": frame_number, "timestamp": started, "stages": []}
+            self.last_frame = frame_number
+        entry["stages"].append({
+            "stage": stage,
+            "offset_ms": round((started - entry["timestamp"]) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+        })
+
+    def to_dict(self) -> dict:
+        return {
+            "stream_id": self.stream_id,
+            "limit": self.limit,
+            "started_at": self.started_at,
+            "completed": self.completed,
+            "frames": [self.frames[number] for number in sorted(self.frames)],
+        }
+
+
+class StreamTracer:
+    """Включенные трассировки стримов. Стрим без трассировки стоит одну проверку словаря на этап."""
+
+    def __init__(self):
+        self.traces: Dict[str, StreamTrace] = {}
+
+    def start(self, stream_id: str, frames: int) -> StreamTrace:
+        trace = self.traces[stream_id] = StreamTrace(stream_id, min(frames, TRACE_MAX_FRAMES))
+        return trace
+
+    def get(self, stream_id: str) -> Optional[StreamTrace]:
+        return self.traces.get(stream_id)
+
+    def stop(self, stream_id: str) -> Optional[StreamTrace]:
+        return self.traces.pop(stream_id, None)
+
+    def record(self, stream_id: str, frame_number: Optional[int], stage: str, started: float, duration: float):
+        trace = self.traces.get(stream_id)
+        if trace is not None:
+            trace.record(frame_number, stage, started, duration)
+
+    def list(self) -> List[dict]:
+        return [
+            {"stream_id": trace.stream_id, "limit": trace.limit, "frames": len(trace.frames), "completed": trace.completed}
+            for trace in self.traces.values()
+        ]
+
+
+# Глобальные экземпляры
+profiler = SamplingProfiler()
+stream_tracer = StreamTracer()
@@ -0,0 +1,245 @@
+"""
+Адаптивная частота детекции для стримов.
+
+Вместо фиксированного detection_interval интервал каждого стрима
+пересчитывается по его активности: движению в кадре, недавним положительным
+вердиктам и числу зрителей. Загруженные камеры проверяются чаще, статичные —
+реже. Сумма частот всех стримов ограничивается глобальным бюджетом вызовов
+AI модели в минуту: при превышении интервалы растягиваются пропорционально.
+Сэмпл тайловой детекции стоит rows * cols вызовов (calls_per_sample).
+Вызовы вне интервалов детекции — пакетная детекция фото и файлы, которые читаются
+по времени источника быстрее реального времени, — расходуют только ту часть
+бюджета, которую не запрашивают живые стримы (try_background_call).
+"""
+
+import math
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+# Глобальный бюджет вызовов AI модели в минуту (0 — без ограничения)
+DETECTOR_BUDGET_PER_MINUTE = float(os.getenv("DETECTOR_BUDGET_PER_MINUTE", "120"))
+
+# Интервал детекции по умолчанию (секунды)
+DEFAULT_DETECTION_INTERVAL = 5.0
+
+# Границы эффективного интервала детекции (секунды)
+MIN_DETECTION_INTERVAL = 1.0
+MAX_DETECTION_INTERVAL = 60.0
+
+# Движение оценивается по уменьшенному серому кадру не чаще раза в MOTION_SAMPLE_INTERVAL секунд
+MOTION_FRAME_SIZE = (64, 36)
+MOTION_SAMPLE_INTERVAL = 0.5
+# Сглаживание оценки движения (экспоненциальное среднее)
+MOTION_SMOOTHING = 0.3
+# Средняя разница кадров (0..1), начиная с которой камера считается полностью загруженной
+MOTION_REFERENCE = 0.03
+
+# Сколько секунд после положительного вердикта стрим проверяется чаще
+POSITIVE_BOOST_WINDOW = 120.0
+
+# Как часто пересчитываются интервалы (секунды)
+RECOMPUTE_INTERVAL = 1.0
+
+# Как часто вызов, отложенный из-за исчерпанного бюджета, проверяет его снова (секунды)
+BUDGET_POLL_INTERVAL = 1.0
+
+
+class StreamRate:
+    """Состояние частоты детекции одного стрима."""
+
+    __slots__ = (
+        "base_interval", "calls_per_sample", "interval", "motion", "last_positive", "viewers",
+        "last_detection", "calls", "_prev_small", "_motion_at",
+    )
+
+    def __init__(self, base_interval: float, calls_per_sample: int = 1):
+        self.base_interval = base_interval
+        # Вызовов AI модели на один сэмпл (rows * cols при тайловой детекции)
+        self.calls_per_sample = calls_per_sample
+        self.interval = base_interval
+        self.motion = 0.0
+        self.last_positive: Optional[float] = None
+        self.viewers = 0
+        self.last_detection = 0.0
+        # Время вызовов AI модели за последнюю минуту
+        self.calls: deque = deque()
+        self._prev_small: Optional[np.ndarray] = None
+        self._motion_at = 0.0
+
+    def activity(self, timestamp: float) -> float:
+        """
+        Множитель частоты детекции: 1.0 — базовая частота, меньше — реже, больше — чаще.
+        Статичная сцена без детекций с одним зрителем дает 0.5.
+        """
+        activity = 0.5 + 1.5 * min(self.motion / MOTION_REFERENCE, 1.0)
+        if self.last_positive is not None and timestamp - self.last_positive < POSITIVE_BOOST_WINDOW:
+            activity += 1.0
+        if self.viewers > 1:
+            activity += 0.25 * math.log2(self.viewers)
+        return activity
+
+
+class DetectionRateController:
+    """
+    Распределяет вызовы AI модели между стримами.
+
+    Желаемый интервал стрима — base_interval / activity в пределах
+    [MIN_DETECTION_INTERVAL, MAX_DETECTION_INTERVAL]. Если суммарная частота
+    стримов со зрителями превышает бюджет, все интервалы умножаются на
+    одинаковый коэффициент, так что бюджет делится пропорционально активности.
+    """
+
+    def __init__(self, budget_per_minute: float = DETECTOR_BUDGET_PER_MINUTE):
+        self.budget_per_minute = budget_per_minute
+        self.streams: Dict[str, StreamRate] = {}
+        self.budget_scale = 1.0
+        # Вызовов в минуту, которые запрашивают стримы со зрителями (до масштабирования бюджетом)
+        self.stream_demand = 0.0
+        # Время фоновых вызовов AI модели за последнюю минуту (пакеты и файлы)
+        self.background_calls: deque = deque()
+        self._recomputed_at = 0.0
+
+    def register(self, stream_id: str, base_interval: float = DEFAULT_DETECTION_INTERVAL,
+                 calls_per_sample: int = 1) -> StreamRate:
+        rate = self.streams.get(stream_id)
+        if rate is None:
+            rate = self.streams[stream_id] = StreamRate(float(base_interval), calls_per_sample)
+        else:
+            rate.base_interval = float(base_interval)
+            rate.calls_per_sample = calls_per_sample
+        self._recomputed_at = 0.0
+        return rate
+
+    def unregister(self, stream_id: str):
+        if self.streams.pop(stream_id, None) is not None:
+            self._recomputed_at = 0.0
+
+    def set_viewers(self, stream_id: str, viewers: int):
+        rate = self.streams.get(stream_id)
+        if rate is not None:
+            rate.viewers = viewers
+
+    def observe_frame(self, stream_id: str, frame: np.ndarray, timestamp: Optional[float] = None):
+        """Обновляет оценку движения стрима (не чаще раза в MOTION_SAMPLE_INTERVAL секунд)."""
+        rate = self.streams.get(stream_id)
+        timestamp = time.time() if timestamp is None else timestamp
+        if rate is None or timestamp - rate._motion_at < MOTION_SAMPLE_INTERVAL:
+            return
+        rate._motion_at = timestamp
+
+        small = cv2.cvtColor(cv2.resize(frame, MOTION_FRAME_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if rate._prev_small is not None:
+            score = float(cv2.absdiff(small, rate._prev_small).mean()) / 255.0
+            rate.motion += MOTION_SMOOTHING * (score - rate.motion)
+        rate._prev_small = small
+
+    def observe_verdict(self, stream_id: str, positive: bool, timestamp: float):
+        rate = self.streams.get(stream_id)
+        if rate is not None and positive:
+            rate.last_positive = timestamp
+
+    def recompute(self, timestamp: float):
+        """Пересчитывает эффективные интервалы всех стримов с учетом бюджета."""
+        self._recomputed_at = timestamp
+        desired = {}
+        for stream_id, rate in self.streams.items():
+            interval = rate.base_interval / rate.activity(timestamp)
+            desired[stream_id] = min(max(interval, MIN_DETECTION_INTERVAL), MAX_DETECTION_INTERVAL)
+
+        # В бюджете учитываются только стримы, которые сейчас кто-то смотрит
+        demand = sum(
+            rate.calls_per_sample * 60.0 / desired[stream_id]
+            for stream_id, rate in self.streams.items() if rate.viewers > 0
+        )
+        self.stream_demand = demand
+        self.budget_scale = 1.0
+        if self.budget_per_minute > 0 and demand > self.budget_per_minute:
+            self.budget_scale = demand / self.budget_per_minute
+
+        for stream_id, rate in self.streams.items():
+            rate.interval = desired[stream_id] * self.budget_scale
+
+    def needs_motion_sample(self, stream_id: str, timestamp: float) -> bool:
+        """Пора ли передать кадр в observe_frame (для разреженного декодирования)."""
+        rate = self.streams.get(stream_id)
+        return rate is not None and timestamp - rate._motion_at >= MOTION_SAMPLE_INTERVAL
+
+    def is_detection_due(self, stream_id: str, timestamp: float) -> bool:
+        """Истек ли интервал детекции стрима. В отличие от should_detect, вызов не учитывается."""
+        rate = self.streams.get(stream_id)
+        return rate is None or timestamp - rate.last_detection >= rate.interval
+
+    def should_detect(self, stream_id: str, timestamp: float) -> bool:
+        """
+        Пора ли отправлять кадр стрима в AI модель. Если да, вызов учитывается
+        в статистике стрима, поэтому метод нужно вызывать последним условием.
+        """
+        rate = self.streams.get(stream_id) or self.register(stream_id)
+        if timestamp - self._recomputed_at >= RECOMPUTE_INTERVAL:
+            self.recompute(timestamp)
+        if timestamp - rate.last_detection < rate.interval:
+            return False
+
+        rate.last_detection = timestamp
+        rate.calls.extend([timestamp] * rate.calls_per_sample)
+        while rate.calls and timestamp - rate.calls[0] > 60.0:
+            rate.calls.popleft()
+        return True
+
+    def try_background_call(self, timestamp: float, stream_id: Optional[str] = None) -> bool:
+        """
+        Учитывает фоновый вызов AI модели, если на него остался бюджет: живые стримы
+        имеют приоритет, поэтому фоновым вызовам достается бюджет минус запрос стримов.
+        Если за минуту не было ни одного фонового вызова, вызов допускается всегда,
+        чтобы сэмпл дороже всего бюджета (крупная сетка тайлов) не ждал бесконечно.
+
+        Args:
+            timestamp: Время сервера
+            stream_id: Стрим, читающий файл по времени источника (None — пакетная детекция);
+                его сэмпл стоит calls_per_sample вызовов и учитывается в статистике стрима
+
+        Returns:
+            bool: False — вызов нужно отложить
+        """
+        if timestamp - self._recomputed_at >= RECOMPUTE_INTERVAL:
+            self.recompute(timestamp)
+        while self.background_calls and timestamp - self.background_calls[0] > 60.0:
+            self.background_calls.popleft()
+        rate = self.streams.get(stream_id) if stream_id is not None else None
+        calls = rate.calls_per_sample if rate is not None else 1
+        if (self.budget_per_minute > 0 and self.background_calls
+                and len(self.background_calls) + calls + self.stream_demand > self.budget_per_minute):
+            return False
+        self.background_calls.extend([timestamp] * calls)
+        if rate is not None:
+            rate.last_detection = timestamp
+            rate.calls.extend([timestamp] * calls)
+            while rate.calls and timestamp - rate.calls[0] > 60.0:
+                rate.calls.popleft()
+        return True
+
+    def report(self, stream_id: str) -> Optional[dict]:
+        """Текущая частота детекции стрима."""
+        rate = self.streams.get(stream_id)
+        if rate is None:
+            return None
+        now = time.time()
+        return {
+            "base_interval": rate.base_interval,
+            "effective_interval": round(rate.interval, 2),
+            "effective_rate_per_minute": round(60.0 / rate.interval, 2),
+            "calls_per_sample": rate.calls_per_sample,
+            "calls_last_minute": sum(1 for call in rate.calls if now - call <= 60.0),
+            "motion": round(rate.motion, 4),
+            "recent_positive": rate.last_positive is not None and now - rate.last_positive < POSITIVE_BOOST_WINDOW,
+            "viewers": rate.viewers,
+        }
+
+
+# Глобальный контроллер частоты детекции
+rate_controller = DetectionRateController()
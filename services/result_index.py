@@ -0,0 +1,108 @@
+"""
+Постоянный индекс результатов детекции по хешу содержимого загрузок.
+
+Повторная загрузка того же видео или фото не должна заново декодироваться и
+оплачивать вызовы AI модели. Загрузка хешируется (SHA-256) по мере записи на
+диск, а результат сохраняется в SQLite с ключом (вид загрузки, хеш, версия
+конфигурации детектора). Версия меняется при смене модели, промпта или
+параметров сэмплирования, и старые результаты перестают совпадать.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import BinaryIO, Optional, Tuple
+
+from fastapi import UploadFile
+
+# Путь к базе индекса результатов
+RESULT_INDEX_PATH = os.getenv("RESULT_INDEX_PATH", "results.db")
+
+# Размер блока при чтении загрузки
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+async def save_upload_hashed(file: UploadFile, destination: BinaryIO) -> Tuple[str, int]:
+    """
+    Записывает загрузку в файл блоками, одновременно вычисляя SHA-256.
+
+    Returns:
+        (хеш содержимого в hex, размер в байтах)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultIndex:
+    """Результаты детекции по хешу содержимого и версии конфигурации детектора."""
+
+    def __init__(self, path: str = RESULT_INDEX_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # База открывается при первом обращении, чтобы импорт модуля не создавал файл
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    kind TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    config_version TEXT NOT NULL,
+                    verdict TEXT NOT NULL,
+                    job_id TEXT,
+                    size INTEGER,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (kind, content_hash, config_version)
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, kind: str, content_hash: str, config_version: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT verdict, job_id, size, created_at FROM results WHERE kind = ? AND content_hash = ? AND config_version = ?",
+                (kind, content_hash, config_version),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"verdict": row[0], "job_id": row[1], "size": row[2], "created_at": row[3]}
+
+    def put(self, kind: str, content_hash: str, config_version: str, verdict: str,
+            job_id: Optional[str] = None, size: Optional[int] = None):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO results (kind, content_hash, config_version, verdict, job_id, size, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, content_hash, config_version, verdict, job_id, size, time.time()),
+            )
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Глобальный индекс результатов
+result_index = ResultIndex()
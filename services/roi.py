@@ -0,0 +1,90 @@
+"""
+Области интереса (ROI) камер.
+
+Многие городские камеры видят небо, дороги и фасады, где курить некому.
+ROI задается полигонами в нормированных координатах кадра (0..1), по ним один
+раз на разрешение строится маска; перед кодированием кадр обрезается по
+ограничивающему прямоугольнику ROI, а пиксели вне полигонов зануляются.
+Это уменьшает время кодирования, размер запроса к AI модели и ложные срабатывания.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Полигон — список точек [x, y] в нормированных координатах кадра
+Polygon = List[List[float]]
+
+
+def validate_polygons(polygons: List[Polygon]) -> Optional[str]:
+    """
+    Проверяет полигоны ROI.
+
+    Returns:
+        str: Описание ошибки или None, если полигоны корректны
+    """
+    if not polygons:
+        return "at least one polygon is required"
+    for polygon in polygons:
+        if len(polygon) < 3:
+            return "each polygon must have at least 3 points"
+        for point in polygon:
+            if len(point) != 2 or not all(0.0 <= v <= 1.0 for v in point):
+                return "polygon points must be [x, y] pairs normalized to 0..1"
+    return None
+
+
+class RoiMask:
+    """
+    Маска области интереса одного стрима.
+
+    Маска и ограничивающий прямоугольник считаются лениво для каждого
+    разрешения кадра и кэшируются, поэтому на кадр остаются только срез
+    и побитовое И.
+    """
+
+    def __init__(self, polygons: List[Polygon]):
+        self.polygons = polygons
+        # Формат: { (width, height): (маска в пределах прямоугольника, (x1, y1, x2, y2)) }
+        self._cache: Dict[Tuple[int, int], Tuple[Optional[np.ndarray], Tuple[int, int, int, int]]] = {}
+
+    def _build(self, width: int, height: int) -> Tuple[Optional[np.ndarray], Tuple[int, int, int, int]]:
+        scale = np.array([width - 1, height - 1], dtype=np.float64)
+        contours = [np.round(np.asarray(polygon) * scale).astype(np.int32) for polygon in self.polygons]
+
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillPoly(mask, contours, 255)
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            return None, (0, 0, width, height)
+
+        x1, y1, x2, y2 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        crop_mask = mask[y1:y2, x1:x2]
+        # Если полигоны покрывают прямоугольник целиком, маска не нужна
+        if crop_mask.all():
+            crop_mask = None
+        return crop_mask, (x1, y1, x2, y2)
+
+    def apply(self, frame: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Оставляет в кадре только пиксели области интереса.
+
+        Args:
+            frame: Кадр BGR
+
+        Returns:
+            tuple: (копия обрезанного кадра с зануленными пикселями вне ROI, смещение (x, y) обрезки в кадре)
+        """
+        height, width = frame.shape[:2]
+        key = (width, height)
+        if key not in self._cache:
+            self._cache[key] = self._build(width, height)
+        crop_mask, (x1, y1, x2, y2) = self._cache[key]
+
+        crop = frame[y1:y2, x1:x2]
+        if crop_mask is not None:
+            crop = cv2.bitwise_and(crop, crop, mask=crop_mask)
+        else:
+            crop = crop.copy()
+        return crop, (x1, y1)
@@ -0,0 +1,95 @@
+"""
+Часы стрима, открытого по URL: время источника для файлов и VOD, время сервера для живых источников.
+
+Живой источник отдает кадры в реальном времени, и интервалы детекции
+отсчитываются по time.time(). Файл или VOD читается настолько быстро,
+насколько позволяет железо, поэтому время кадра берется из самого источника:
+PTS кадра (CAP_PROP_POS_MSEC), а если он недоступен — номер кадра / FPS.
+Метка времени кадра — момент открытия стрима плюс время кадра в источнике,
+так что трекер и клиенты видят интервалы видео, а не скорость чтения.
+Хранилище событий, тепловая карта и оповещения получают время сервера, а время
+кадра в источнике — в поле media_time (routers/streaming.py, to_wall_clock).
+Между точками сэмплирования источник переходит к следующей точке (seek),
+если кадры в промежутке никому не нужны.
+"""
+
+import os
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import cv2
+
+# Схемы и форматы, которые всегда считаются живыми (в том числе VOD плейлисты HLS,
+# по которым нельзя дешево отличить запись от трансляции)
+LIVE_SCHEMES = {"rtsp", "rtsps", "rtmp", "rtmps", "udp", "rtp", "srt", "tcp"}
+LIVE_SUFFIXES = (".m3u8",)
+
+# Сколько детекций файла может выполняться одновременно: чтение файла не уходит
+# дальше от детектора, а результаты не копятся в памяти
+SOURCE_MAX_PENDING_DETECTIONS = int(os.getenv("SOURCE_MAX_PENDING_DETECTIONS", "4"))
+
+# Минимальный разрыв до следующей точки сэмплирования (секунды), начиная с которого
+# переход выгоднее, чем чтение кадров подряд
+SEEK_MIN_GAP = float(os.getenv("SEEK_MIN_GAP", "2.0"))
+
+
+def is_file_source(url: str, cap) -> bool:
+    """Конечный ли источник (файл, VOD .mp4 по HTTP): известны число кадров и FPS, схема не потоковая."""
+    parts = urlsplit(url)
+    if parts.scheme.lower() in LIVE_SCHEMES or parts.path.lower().endswith(LIVE_SUFFIXES):
+        return False
+    return cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0 and cap.get(cv2.CAP_PROP_FPS) > 0
+
+
+class SourceClock:
+    """Метки времени кадров стрима и переход между точками сэмплирования."""
+
+    def __init__(self, cap, fps: float, source_time: bool):
+        self.cap = cap
+        self.fps = fps
+        self.source_time = source_time
+        self.started = time.time()
+        # Время последнего прочитанного кадра в источнике (секунды)
+        self.position = 0.0
+        self._frames = 0
+
+    @classmethod
+    def open(cls, cap, url: str, fps: float, mode: str = "auto") -> "SourceClock":
+        """mode: auto — по типу источника, source — время источника, wall — время сервера."""
+        source_time = mode == "source" or (mode == "auto" and is_file_source(url, cap))
+        return cls(cap, fps, source_time)
+
+    @property
+    def mode(self) -> str:
+        return "source" if self.source_time else "wall"
+
+    def tick(self) -> float:
+        """Метка времени только что прочитанного кадра. Вызывается после каждого успешного чтения."""
+        self._frames += 1
+        if not self.source_time:
+            return time.time()
+        pts = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        self.position = pts / 1000.0 if pts > 0 else (self._frames - 1) / self.fps
+        return self.started + self.position
+
+    def media_time(self, timestamp: float) -> Optional[float]:
+        """Время кадра в источнике по его метке, None для живого источника."""
+        return round(timestamp - self.started, 3) if self.source_time else None
+
+    def seek(self, timestamp: float) -> bool:
+        """
+        Переходит к кадру с меткой timestamp, если до него не меньше SEEK_MIN_GAP секунд.
+        Для живого источника ничего не делает.
+        """
+        if not self.source_time:
+            return False
+        target = timestamp - self.started
+        if target - self.position < SEEK_MIN_GAP:
+            return False
+        if not self.cap.set(cv2.CAP_PROP_POS_MSEC, target * 1000.0):
+            return False
+        # Следующий кадр будет первым после перехода
+        self.position = target - 1.0 / self.fps
+        self._frames = int(round(target * self.fps))
+        return True
@@ -0,0 +1,280 @@
+"""
+Разреженное декодирование видео для детекции по редким сэмплам.
+
+Детекции нужен кадр раз в несколько секунд, а полное декодирование тратит CPU
+на каждый кадр. С PyAV (пакет av из requirements.txt):
+- файлы читаются переходом к ближайшему ключевому кадру перед каждым моментом
+  сэмпла и декодированием только от него до нужного кадра;
+- живые источники декодируются только по ключевым кадрам (skip_frame=NONKEY),
+  остальные пакеты лишь демультиплексируются.
+Без PyAV используется OpenCV: grab() декодирует каждый кадр, и экономятся
+только преобразование в BGR и копирование (retrieve()) ненужных кадров,
+поэтому реального сокращения декодирования в этом режиме нет.
+
+Сэмплы нумеруются от начала файла (k-й сэмпл — момент k * interval), поэтому
+длинный файл можно разбить на диапазоны сэмплов и обработать их независимо
+в разных процессах (encode_sample_range).
+"""
+
+import base64
+import logging
+import math
+import time
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# Бэкенд разреженного декодирования
+SPARSE_DECODE_BACKEND = "pyav" if av is not None else "opencv"
+
+
+def count_samples(video_path: str, interval: float) -> Optional[int]:
+    """
+    Количество сэмплов в видеофайле при шаге interval секунд.
+
+    Returns:
+        Количество сэмплов или None, если длительность файла неизвестна
+
+    Raises:
+        IOError: файл не удалось открыть
+    """
+    if av is not None:
+        try:
+            container = av.open(video_path)
+        except Exception as e:
+            raise IOError(f"Could not open video file: {e}")
+        with container:
+            stream = container.streams.video[0]
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            elif container.duration is not None:
+                duration = container.duration / av.time_base
+            else:
+                return None
+        return int(duration // interval) + 1
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video file.")
+    try:
+        fps, frame_interval = _opencv_sampling(cap, interval)
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+    return math.ceil(frames / frame_interval) if frames > 0 else None
+
+
+def sample_video_frames(video_path: str, interval: float, first_sample: int = 0,
+                        end_sample: Optional[int] = None) -> Iterator[Tuple[float, np.ndarray]]:
+    """
+    Кадры видеофайла с шагом interval секунд, начиная с нулевой секунды.
+
+    Args:
+        video_path: Путь к видеофайлу
+        interval: Шаг сэмплирования в секундах
+        first_sample: Номер первого сэмпла (до него выполняется переход без декодирования)
+        end_sample: Номер сэмпла, на котором чтение прекращается (None — до конца файла)
+
+    Yields:
+        (время кадра в секундах, кадр BGR)
+
+    Raises:
+        IOError: файл не удалось открыть
+    """
+    if av is not None:
+        try:
+            container = av.open(video_path)
+        except Exception as e:
+            raise IOError(f"Could not open video file: {e}")
+        with container:
+            yield from _sample_pyav(container, interval, first_sample, end_sample)
+    else:
+        yield from _sample_opencv(video_path, interval, first_sample, end_sample)
+
+
+def encode_sample_range(video_path: str, interval: float, first_sample: int = 0,
+                        end_sample: Optional[int] = None) -> List[Tuple[float, str]]:
+    """
+    Сэмплы диапазона в формате для детекции: (время, PNG в base64).
+    Выполняется в процессе пула, поэтому возвращает компактные PNG, а не массивы кадров.
+    """
+    samples = []
+    for timestamp, frame in sample_video_frames(video_path, interval, first_sample, end_sample):
+        _, buffer = cv2.imencode('.png', frame)
+        samples.append((timestamp, base64.b64encode(buffer).decode('utf-8')))
+    return samples
+
+
+def _sample_pyav(container, interval: float, first_sample: int, end_sample: Optional[int]) -> Iterator[Tuple[float, np.ndarray]]:
+    stream = container.streams.video[0]
+    stream.thread_type = "AUTO"
+    time_base = float(stream.time_base)
+    target = first_sample * interval
+    end_time = end_sample * interval if end_sample is not None else None
+    while end_time is None or target < end_time - 1e-6:
+        # Переходим к ключевому кадру не позже момента сэмпла и декодируем до него
+        container.seek(int(target / time_base), stream=stream, backward=True, any_frame=False)
+        frame = None
+        for candidate in container.decode(stream):
+            if candidate.time is None or candidate.time + 1e-3 >= target:
+                frame = candidate
+                break
+        if frame is None:
+            return
+        timestamp = frame.time if frame.time is not None else target
+        yield timestamp, frame.to_ndarray(format="bgr24")
+        # Следующий сэмпл строго после текущего кадра, даже если ключевые кадры редкие
+        target = max(target + interval, timestamp + 1e-3)
+
+
+def _opencv_sampling(cap, interval: float) -> Tuple[float, int]:
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not fps or fps == 0:
+        fps = 30  # Assume 30 fps if not available
+    return fps, max(1, int(fps * interval))
+
+
+def _sample_opencv(video_path: str, interval: float, first_sample: int, end_sample: Optional[int]) -> Iterator[Tuple[float, np.ndarray]]:
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video file.")
+    try:
+        fps, frame_interval = _opencv_sampling(cap, interval)
+        frame_index = first_sample * frame_interval
+        end_frame = end_sample * frame_interval if end_sample is not None else None
+        if frame_index > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        while (end_frame is None or frame_index < end_frame) and cap.grab():
+            if frame_index % frame_interval == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    yield frame_index / fps, frame
+            frame_index += 1
+    finally:
+        cap.release()
+
+
+class SparseCapture:
+    """
+    Захват живого источника, отдающий кадр только когда он нужен.
+
+    Интерфейс повторяет cv2.VideoCapture (isOpened, get, set, release), но read()
+    принимает флаг need_frame: при False кадр не преобразуется и возвращается None.
+    С PyAV read() возвращает только ключевые кадры.
+    """
+
+    def __init__(self, url: str, open_timeout: float = 10.0):
+        self._cap = None
+        self._container = None
+        self._frames = None
+        self._stream = None
+        # Время последнего прочитанного кадра (секунды), для CAP_PROP_POS_MSEC
+        self._position = 0.0
+        if av is not None:
+            try:
+                self._container = av.open(url, timeout=open_timeout)
+                self._stream = self._container.streams.video[0]
+                self._stream.thread_type = "AUTO"
+                self._stream.codec_context.skip_frame = "NONKEY"
+                self._frames = self._container.decode(self._stream)
+            except Exception as e:
+                logger.warning("PyAV не смог открыть %s: %s", url, e)
+                self.release()
+        else:
+            logger.warning(
+                "PyAV не установлен: разреженный режим декодирует все кадры через OpenCV, "
+                "экономится только преобразование в BGR", extra={"rate_limit": 60.0}
+            )
+            self._cap = cv2.VideoCapture(url)
+
+    def isOpened(self) -> bool:
+        if self._cap is not None:
+            return self._cap.isOpened()
+        return self._frames is not None
+
+    def get(self, prop: int) -> float:
+        if self._cap is not None:
+            return self._cap.get(prop)
+        if self._stream is None:
+            return 0.0
+        if prop == cv2.CAP_PROP_FPS:
+            rate = self._stream.average_rate or self._stream.guessed_rate
+            return float(rate) if rate else 0.0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self._stream.codec_context.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self._stream.codec_context.height)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self._position * 1000.0
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self._stream.frames or 0)
+        return 0.0
+
+    def set(self, prop: int, value: float) -> bool:
+        """Поддерживает переход по времени (CAP_PROP_POS_MSEC); с PyAV — к ключевому кадру не позже этого времени."""
+        if self._cap is not None:
+            return self._cap.set(prop, value)
+        if self._stream is None or prop != cv2.CAP_PROP_POS_MSEC:
+            return False
+        try:
+            self._container.seek(int(value / 1000.0 / float(self._stream.time_base)), stream=self._stream, backward=True)
+        except Exception as e:
+            logger.warning("Ошибка перехода к %.1f с: %s", value / 1000.0, e)
+            return False
+        self._frames = self._container.decode(self._stream)
+        return True
+
+    def read(self, need_frame: Union[bool, Callable[[float], bool]] = True) -> Tuple[bool, Optional[np.ndarray], float]:
+        """
+        Читает следующий кадр (с PyAV — следующий ключевой кадр).
+
+        Args:
+            need_frame: Нужен ли кадр, или функция от времени прочитанного кадра в источнике
+                (секунды), которая решает это после чтения
+
+        Returns:
+            (успех, кадр BGR или None, если кадр не нужен, время CPU потока на чтение)
+        """
+        started = time.thread_time()
+        if self._cap is not None:
+            if not self._cap.grab():
+                return False, None, time.thread_time() - started
+            if callable(need_frame):
+                need_frame = need_frame(self._cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+            frame = None
+            if need_frame:
+                ret, frame = self._cap.retrieve()
+                if not ret:
+                    return False, None, time.thread_time() - started
+            return True, frame, time.thread_time() - started
+
+        try:
+            frame = next(self._frames)
+        except StopIteration:
+            return False, None, time.thread_time() - started
+        except Exception as e:
+            logger.warning("Ошибка чтения ключевого кадра: %s", e, extra={"rate_limit": 5.0})
+            return False, None, time.thread_time() - started
+        if frame.time is not None:
+            self._position = frame.time
+        if callable(need_frame):
+            need_frame = need_frame(self._position)
+        image = frame.to_ndarray(format="bgr24") if need_frame else None
+        return True, image, time.thread_time() - started
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+        if self._container is not None:
+            self._container.close()
+            self._container = None
+        self._frames = None
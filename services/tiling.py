@@ -0,0 +1,147 @@
+"""
+Тайловая детекция для широких кадров городских камер.
+
+Сигарета занимает несколько пикселей в уменьшенном полном кадре, поэтому кадр
+режется на сетку перекрывающихся тайлов (как split_frame_into_quadrants в
+experiments/experiment_inference.ipynb), все тайлы отправляются на детекцию
+не более TILE_CONCURRENCY одновременно, а положительные тайлы переводятся в координаты кадра и
+объединяются NMS. Каждый тайл — отдельный вызов AI модели: он занимает свой слот
+детектора губернатора и учитывается в бюджете вызовов (services/rate_control.py).
+"""
+
+import asyncio
+import base64
+import os
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from services.governor import governor
+from utils import detect_smoking, normalize_verdict
+
+# Порог IoU для объединения положительных тайлов. Соседние тайлы пересекаются
+# только по полосе перекрытия, поэтому объединяются любые пересекающиеся тайлы.
+TILE_NMS_IOU_THRESHOLD = 0.0
+
+# Сколько тайлов одного кадра кодируются и проверяются детектором одновременно.
+# Каждый тайл ждет свой слот детектора, поэтому сетка 8x8 не должна ставить в очередь 64 запроса сразу.
+TILE_CONCURRENCY = int(os.getenv("TILE_CONCURRENCY", "4"))
+
+
+@lru_cache(maxsize=64)
+def tile_layout(width: int, height: int, rows: int, cols: int, overlap: float) -> np.ndarray:
+    """
+    Вычисляет раскладку тайлов для кадра заданного разрешения.
+    Результат кэшируется, поэтому для стрима с постоянным разрешением считается один раз.
+
+    Args:
+        width: Ширина кадра
+        height: Высота кадра
+        rows: Количество рядов тайлов
+        cols: Количество столбцов тайлов
+        overlap: Перекрытие соседних тайлов в долях размера тайла
+
+    Returns:
+        np.ndarray: Рамки тайлов [x1, y1, x2, y2] размера (rows * cols, 4)
+    """
+    tile_w = width / cols
+    tile_h = height / rows
+    pad_x = tile_w * overlap / 2
+    pad_y = tile_h * overlap / 2
+
+    rects = []
+    for row in range(rows):
+        for col in range(cols):
+            x1 = max(0, int(col * tile_w - pad_x))
+            y1 = max(0, int(row * tile_h - pad_y))
+            x2 = min(width, int(round((col + 1) * tile_w + pad_x)))
+            y2 = min(height, int(round((row + 1) * tile_h + pad_y)))
+            rects.append((x1, y1, x2, y2))
+    layout = np.array(rects, dtype=np.int32)
+    layout.flags.writeable = False
+    return layout
+
+
+def merge_boxes(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = TILE_NMS_IOU_THRESHOLD) -> np.ndarray:
+    """
+    Векторный NMS с объединением: рамка с наибольшим score подавляет рамки,
+    пересекающиеся с ней сильнее порога, и расширяется до их объединения.
+    Так объект на стыке тайлов дает одну рамку, покрывающую оба тайла.
+
+    Args:
+        boxes: Рамки [x1, y1, x2, y2]
+        scores: Уверенность для каждой рамки
+        iou_threshold: Рамки с IoU выше порога объединяются
+
+    Returns:
+        np.ndarray: Объединенные рамки в порядке убывания score
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores, kind="stable")
+    merged = []
+    while order.size:
+        i = order[0]
+        rest = order[1:]
+        w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        suppressed = iou > iou_threshold
+        group = boxes[np.concatenate(([i], rest[suppressed]))]
+        merged.append([group[:, 0].min(), group[:, 1].min(), group[:, 2].max(), group[:, 3].max()])
+        order = rest[~suppressed]
+    return np.array(merged, dtype=np.float64).reshape(-1, 4)
+
+
+def _encode_tile(tile: np.ndarray) -> str:
+    _, buffer = cv2.imencode('.png', tile)
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+async def detect_smoking_tiled(frame: np.ndarray, rows: int, cols: int, overlap: float,
+                               stream_id: str) -> Tuple[Optional[str], List[List[float]]]:
+    """
+    Запускает детекцию курения по тайлам кадра.
+
+    Args:
+        frame: Кадр BGR
+        rows: Количество рядов тайлов
+        cols: Количество столбцов тайлов
+        overlap: Перекрытие соседних тайлов в долях размера тайла
+        stream_id: Стрим, от имени которого тайлы занимают слоты детектора
+
+    Returns:
+        tuple: (вердикт "Yes"/"No", рамки [x1, y1, x2, y2] в координатах кадра).
+            Если AI модель не ответила хотя бы для одного тайла — (None, []):
+            непроверенная часть кадра не должна превращаться в вердикт "No"
+    """
+    height, width = frame.shape[:2]
+    layout = tile_layout(width, height, rows, cols, overlap)
+
+    # Тайлы — это срезы кадра без копирования; тайл кодируется непосредственно перед
+    # отправкой, поэтому в памяти не больше TILE_CONCURRENCY закодированных тайлов
+    semaphore = asyncio.Semaphore(TILE_CONCURRENCY)
+
+    async def detect_tile(tile: np.ndarray):
+        async with semaphore:
+            b64 = await asyncio.to_thread(_encode_tile, tile)
+            async with governor.detector_slot(stream_id):
+                return await asyncio.to_thread(detect_smoking, b64)
+
+    tiles = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in layout]
+    verdicts = await asyncio.gather(*(detect_tile(tile) for tile in tiles))
+    if any(v is None for v in verdicts):
+        return None, []
+
+    positive = np.array([normalize_verdict(v) == "Yes" for v in verdicts], dtype=bool)
+    if not positive.any():
+        return "No", []
+
+    # Рамка тайла в его координатах — [0, 0, w, h]; сдвиг на смещение тайла
+    # переводит ее в координаты кадра, то есть совпадает с рамкой тайла в раскладке
+    boxes = layout[positive].astype(np.float64)
+    merged = merge_boxes(boxes, np.ones(len(boxes)))
+    return "Yes", merged.tolist()
@@ -0,0 +1,192 @@
+"""
+Трекинг детекций между кадрами.
+
+Сопоставляет рамки соседних кадров (IoU с отсечением по расстоянию между
+центрами, венгерский алгоритм) и присваивает им ID треков, чтобы курящий
+человек в кадре давал одно событие на весь трек, а не по событию на каждый кадр.
+Логика повторяет DetectionTracker из experiments/experiment_inference.ipynb,
+но матрицы стоимости считаются векторно.
+"""
+
+from typing import List, Optional, Sequence
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Параметры трекера для рамок от внешнего детектора (каждый кадр)
+FRAME_TRACKER_PARAMS = {"max_age": 15, "min_hits": 3}
+
+# Параметры трекера для вердиктов AI модели (один сэмпл раз в несколько секунд)
+VERDICT_TRACKER_PARAMS = {"max_age": 3, "min_hits": 2}
+
+# Через сколько секунд подтвержденный трек нужно повторно проверить AI моделью
+TRACK_REVERIFY_INTERVAL = 30.0
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Матрица IoU между двумя наборами рамок [x1, y1, x2, y2].
+
+    Returns:
+        np.ndarray: Матрица размера (len(boxes_a), len(boxes_b))
+    """
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def centroid_distance_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Матрица расстояний между центрами рамок."""
+    centers_a = (boxes_a[:, :2] + boxes_a[:, 2:]) / 2
+    centers_b = (boxes_b[:, :2] + boxes_b[:, 2:]) / 2
+    return np.linalg.norm(centers_a[:, None, :] - centers_b[None, :, :], axis=2)
+
+
+class Track:
+    """Один трек: последовательность сопоставленных рамок одного объекта."""
+
+    __slots__ = ("id", "box", "conf", "age", "hits", "confirmed", "started_at", "last_seen", "verified_at")
+
+    def __init__(self, track_id: int, box: np.ndarray, conf: float, timestamp: float):
+        self.id = track_id
+        self.box = box
+        self.conf = conf
+        self.age = 0
+        self.hits = 1
+        self.confirmed = False
+        self.started_at = timestamp
+        self.last_seen = timestamp
+        # Время последней проверки трека AI моделью
+        self.verified_at: Optional[float] = None
+
+    def to_event(self, event: str, timestamp: float) -> dict:
+        return {
+            "type": "smoking_event",
+            "event": event,
+            "track_id": self.id,
+            "timestamp": timestamp,
+            "started_at": self.started_at,
+            "duration": round(self.last_seen - self.started_at, 3),
+            "hits": self.hits,
+            "confidence": round(float(self.conf), 4),
+            "box": [round(float(v), 1) for v in self.box],
+        }
+
+
+class DetectionTracker:
+    """
+    Трекер детекций одного стрима.
+
+    Трек подтверждается после min_hits сопоставлений и завершается, если
+    не сопоставлялся max_age обновлений подряд. Для каждого подтвержденного
+    трека update() возвращает ровно одно событие "started" и одно "ended".
+    """
+
+    def __init__(self, max_age: int = 15, min_hits: int = 3, iou_threshold: float = 0.3, distance_ratio: float = 1.0):
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        # Максимальное расстояние между центрами в долях диагонали рамки трека
+        self.distance_ratio = distance_ratio
+        self.tracks: List[Track] = []
+        self.next_id = 1
+        # ID трека для каждой детекции последнего update()
+        self.last_track_ids: List[int] = []
+
+    def update(self, boxes: Sequence[Sequence[float]], confs: Sequence[float], timestamp: float) -> List[dict]:
+        """
+        Сопоставляет детекции кадра с треками.
+
+        Args:
+            boxes: Рамки детекций [x1, y1, x2, y2]
+            confs: Уверенность для каждой рамки
+            timestamp: Время кадра
+
+        Returns:
+            list: События жизненного цикла треков ("started" / "ended")
+        """
+        detections = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        events = []
+        matched_tracks = set()
+        matched_dets = set()
+        track_ids = [0] * len(detections)
+
+        if self.tracks and len(detections):
+            track_boxes = np.stack([track.box for track in self.tracks])
+            iou = iou_matrix(track_boxes, detections)
+            distance = centroid_distance_matrix(track_boxes, detections)
+            diagonal = np.linalg.norm(track_boxes[:, 2:] - track_boxes[:, :2], axis=1)
+            iou[distance > diagonal[:, None] * self.distance_ratio] = 0.0
+
+            rows, cols = linear_sum_assignment(-iou)
+            for i, j in zip(rows, cols):
+                if iou[i, j] <= self.iou_threshold:
+                    continue
+                track = self.tracks[i]
+                track.box = detections[j]
+                track.conf = confs[j]
+                track.age = 0
+                track.hits += 1
+                track.last_seen = timestamp
+                matched_tracks.add(i)
+                matched_dets.add(j)
+                track_ids[j] = track.id
+
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.age += 1
+
+        for j in range(len(detections)):
+            if j not in matched_dets:
+                self.tracks.append(Track(self.next_id, detections[j], confs[j], timestamp))
+                track_ids[j] = self.next_id
+                self.next_id += 1
+        self.last_track_ids = track_ids
+
+        alive = []
+        for track in self.tracks:
+            if track.age >= self.max_age:
+                if track.confirmed:
+                    events.append(track.to_event("ended", timestamp))
+                continue
+            if not track.confirmed and track.hits >= self.min_hits:
+                track.confirmed = True
+                events.append(track.to_event("started", timestamp))
+            alive.append(track)
+        self.tracks = alive
+        return events
+
+    def confirmed_tracks(self) -> List[Track]:
+        return [track for track in self.tracks if track.confirmed]
+
+    def mark_verified(self, timestamp: float):
+        """Отмечает, что подтвержденные треки только что проверены AI моделью."""
+        for track in self.tracks:
+            if track.confirmed and track.age == 0:
+                track.verified_at = timestamp
+
+    def should_verify(self, timestamp: float, reverify_interval: float = TRACK_REVERIFY_INTERVAL) -> bool:
+        """
+        Нужно ли вызывать AI модель для очередного сэмпла.
+
+        Если все активные треки уже подтверждены и проверены не раньше чем
+        reverify_interval секунд назад, повторная проверка не нужна.
+        """
+        confirmed = self.confirmed_tracks()
+        if not confirmed or len(confirmed) != len(self.tracks):
+            return True
+        return any(
+            track.verified_at is None or timestamp - track.verified_at >= reverify_interval
+            for track in confirmed
+        )
+
+    def close(self, timestamp: float) -> List[dict]:
+        """Завершает все треки (при остановке стрима) и возвращает события "ended"."""
+        events = [track.to_event("ended", timestamp) for track in self.tracks if track.confirmed]
+        self.tracks = []
+        return events
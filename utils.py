@@ -1,29 +1,57 @@
+import hashlib
+import logging
+import os
+import time
 from openai import OpenAI
-import requests
-from bs4 import BeautifulSoup
-import re
 
-API_KEY = ""
+logger = logging.getLogger(__name__)
+
+# Параметры OpenAI-совместимого API детектора. Для нагрузочных тестов без сети
+# укажите DETECTOR_BASE_URL локального мок-сервера (benchmarks/mock_detector.py)
+API_KEY = os.getenv("DETECTOR_API_KEY", "")
+DETECTOR_BASE_URL = os.getenv("DETECTOR_BASE_URL", "https://openrouter.ai/api/v1")
+DETECTOR_MODEL = os.getenv("DETECTOR_MODEL", "nvidia/nemotron-nano-12b-v2-vl:free")
+
+# Детектор: "openai" (AI модель по API) или "stub" (локальная заглушка для бенчмарков)
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "openai")
+# Задержка и ответ заглушки детектора
+DETECTOR_STUB_LATENCY = float(os.getenv("DETECTOR_STUB_LATENCY", "0.2"))
+DETECTOR_STUB_VERDICT = os.getenv("DETECTOR_STUB_VERDICT", "No")
+
+DETECTOR_PROMPT = "Is someone smoking a cigarette or vape in this photo? Just answer Yes or No."
+
+# Версия конфигурации детектора: закэшированные результаты (services/result_index.py)
+# действительны, только пока не менялись модель, промпт и бэкенд
+DETECTOR_CONFIG_VERSION = os.getenv("DETECTOR_CONFIG_VERSION") or hashlib.sha256(
+    "|".join(
+        [DETECTOR_BACKEND, DETECTOR_BASE_URL, DETECTOR_MODEL, DETECTOR_PROMPT]
+        + ([DETECTOR_STUB_VERDICT] if DETECTOR_BACKEND == "stub" else [])
+    ).encode("utf-8")
+).hexdigest()[:12]
 
 client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
+  base_url=DETECTOR_BASE_URL,
   api_key=API_KEY,
-)
+) if DETECTOR_BACKEND == "openai" else None
 
 def detect_smoking(b64_image: str):
     """
     Calls the OpenAI API to detect smoking in a base64 encoded image.
+    With DETECTOR_BACKEND=stub returns DETECTOR_STUB_VERDICT after DETECTOR_STUB_LATENCY seconds.
     """
+    if DETECTOR_BACKEND == "stub":
+        time.sleep(DETECTOR_STUB_LATENCY)
+        return DETECTOR_STUB_VERDICT
     try:
         response = client.chat.completions.create(
-            model="nvidia/nemotron-nano-12b-v2-vl:free",
+            model=DETECTOR_MODEL,
             messages=[
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": "Is someone smoking a cigarette or vape in this photo? Just answer Yes or No."
+                            "text": DETECTOR_PROMPT
                         },
                         {
                             "type": "image_url",
@@ -38,51 +66,18 @@ def detect_smoking(b64_image: str):
         )
         return response.choices[0].message.content
     except Exception as e:
-        print(f"Error calling OpenAI API: {e}")
+        logger.warning("Error calling OpenAI API: %s", e, extra={"rate_limit": 5.0})
         return None
 
-def extract_hls_url_from_page(url):
-    """
-    Extracts HLS (.m3u8) URLs from a given web page.
-
-    Args:
-        url (str): The URL of the web page to scrape.
 
-    Returns:
-        str: The first HLS URL found on the page, or None.
+def normalize_verdict(verdict_raw: str) -> str:
     """
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching URL: {e}")
-        return None
-
-    soup = BeautifulSoup(response.text, 'html.parser')
-    hls_urls = []
-
-    # 1. Search for .m3u8 in script tags (often embedded in JavaScript)
-    for script in soup.find_all('script'):
-        if script.string:
-            # This regex looks for http or https URLs ending with .m3u8
-            found_urls = re.findall(r'https?://[^\\s"\'_]+\.m3u8', script.string)
-            hls_urls.extend(found_urls)
-    
-    # 2. Search for .m3u8 in video and source tags
-    for video_tag in soup.find_all('video'):
-        if 'src' in video_tag.attrs and '.m3u8' in video_tag['src']:
-            hls_urls.append(video_tag['src'])
-        for source_tag in video_tag.find_all('source'):
-            if 'src' in source_tag.attrs and '.m3u8' in source_tag['src']:
-                hls_urls.append(source_tag['src'])
-
-    # 3. Search for .m3u8 in any tag's attributes (e.g., 'href', 'data-src', etc.)
-    for tag in soup.find_all(True): # find all tags
-        for attr, value in tag.attrs.items():
-            if isinstance(value, str) and '.m3u8' in value:
-                if value.startswith('http://') or value.startswith('https://'):
-                    hls_urls.append(value)
-    
-    if hls_urls:
-        return hls_urls[0]
-    return None
+    Normalizes a detector answer: "Yes" if it contains "yes", "No" if it contains "no",
+    otherwise the stripped original answer.
+    """
+    verdict_lower = verdict_raw.strip().lower()
+    if "yes" in verdict_lower:
+        return "Yes"
+    if "no" in verdict_lower:
+        return "No"
+    return verdict_raw.strip()